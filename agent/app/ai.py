@@ -8,20 +8,25 @@
 
 
 import os
-import requests
-import json
-from time import sleep
+import asyncio
+from typing import List
 
+from langchain_core.callbacks import BaseCallbackHandler
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.pydantic_v1 import BaseModel, Field
 
-from langchain import hub
 from langchain.agents import tool
-from langchain.agents import AgentExecutor, create_react_agent
+from langchain.agents import AgentExecutor
 from langchain.agents.format_scratchpad.openai_tools import format_to_openai_tool_messages
 from langchain.agents.output_parsers.openai_tools import OpenAIToolsAgentOutputParser
 
-from langchain_openai import ChatOpenAI, OpenAI
+from langchain_openai import ChatOpenAI
+from langchain_community.callbacks.manager import get_openai_callback
+
+from clients import http_get, run_async, get_openai_limit, HTTP_TIMEOUT_SECONDS, HTTP_MAX_RETRIES
+from devices import device_registry
+from telemetry import span, Span
+from history import ChatHistory, count_message_tokens, CHAT_SUMMARY_MODEL, CHAT_SUMMARY_MAX_TOKENS
 
 
 LANGCHAIN_TRACING_V2 = os.environ['LANGCHAIN_TRACING_V2']
@@ -34,53 +39,104 @@ OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
 OPENAI_ORG_ID = os.environ["OPENAI_ORG_ID"]
 
 
-@tool
-def set_shelly_light_on(ip: str):
-    """Sets Shelly controlled light on."""
-    response = requests.get(f'http://{ip}/relay/0?turn=on')
-    return response.json()
+# coroutine tools, the async agent executor runs the tool calls of one step concurrently
+# on the shared event loop, bounded by the tool limit of the clients module
 
-@tool
-def set_shelly_light_off(ip: str):
-    """Sets Shelly controlled light off."""
-    response = requests.get(f'http://{ip}/relay/0?turn=off')
-    return response.json()
+class LightState(BaseModel):
+    light: str = Field(description="name or ip address of the light")
+    on: bool = Field(description="true to turn the light on, false to turn it off")
+
+class LightStates(BaseModel):
+    lights: List[LightState] = Field(description="lights to switch")
+
+# the device registry knows the generation and switch endpoint of every light, no discovery calls needed
+
+@tool(args_schema=LightState)
+async def set_light(light: str, on: bool):
+    """Turns a Shelly controlled light, given by name or ip address, on or off."""
+    return await device_registry.set_light(light, on)
+
+@tool(args_schema=LightStates)
+async def set_lights(lights: List[LightState]):
+    """Turns several Shelly controlled lights on or off at once."""
+    return await device_registry.set_lights([(l['light'], l['on']) if isinstance(l, dict) else (l.light, l.on) for l in lights])
 
 @tool
-def wait(seconds: float):
+async def wait(seconds: float):
     """Waits for the provided seconds an then returns."""
-    sleep(seconds)
+    await asyncio.sleep(seconds)
 
 @tool
-def do_http_get_request(url: str):
-    """Sends a HTTP GET request using python requests and returns the response object."""
-    response = requests.get(url)
+async def do_http_get_request(url: str):
+    """Sends a HTTP GET request and returns the status code and, if successful, the response text."""
+    response = await http_get(url)
     if response.status_code == 200:
         return { "status_code": response.status_code, "text": response.text }
     else:
         return { "status_code": response.status_code }
 
 
+class TelemetryCallbackHandler(BaseCallbackHandler):
+    # model calls and tool calls of one agent turn as child spans of the turn
+    run_inline = True
+
+    def __init__(self, parent: Span):
+        self.parent = parent
+        self.spans = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self.spans[run_id] = self.parent.child('llm', model=kwargs.get('invocation_params', {}).get('model_name'))
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        llm = self.spans.pop(run_id, None)
+        if llm:
+            usage = (response.llm_output or {}).get('token_usage') or {}
+            llm.set(**{'prompt-tokens': usage.get('prompt_tokens', 0), 'completion-tokens': usage.get('completion_tokens', 0)}).end()
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        llm = self.spans.pop(run_id, None)
+        if llm:
+            llm.set(error=f'{type(error).__name__}: {error}').end()
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        # one stage per tool, e.g. agent_stage_seconds{stage="tool:set_lights"}
+        self.spans[run_id] = self.parent.child(f'tool:{serialized.get("name")}', bytes=len(input_str or ''))
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        tool = self.spans.pop(run_id, None)
+        if tool:
+            tool.set(bytes=tool.attributes['bytes'] + len(str(output))).end()
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        tool = self.spans.pop(run_id, None)
+        if tool:
+            tool.set(error=f'{type(error).__name__}: {error}').end()
+
+
 class IlluminatingAI:
     def __init__(self):
         # models: 'gpt-3.5-turbo', 'gpt-4', 'gpt-4-turbo-preview'
-        self.llm = ChatOpenAI(model="gpt-4-turbo-preview", temperature=0)
-        #self.tools = [set_shelly_light_on, set_shelly_light_off, wait, do_http_get_request]
-        self.tools = [do_http_get_request]
-        self.chat_history = []
+        # the openai sdk pools connections and retries with jittered backoff itself
+        self.llm = ChatOpenAI(model="gpt-4-turbo-preview", temperature=0, request_timeout=HTTP_TIMEOUT_SECONDS, max_retries=HTTP_MAX_RETRIES)
+        #self.tools = [set_light, set_lights, wait, do_http_get_request]
+        self.tools = [set_light, set_lights, do_http_get_request]
+        device_registry.start()
+        # older turns are summarized by a cheaper model, so the prompt stays within a token budget
+        self.summary_llm = ChatOpenAI(model=CHAT_SUMMARY_MODEL, temperature=0, max_tokens=CHAT_SUMMARY_MAX_TOKENS,
+            request_timeout=HTTP_TIMEOUT_SECONDS, max_retries=HTTP_MAX_RETRIES)
+        self.chat_history = ChatHistory(self.summary_llm)
+        self.last_turn_stats = {}
         self.prompt = ChatPromptTemplate.from_messages([
             (
                 "system", 
                 "You are very powerful light assistant. Use your tools to turn shelly controlled lights on or off. "
-                + "Ensure to use the correct API calls depending on the Shelly switch model generation."
-                + "You can use the endpoint /shelly to check the model and generation."
-                + "Useful link: https://shelly-api-docs.shelly.cloud/gen2/ComponentsAndServices/Switch#http-endpoint-relayid"
+                + "Use set_light for one light and set_lights for several lights, they know the API of every Shelly switch model generation. "
                 + "Your should always think about what to do, defining an action to take and observe the result. Your can iterate N times."
+                + "Call independent tools, e.g. for several lights, together in one step, they are executed in parallel."
             ),
             (
                 "user", 
-                "There are lights named by ip address 192.168.11.210 (south west), 192.168.11.212 (south east), 192.168.11.213 (north east), "
-                + "192.168.11.214 (north), 192.168.11.215 (north west), 192.168.11.216 (west) and 192.168.11.217 (east). "
+                f"There are lights named by ip address {device_registry.describe()}. "
             ),
             (
                 "assistant", 
@@ -107,12 +163,34 @@ class IlluminatingAI:
         self.agent_executor = AgentExecutor(agent=self.agent, tools=self.tools, verbose=True)
 
     def ask(self, query: str):
-        result = self.agent_executor.invoke({
-            "input": query, 
-            "chat_history": self.chat_history
-        })
-        self.chat_history.extend([
-            HumanMessage(content=query),
-            AIMessage(content=result["output"])
-        ])
+        return run_async(self.aask(query))
+
+    async def aask(self, query: str):
+        # runs on the shared event loop of the clients module, sync tools are run in its executor
+        # one trace per turn, model and tool calls of the agent iterations are its children
+        turn = span('turn')
+        try:
+            with span('history-load', turn):
+                chat_history = await self.chat_history.get_messages()
+            with get_openai_callback() as usage:
+                async with get_openai_limit():
+                    result = await self.agent_executor.ainvoke({
+                        "input": query, 
+                        "chat_history": chat_history
+                    }, config={'callbacks': [TelemetryCallbackHandler(turn)]})
+            turn.set(**{'tokens': usage.total_tokens, 'model-calls': usage.successful_requests})
+        except Exception as e:
+            turn.set(error=f'{type(e).__name__}: {e}')
+            raise
+        finally:
+            turn.end()
+        self.chat_history.add_turn(query, result["output"])
+        # prompt tokens of all model calls of the turn (agent iterations), the history is part of each
+        self.last_turn_stats = {
+            'history-tokens-sent': count_message_tokens(chat_history),
+            'prompt-tokens': usage.prompt_tokens,
+            'completion-tokens': usage.completion_tokens,
+            'model-calls': usage.successful_requests,
+            **self.chat_history.get_stats(),
+        }
         return result["output"]
@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+
+import os
+import time
+import random
+import asyncio
+import threading
+from urllib.parse import urlsplit
+
+import httpx
+
+
+HTTP_TIMEOUT_SECONDS = float(os.environ.get('HTTP_TIMEOUT_SECONDS', '30'))
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('HTTP_CONNECT_TIMEOUT_SECONDS', '5'))
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', '3'))
+HTTP_BACKOFF_SECONDS = float(os.environ.get('HTTP_BACKOFF_SECONDS', '0.5'))
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '20'))
+OPENAI_MAX_CONCURRENCY = int(os.environ.get('OPENAI_MAX_CONCURRENCY', '16'))
+# tool calls in flight per process, the calls of one agent step run concurrently
+TOOL_MAX_CONCURRENCY = int(os.environ.get('TOOL_MAX_CONCURRENCY', '8'))
+# idempotent device info endpoints, their GET responses are cached per url
+TOOL_CACHE_TTL_SECONDS = float(os.environ.get('TOOL_CACHE_TTL_SECONDS', '60'))
+TOOL_CACHE_PATHS = [p.strip() for p in os.environ.get('TOOL_CACHE_PATHS', '/shelly,/rpc/Shelly.GetDeviceInfo').split(',') if p.strip()]
+
+
+# one event loop per process in a background thread, the openai async client keeps its
+# pooled connections on it and the agents of all sessions are multiplexed onto it
+event_loop = None
+event_loop_lock = threading.Lock()
+openai_limit = None
+tool_limit = None
+
+def get_event_loop():
+    global event_loop, openai_limit, tool_limit
+    with event_loop_lock:
+        if event_loop is None:
+            event_loop = asyncio.new_event_loop()
+            openai_limit = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+            tool_limit = asyncio.Semaphore(TOOL_MAX_CONCURRENCY)
+            threading.Thread(target=event_loop.run_forever, name='async-clients', daemon=True).start()
+        return event_loop
+
+def run_async(coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, get_event_loop()).result()
+
+def get_openai_limit():
+    # agent runs in flight against openai, only used on the shared event loop
+    get_event_loop()
+    return openai_limit
+
+
+# async tool http calls, only used on the shared event loop
+async_http_client = None
+tool_cache = {}
+
+def get_async_http_client():
+    global async_http_client
+    if async_http_client is None:
+        async_http_client = httpx.AsyncClient(timeout=httpx.Timeout(HTTP_TIMEOUT_SECONDS, connect=HTTP_CONNECT_TIMEOUT_SECONDS),
+            limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE))
+    return async_http_client
+
+def backoff_seconds(attempt: int):
+    # exponential with jitter, concurrent tool calls do not retry in lockstep
+    return HTTP_BACKOFF_SECONDS * 2 ** attempt + random.uniform(0, HTTP_BACKOFF_SECONDS)
+
+async def get_with_retries(url: str):
+    # keep-alive connections per host, retried on connection errors and overload
+    async with tool_limit:
+        for attempt in range(HTTP_MAX_RETRIES + 1):
+            try:
+                response = await get_async_http_client().get(url)
+                if response.status_code not in (429, 500, 502, 503, 504) or attempt == HTTP_MAX_RETRIES:
+                    return response
+            except httpx.TransportError:
+                if attempt == HTTP_MAX_RETRIES:
+                    raise
+            await asyncio.sleep(backoff_seconds(attempt))
+
+async def http_get(url: str):
+    # GETs of the cached paths are shared for the ttl, concurrent calls for the same url wait for one request
+    if urlsplit(url).path not in TOOL_CACHE_PATHS:
+        return await get_with_retries(url)
+    entry = tool_cache.get(url)
+    if entry is None or time.monotonic() - entry[0] > TOOL_CACHE_TTL_SECONDS:
+        entry = (time.monotonic(), asyncio.ensure_future(get_with_retries(url)))
+        tool_cache[url] = entry
+    try:
+        response = await asyncio.shield(entry[1])
+    except Exception:
+        if tool_cache.get(url) is entry:
+            del tool_cache[url]
+        raise
+    if response.status_code != 200 and tool_cache.get(url) is entry:
+        del tool_cache[url]
+    return response
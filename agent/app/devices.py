@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+
+import os
+import time
+import asyncio
+import threading
+
+from clients import get_event_loop, get_with_retries
+
+
+# name per device address (ip or host:port), the lights the agent controls
+SHELLY_DEVICES = os.environ.get('SHELLY_DEVICES', '192.168.11.210=south west,192.168.11.212=south east,192.168.11.213=north east,'
+    + '192.168.11.214=north,192.168.11.215=north west,192.168.11.216=west,192.168.11.217=east')
+SHELLY_REFRESH_SECONDS = float(os.environ.get('SHELLY_REFRESH_SECONDS', '300'))
+
+
+def parse_devices(config: str):
+    devices = {}
+    for item in config.split(','):
+        if item.strip():
+            address, _, name = item.partition('=')
+            devices[address.strip()] = name.strip() or address.strip()
+    return devices
+
+
+class DeviceRegistry:
+    # generation and switch endpoint of every configured shelly, probed concurrently in the background
+    # gen1 devices switch with /relay/0?turn=, gen2 and later with the rpc api /rpc/Switch.Set
+
+    def __init__(self, devices: dict, refresh_seconds=SHELLY_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self.devices = {address: {'name': name, 'address': address, 'generation': None, 'model': None, 'online': False,
+                                  'on': None, 'updated': None} for address, name in devices.items()}
+        self.lock = threading.Lock()
+        self.started = False
+
+    def start(self):
+        # one refresh loop per process on the shared event loop
+        with self.lock:
+            if not self.started:
+                self.started = True
+                asyncio.run_coroutine_threadsafe(self.__refresh_loop(), get_event_loop())
+
+    async def __refresh_loop(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.refresh_seconds)
+
+    async def refresh(self):
+        await asyncio.gather(*[self.__probe(device) for device in self.devices.values()])
+
+    async def __probe(self, device):
+        try:
+            response = await get_with_retries(f'http://{device["address"]}/shelly')
+            info = response.json()
+            device['generation'] = info.get('gen', 1)
+            device['model'] = info.get('model', info.get('type'))
+            device['online'] = True
+        except Exception:
+            device['online'] = False
+        device['updated'] = time.strftime('%H:%M:%S')
+
+    def resolve(self, name_or_ip: str):
+        key = name_or_ip.strip().lower()
+        for device in self.devices.values():
+            if key in (device['address'].lower(), device['name'].lower()):
+                return device
+        raise ValueError(f'unknown light {name_or_ip}, known lights: {", ".join(d["name"] for d in self.devices.values())}')
+
+    async def set_light(self, name_or_ip: str, on: bool):
+        # errors are returned to the model instead of raised, so it can correct itself
+        try:
+            device = self.resolve(name_or_ip)
+        except ValueError as e:
+            return {'light': name_or_ip, 'error': str(e)}
+        if device['generation'] is None:
+            await self.__probe(device)
+            if not device['online']:
+                return {'light': device['name'], 'error': 'device not reachable'}
+        if device['generation'] == 1:
+            url = f'http://{device["address"]}/relay/0?turn={"on" if on else "off"}'
+        else:
+            url = f'http://{device["address"]}/rpc/Switch.Set?id=0&on={"true" if on else "false"}'
+        try:
+            response = await get_with_retries(url)
+        except Exception as e:
+            device['online'] = False
+            return {'light': device['name'], 'error': str(e)}
+        if response.status_code != 200:
+            return {'light': device['name'], 'error': f'status code {response.status_code}'}
+        device['on'] = on
+        return {'light': device['name'], 'on': on}
+
+    async def set_lights(self, lights):
+        # lights: list of (name_or_ip, on), switched concurrently
+        return await asyncio.gather(*[self.set_light(name_or_ip, on) for name_or_ip, on in lights])
+
+    def describe(self):
+        return ', '.join(f'{d["name"]} ({d["address"]})' for d in self.devices.values())
+
+    def get_stats(self):
+        return {d['name']: {k: d[k] for k in ['address', 'generation', 'model', 'online', 'on', 'updated']} for d in self.devices.values()}
+
+
+device_registry = DeviceRegistry(parse_devices(SHELLY_DEVICES))
@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+
+# local fake shelly devices for testing the light agent without hardware, alternating gen1 and gen2 api
+#
+#   python fake_shelly.py [--devices 7] [--port 8100] [--latency 0.2]
+#
+# every device listens on its own port, the printed SHELLY_DEVICES value points the agent at them
+
+import json
+import time
+import argparse
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+NAMES = ['south west', 'south east', 'north east', 'north', 'north west', 'west', 'east']
+
+
+def create_handler(generation: int, latency: float, state: dict):
+    class ShellyHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            url = urlsplit(self.path)
+            query = parse_qs(url.query)
+            if url.path == '/shelly':
+                if generation == 1:
+                    body = {'type': 'SHSW-1', 'mac': 'FAKE00000001', 'auth': False, 'fw': '20230913-112003/v1.14.0'}
+                else:
+                    body = {'id': 'shellyplus1-fake', 'model': 'SNSW-001X16EU', 'gen': generation, 'ver': '1.0.8', 'auth_en': False}
+            elif generation == 1 and url.path == '/relay/0':
+                if 'turn' in query:
+                    state['on'] = query['turn'][0] == 'on'
+                body = {'ison': state['on'], 'has_timer': False, 'source': 'http'}
+            elif generation > 1 and url.path == '/rpc/Switch.Set':
+                was_on = state['on']
+                state['on'] = query.get('on', ['false'])[0] == 'true'
+                body = {'was_on': was_on}
+            elif generation > 1 and url.path == '/rpc/Switch.GetStatus':
+                body = {'id': 0, 'source': 'http', 'output': state['on']}
+            else:
+                self.send_error(404)
+                return
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+    return ShellyHandler
+
+def start_devices(count: int, port: int, latency: float):
+    # returns the servers and the SHELLY_DEVICES value
+    servers = []
+    for i in range(count):
+        server = ThreadingHTTPServer(('127.0.0.1', port + i), create_handler(1 if i % 2 == 0 else 2, latency, {'on': False}))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    devices = ','.join(f'127.0.0.1:{port + i}={NAMES[i % len(NAMES)]}{"" if i < len(NAMES) else f" {i}"}' for i in range(count))
+    return servers, devices
+
+def main():
+    parser = argparse.ArgumentParser(description='fake shelly devices')
+    parser.add_argument('--devices', type=int, default=7, help='number of devices, even are gen1, odd are gen2')
+    parser.add_argument('--port', type=int, default=8100, help='port of the first device')
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds per request')
+    args = parser.parse_args()
+    servers, devices = start_devices(args.devices, args.port, args.latency)
+    print(f'SHELLY_DEVICES={devices}', flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        for server in servers:
+            server.shutdown()
+
+if __name__ == '__main__':
+    main()
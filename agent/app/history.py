@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+
+import os
+import asyncio
+import logging
+import threading
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from clients import get_openai_limit
+from telemetry import span
+
+
+# tokens of the chat history sent with every turn, older turns are folded into a summary
+CHAT_HISTORY_TOKEN_BUDGET = int(os.environ.get('CHAT_HISTORY_TOKEN_BUDGET', '2000'))
+# most recent turns always sent verbatim, even above the budget
+CHAT_HISTORY_RECENT_TURNS = int(os.environ.get('CHAT_HISTORY_RECENT_TURNS', '2'))
+CHAT_SUMMARY_MODEL = os.environ.get('CHAT_SUMMARY_MODEL', 'gpt-3.5-turbo')
+CHAT_SUMMARY_MAX_TOKENS = int(os.environ.get('CHAT_SUMMARY_MAX_TOKENS', '300'))
+
+SUMMARY_PROMPT = (
+    'Update the running summary of a conversation between a user and a light assistant with the new turns. '
+    + 'Keep names, ip addresses, device states and open requests, drop small talk. Answer with the summary only.\n\n'
+    + 'Running summary:\n{summary}\n\nNew turns:\n{turns}'
+)
+
+logger = logging.getLogger(__name__)
+
+
+encoding = None
+encoding_lock = threading.Lock()
+
+def count_tokens(text: str):
+    # tiktoken encoding of the openai chat models, ~4 characters per token if it cannot be loaded (offline)
+    global encoding
+    with encoding_lock:
+        if encoding is None:
+            try:
+                import tiktoken
+                encoding = tiktoken.get_encoding('cl100k_base')
+            except Exception:
+                encoding = False
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+def count_message_tokens(messages):
+    # content plus the per message overhead of the chat format
+    return sum(count_tokens(str(m.content)) + 4 for m in messages)
+
+
+class ChatHistory:
+    # recent turns verbatim within a token budget, older turns incrementally summarized by a cheap model
+    # the summary is updated in the background after a turn, the next turn only waits if it is still running
+
+    def __init__(self, summary_llm, token_budget=CHAT_HISTORY_TOKEN_BUDGET, recent_turns=CHAT_HISTORY_RECENT_TURNS):
+        self.summary_llm = summary_llm
+        self.token_budget = token_budget
+        self.recent_turns = recent_turns
+        self.summary = ''
+        self.summary_tokens = 0
+        self.summarized_turns = 0
+        self.summary_failures = 0
+        self.summary_error = None
+        self.turns = []
+        self.compaction = None
+
+    def __turn_tokens(self):
+        return sum(tokens for _, _, tokens in self.turns)
+
+    async def get_messages(self):
+        if self.compaction:
+            await self.compaction
+        messages = []
+        if self.summary:
+            messages.append(SystemMessage(content=f'Summary of the earlier conversation: {self.summary}'))
+        for query, answer, _ in self.turns:
+            messages.extend([HumanMessage(content=query), AIMessage(content=answer)])
+        return messages
+
+    def add_turn(self, query: str, answer: str):
+        # must be called on the event loop, after get_messages
+        tokens = count_message_tokens([HumanMessage(content=query), AIMessage(content=answer)])
+        self.turns.append((query, answer, tokens))
+        evicted = []
+        while len(self.turns) > self.recent_turns and self.summary_tokens + self.__turn_tokens() > self.token_budget:
+            evicted.append(self.turns.pop(0))
+        if evicted:
+            self.compaction = asyncio.ensure_future(self.__summarize(evicted))
+
+    async def __summarize(self, evicted):
+        turns = '\n'.join(f'User: {query}\nAssistant: {answer}' for query, answer, _ in evicted)
+        try:
+            async with get_openai_limit():
+                with span('history-summary', turns=len(evicted)):
+                    result = await self.summary_llm.ainvoke(SUMMARY_PROMPT.format(summary=self.summary or '-', turns=turns))
+            self.summary = str(result.content).strip()
+        except Exception as e:
+            # the evicted turns are kept verbatim, above the budget, and summarized again after the next turn
+            logger.warning('chat history summary of %d turns failed: %s', len(evicted), e)
+            self.turns[:0] = evicted
+            self.summary_failures += 1
+            self.summary_error = f'{type(e).__name__}: {e}'
+            return
+        self.summary_tokens = count_tokens(self.summary) + 4 if self.summary else 0
+        self.summarized_turns += len(evicted)
+        self.summary_error = None
+
+    def get_stats(self):
+        return {
+            'history-turns': len(self.turns),
+            'history-tokens': self.summary_tokens + self.__turn_tokens(),
+            'summarized-turns': self.summarized_turns,
+            'summary-tokens': self.summary_tokens,
+            'summary-failures': self.summary_failures,
+            'summary-error': self.summary_error,
+        }
@@ -1,18 +1,32 @@
 #!/usr/bin/python3
 
+import os
+import itertools
+from collections import deque
 import streamlit as st
 from streamlit_chat import message
+# imported first, profiles the imports of all app modules below
+from startup import mark, get_startup_report
 from ai import IlluminatingAI
-from assistant import AddressAssistantAI
+from devices import device_registry
+from telemetry import start_metrics_server
+
+mark('imports')
 
 APP_NAME='AI Playground - Agents'
+# chat history per session, rendered one page at a time
+CHAT_HISTORY_SIZE = int(os.environ.get('CHAT_HISTORY_SIZE', '200'))
+CHAT_PAGE_SIZE = int(os.environ.get('CHAT_PAGE_SIZE', '20'))
 
 # ui handlers
 def __on_change_agent():
-    st.session_state['messages'] = []
+    st.session_state['messages'] = deque(maxlen=CHAT_HISTORY_SIZE)
+    st.session_state['messages_page'] = 0
     if st.session_state['selected_agent'] == 'Illuminating AI':
         st.session_state['assistant'] = IlluminatingAI()
     else:
+        # the openai assistants integration is only imported when that agent is selected
+        from assistant import AddressAssistantAI
         st.session_state['assistant'] = AddressAssistantAI()
 
 def __on_ask_question():
@@ -21,13 +35,41 @@ def __on_ask_question():
         with st.session_state['thinking_spinner'], st.spinner(f'Thinking'):
             response = st.session_state['assistant'].ask(user_text)
             agent_text = str(response)
+        stats = getattr(st.session_state['assistant'], 'last_turn_stats', None)
+        if stats:
+            summary_failed = ', history summary failed' if stats.get('summary-error') else ''
+            agent_text = f'_{stats["prompt-tokens"]} prompt tokens in {stats["model-calls"]} model calls, history {stats["history-tokens-sent"]} tokens{summary_failed}:_\n\n{agent_text}'
         st.session_state['messages'].append((user_text, True))
         st.session_state['messages'].append((agent_text, False))
+        st.session_state['messages_page'] = 0
+
+def __on_older_messages():
+    st.session_state['messages_page'] += 1
+
+def __on_newer_messages():
+    st.session_state['messages_page'] -= 1
 
 # ui renderers
-def render_chat():
-    for i, (msg, is_user) in enumerate(st.session_state['messages']):
+def render_messages():
+    # only the selected page is rendered, the newest page is 0
+    messages = st.session_state['messages']
+    pages = max(1, -(-len(messages) // CHAT_PAGE_SIZE))
+    page = min(st.session_state['messages_page'], pages - 1)
+    end = len(messages) - page * CHAT_PAGE_SIZE
+    start = max(0, end - CHAT_PAGE_SIZE)
+    if pages > 1:
+        c1, c2, c3 = st.columns([2,6,2])
+        with c1:
+            st.button('Older', on_click=__on_older_messages, disabled=page == pages - 1, use_container_width=True)
+        with c2:
+            st.caption(f'messages {start + 1}-{end} of {len(messages)}')
+        with c3:
+            st.button('Newer', on_click=__on_newer_messages, disabled=page == 0, use_container_width=True)
+    for i, (msg, is_user) in enumerate(itertools.islice(messages, start, end), start):
         message(msg, is_user=is_user, key=str(i))
+
+def render_chat():
+    render_messages()
     st.session_state['thinking_spinner'] = st.empty()
     st.write(f'<font size="3">Question</font>', unsafe_allow_html=True)
     c1, c2 = st.columns([10,1])
@@ -39,13 +81,27 @@ def render_chat():
 def render_sidebar():
     st.subheader('Agent')
     st.radio('Select Agent', key='selected_agent', options=['Illuminating AI', 'Address Assistant AI'], on_change=__on_change_agent)
+    if st.session_state['selected_agent'] == 'Illuminating AI':
+        st.subheader('Lights')
+        for name, device in device_registry.get_stats().items():
+            st.caption(f'  {name}: ' + ', '.join(f'{k} {v}' for k, v in device.items()))
+
+    st.subheader('Startup')
+    report = get_startup_report()
+    for name, m in report['marks'].items():
+        st.caption(f'  {name}: {m["seconds"]}s after process start, rss {m["rss-mb"]} MB')
+    with st.expander(f'imports {report["import-seconds"]}s'):
+        for i in report['imports']:
+            st.caption(f'  {i["package"]}: {i["seconds"]}s, {i["rss-mb"]} MB, {i["modules"]} modules' + (' (lazy)' if i['lazy'] else ''))
 
 def render_page():
     # init first loop
     if len(st.session_state) == 0:
-        st.session_state['messages'] = []
+        st.session_state['messages'] = deque(maxlen=CHAT_HISTORY_SIZE)
+        st.session_state['messages_page'] = 0
         st.session_state['selected_agent'] = 'Illuminating AI'
         st.session_state['assistant'] = IlluminatingAI()
+        mark('ready')
     # init loop
     st.header(APP_NAME)
     render_chat()
@@ -54,4 +110,5 @@ def render_page():
 
 if __name__ == '__main__':
     st.set_page_config(page_title=APP_NAME)
+    start_metrics_server()
     render_page()
@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+
+# the rag and the agent app are built from their own directories and share no code, this module is copied
+# between rag/app and agent/app and kept identical
+
+import os
+import sys
+import time
+import threading
+import importlib.abc
+import importlib.machinery
+
+from telemetry import metrics
+
+
+# time spent executing imported modules per top-level package, recorded from the import of this module on
+STARTUP_IMPORT_PROFILE = os.environ.get('STARTUP_IMPORT_PROFILE', 'true').lower() == 'true'
+STARTUP_REPORT_SIZE = int(os.environ.get('STARTUP_REPORT_SIZE', '15'))
+STARTUP_BUCKETS = [0.5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 60, 120]
+
+
+def get_rss_bytes():
+    # resident set size of the current process, linux only (the app runs in a linux container)
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def get_process_seconds():
+    # wall time since the interpreter process was started, linux only
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class ImportProfile:
+    # exclusive execution time and rss growth per top-level package, nested imports of other packages
+    # are subtracted from the importing package, so the entries add up to the total import time
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.packages = {}
+        self.marks = {}
+
+    def enter(self):
+        stack = self.local.__dict__.setdefault('stack', [])
+        stack.append([time.perf_counter(), get_rss_bytes(), 0.0, 0])
+
+    def exit(self, name: str):
+        stack = self.local.stack
+        start, rss, nested_seconds, nested_rss = stack.pop()
+        seconds = time.perf_counter() - start
+        rss = get_rss_bytes() - rss
+        if stack:
+            stack[-1][2] += seconds
+            stack[-1][3] += rss
+        package = name.split('.')[0]
+        with self.lock:
+            entry = self.packages.setdefault(package, {'seconds': 0.0, 'rss-bytes': 0, 'modules': 0, 'lazy': bool(self.marks)})
+            entry['seconds'] += seconds - nested_seconds
+            entry['rss-bytes'] += rss - nested_rss
+            entry['modules'] += 1
+        metrics.inc('import_seconds_total', seconds - nested_seconds, package=package)
+
+    def mark(self, name: str):
+        # startup milestone, imports after the first mark are reported as lazy
+        seconds = get_process_seconds()
+        with self.lock:
+            if name in self.marks:
+                return
+            self.marks[name] = {'seconds': round(seconds, 2) if seconds is not None else None, 'rss-mb': round(get_rss_bytes() / 2**20, 1)}
+        if seconds is not None:
+            metrics.observe('startup_seconds', seconds, buckets=STARTUP_BUCKETS, phase=name)
+
+    def get_report(self, size: int = STARTUP_REPORT_SIZE):
+        with self.lock:
+            packages = sorted(self.packages.items(), key=lambda p: -p[1]['seconds'])
+            return {
+                'marks': {name: dict(mark) for name, mark in self.marks.items()},
+                'import-seconds': round(sum(p['seconds'] for _, p in packages), 2),
+                'imports': [{'package': package, 'seconds': round(p['seconds'], 3), 'rss-mb': round(p['rss-bytes'] / 2**20, 1),
+                             'modules': p['modules'], 'lazy': p['lazy']} for package, p in packages[:size]],
+            }
+
+
+class ProfilingLoader(importlib.abc.Loader):
+    # wraps the loader of a source or extension module, everything but exec_module is delegated
+
+    def __init__(self, loader, profile: ImportProfile):
+        self.loader = loader
+        self.profile = profile
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        self.profile.enter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            self.profile.exit(module.__name__)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+
+class ProfilingFinder(importlib.abc.MetaPathFinder):
+
+    def __init__(self, profile: ImportProfile):
+        self.profile = profile
+
+    def find_spec(self, fullname, path, target=None):
+        # the regular finders after this one resolve the module, only file based loaders are wrapped
+        for finder in sys.meta_path[sys.meta_path.index(self) + 1:]:
+            find_spec = getattr(finder, 'find_spec', None)
+            spec = find_spec(fullname, path, target) if find_spec else None
+            if spec is not None:
+                if isinstance(spec.loader, (importlib.machinery.SourceFileLoader, importlib.machinery.SourcelessFileLoader,
+                                            importlib.machinery.ExtensionFileLoader)):
+                    spec.loader = ProfilingLoader(spec.loader, self.profile)
+                return spec
+        return None
+
+
+import_profile = ImportProfile()
+
+if STARTUP_IMPORT_PROFILE and not any(isinstance(f, ProfilingFinder) for f in sys.meta_path):
+    sys.meta_path.insert(0, ProfilingFinder(import_profile))
+
+def mark(name: str):
+    import_profile.mark(name)
+
+def get_startup_report():
+    return import_profile.get_report()
+
+def format_startup_report(report: dict):
+    lines = [f'{name}: {m["seconds"]}s since process start, rss {m["rss-mb"]} MB' for name, m in report['marks'].items()]
+    lines.append(f'imports: {report["import-seconds"]}s')
+    lines.extend(f'  {i["package"]}: {i["seconds"]}s, {i["rss-mb"]} MB, {i["modules"]} modules' + (' (lazy)' if i['lazy'] else '')
+                 for i in report['imports'])
+    return '\n'.join(lines)
@@ -0,0 +1,234 @@
+#!/usr/bin/python3
+
+# the rag and the agent app are built from their own directories and share no code, this module is copied
+# between rag/app and agent/app and kept identical apart from the default TELEMETRY_PREFIX
+
+import os
+import json
+import time
+import queue
+import uuid
+import bisect
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+TELEMETRY_ENABLED = os.environ.get('TELEMETRY_ENABLED', 'true').lower() == 'true'
+TELEMETRY_PREFIX = os.environ.get('TELEMETRY_PREFIX', 'agent')
+# prometheus text format on http://host:port/metrics, 0 disables the endpoint
+TELEMETRY_METRICS_PORT = int(os.environ.get('TELEMETRY_METRICS_PORT', '9464'))
+# spans as json lines, empty disables the exporter, rotated to .1 at the size limit
+TELEMETRY_TRACE_PATH = os.environ.get('TELEMETRY_TRACE_PATH', '')
+TELEMETRY_TRACE_MAX_MB = float(os.environ.get('TELEMETRY_TRACE_MAX_MB', '100'))
+TELEMETRY_TRACE_QUEUE_SIZE = int(os.environ.get('TELEMETRY_TRACE_QUEUE_SIZE', '10000'))
+
+SECONDS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+# span attributes counted per stage, e.g. <prefix>_stage_tokens_total{stage="llm"}
+COUNTED_ATTRIBUTES = ['tokens', 'prompt-tokens', 'completion-tokens', 'bytes', 'chars', 'docs', 'chunks', 'errors']
+
+
+def label_string(labels):
+    return ','.join(f'{k}="{str(v)}"'.replace('\n', ' ') for k, v in labels)
+
+
+class Metrics:
+    # process-wide histograms, counters and gauges, rendered in the prometheus text format
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, name: str, value: float, buckets=SECONDS_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': buckets, 'counts': [0] * (len(buckets) + 1), 'sum': 0.0, 'count': 0}
+            histogram['counts'][bisect.bisect_left(buckets, value)] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def render(self):
+        lines = []
+        with self.lock:
+            names = set()
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                metric = f'{self.prefix}_{name}'
+                if name not in names:
+                    names.add(name)
+                    lines.append(f'# TYPE {metric} histogram')
+                cumulative = 0
+                for bound, count in zip(histogram['buckets'] + ['+Inf'], histogram['counts']):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{{label_string(labels + (("le", bound),))}}} {cumulative}')
+                lines.append(f'{metric}_sum{{{label_string(labels)}}} {histogram["sum"]}')
+                lines.append(f'{metric}_count{{{label_string(labels)}}} {histogram["count"]}')
+            for (name, labels), value in sorted(self.counters.items()):
+                metric = f'{self.prefix}_{name}'
+                if name not in names:
+                    names.add(name)
+                    lines.append(f'# TYPE {metric} counter')
+                lines.append(f'{metric}{{{label_string(labels)}}} {value}')
+            for (name, labels), value in sorted(self.gauges.items()):
+                metric = f'{self.prefix}_{name}'
+                if name not in names:
+                    names.add(name)
+                    lines.append(f'# TYPE {metric} gauge')
+                lines.append(f'{metric}{{{label_string(labels)}}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def get_quantiles(self, name: str, quantiles=(0.5, 0.95, 0.99), label: str = 'stage'):
+        # upper bucket bound per label value (stage by default), good enough to spot p99 regressions in the ui
+        result = {}
+        with self.lock:
+            for (metric, labels), histogram in self.histograms.items():
+                if metric != name or not histogram['count']:
+                    continue
+                key = dict(labels).get(label)
+                values = {}
+                for q in quantiles:
+                    rank = q * histogram['count']
+                    cumulative = 0
+                    for bound, count in zip(histogram['buckets'] + [float('inf')], histogram['counts']):
+                        cumulative += count
+                        if cumulative >= rank:
+                            values[f'p{int(q * 100)}'] = bound
+                            break
+                result[key] = values
+        return result
+
+
+class TraceExporter:
+    # spans as json lines, written by a background thread, spans are dropped when the queue is full
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.queue = queue.Queue(maxsize=TELEMETRY_TRACE_QUEUE_SIZE)
+        self.dropped = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        threading.Thread(target=self.__write, name='trace-exporter', daemon=True).start()
+
+    def export(self, record: dict):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def __write(self):
+        while True:
+            records = [self.queue.get()]
+            while not self.queue.empty() and len(records) < 1000:
+                records.append(self.queue.get_nowait())
+            if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                os.replace(self.path, self.path + '.1')
+            with open(self.path, 'a') as f:
+                f.write(''.join(json.dumps(r, default=str) + '\n' for r in records))
+
+
+class Span:
+    # one timed pipeline stage, children are created explicitly (work hops between threads and event loop tasks)
+    # ending a span records its duration in the stage histogram, its counted attributes and exports it
+
+    def __init__(self, name: str, parent=None, **attributes):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.start_time = time.time()
+        self.start = time.perf_counter()
+        self.seconds = None
+
+    def child(self, name: str, **attributes):
+        return Span(name, self, **attributes)
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+        return self
+
+    def end(self, seconds: float = None):
+        # seconds overrides the measured duration (stages timed elsewhere, e.g. in a worker process)
+        if self.seconds is not None:
+            return
+        self.seconds = time.perf_counter() - self.start if seconds is None else seconds
+        record_span(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type:
+            self.set(error=f'{exc_type.__name__}: {exc}')
+        self.end()
+        return False
+
+
+metrics = Metrics(TELEMETRY_PREFIX)
+exporter = TraceExporter(TELEMETRY_TRACE_PATH, int(TELEMETRY_TRACE_MAX_MB * 2**20)) if TELEMETRY_ENABLED and TELEMETRY_TRACE_PATH else None
+
+def span(name: str, parent: Span = None, **attributes):
+    return Span(name, parent, **attributes)
+
+def record_span(span: Span):
+    if not TELEMETRY_ENABLED:
+        return
+    metrics.observe('stage_seconds', span.seconds, stage=span.name)
+    for name in COUNTED_ATTRIBUTES:
+        value = span.attributes.get(name)
+        if isinstance(value, (int, float)) and value:
+            metrics.inc(f'stage_{name.replace("-", "_")}_total', value, stage=span.name)
+    if 'error' in span.attributes:
+        metrics.inc('stage_errors_total', stage=span.name)
+    if exporter:
+        exporter.export({'trace': span.trace_id, 'span': span.span_id, 'parent': span.parent_id, 'name': span.name,
+                         'start': span.start_time, 'seconds': round(span.seconds, 6), **span.attributes})
+
+def record_stage(name: str, seconds: float, parent: Span = None, **attributes):
+    # stage measured elsewhere, recorded as an already finished span
+    Span(name, parent, **attributes).end(seconds)
+
+
+metrics_server = None
+metrics_server_lock = threading.Lock()
+
+def start_metrics_server(port: int = TELEMETRY_METRICS_PORT):
+    # once per process, a second app process on the same host keeps the first one's endpoint
+    global metrics_server
+    with metrics_server_lock:
+        if metrics_server is not None or not TELEMETRY_ENABLED or not port:
+            return
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                data = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+        try:
+            metrics_server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+        except OSError as e:
+            print(f'metrics endpoint on port {port} not started: {e}', flush=True)
+            metrics_server = False
+            return
+        threading.Thread(target=metrics_server.serve_forever, name='metrics-endpoint', daemon=True).start()
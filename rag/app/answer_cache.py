@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get('ANSWER_CACHE_MAX_ENTRIES', '1000'))
+ANSWER_CACHE_TTL_SECONDS = float(os.environ.get('ANSWER_CACHE_TTL_SECONDS', '3600'))
+ANSWER_CACHE_SIMILARITY = float(os.environ.get('ANSWER_CACHE_SIMILARITY', '0.95'))
+
+
+def normalize_question(query: str):
+    return re.sub(r'\s+', ' ', query).strip().lower().rstrip('?!. ')
+
+
+class AnswerCache:
+    # process-wide answer cache shared by all sessions
+    # scope: (knowledge base server, collection, model, prompt template, retrieval settings), an entry is only valid
+    # for the collection content version it was answered on, so every ingestion invalidates it
+
+    def __init__(self, max_entries=ANSWER_CACHE_MAX_ENTRIES, ttl_seconds=ANSWER_CACHE_TTL_SECONDS, similarity=ANSWER_CACHE_SIMILARITY):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity = similarity
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, scope, version: int, query: str, embeddings):
+        # returns (entry, 'exact' | 'semantic') or (None, None), embeddings is only used without exact match
+        key = (scope, normalize_question(query))
+        with self.lock:
+            entry = self.__get_valid(key, version)
+            if entry:
+                self.exact_hits += 1
+                return entry, 'exact'
+            has_candidates = any(k[0] == scope for k in self.entries)
+        if has_candidates and self.similarity < 1.0:
+            vector = self.__normalize(embeddings.embed_query(query))
+            with self.lock:
+                best_key, best_score = None, self.similarity
+                for k in list(self.entries):
+                    if k[0] != scope or self.__get_valid(k, version, touch=False) is None:
+                        continue
+                    score = float(np.dot(self.entries[k]['vector'], vector))
+                    if score >= best_score:
+                        best_key, best_score = k, score
+                if best_key:
+                    self.entries.move_to_end(best_key)
+                    self.semantic_hits += 1
+                    return self.entries[best_key], 'semantic'
+        with self.lock:
+            self.misses += 1
+        return None, None
+
+    def store(self, scope, version: int, query: str, embeddings, answer: str, sources):
+        vector = self.__normalize(embeddings.embed_query(query))
+        with self.lock:
+            key = (scope, normalize_question(query))
+            self.entries[key] = {'answer': answer, 'sources': sources, 'vector': vector, 'version': version, 'created': time.time()}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def __get_valid(self, key, version: int, touch: bool = True):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry['version'] != version or time.time() - entry['created'] > self.ttl_seconds:
+            del self.entries[key]
+            return None
+        if touch:
+            self.entries.move_to_end(key)
+        return entry
+
+    def __normalize(self, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.exact_hits + self.semantic_hits + self.misses
+            return {
+                'answer-cache-entries': len(self.entries),
+                'answer-cache-exact-hits': self.exact_hits,
+                'answer-cache-semantic-hits': self.semantic_hits,
+                'answer-cache-misses': self.misses,
+                'answer-cache-hit-rate': round((self.exact_hits + self.semantic_hits) / lookups, 3) if lookups else 0.0,
+                'answer-cache-evictions': self.evictions,
+            }
+
+
+answer_cache = AnswerCache()
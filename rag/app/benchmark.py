@@ -0,0 +1,221 @@
+#!/usr/bin/python3
+
+# headless retrieval and answer quality benchmark, runs offline against the local vector index and a stub language model
+#
+#   python benchmark.py --corpus ./corpus --questions questions.json [--configs configs.json] [--output results.json]
+#
+# questions.json: [{"question": "...", "sources": ["file-name.pdf", ...]}, ...]
+# configs.json:   [{"name": "...", "chunk_size": 1024, "chunk_overlap": 100, "embedding_model": "...",
+#                   "search_type": "similarity_score_threshold", "k": 6, "score_threshold": 0.3, "fetch_k": 50, "hybrid": true, "rerank": true,
+#                   "vector_encoding": "int8", "ivf_min_rows": 1000, "ann_recall_target": 0.95}, ...]
+# vector_encoding selects the encoding of the local vector index (float32, int8 or pq), the report has
+# its memory footprint and the recall of its approximate search against exact float32 search, a recall below
+# ann_recall_target marks the result, ivf_min_rows lets a small corpus use the ivf index
+# "vector_encoding": null runs the config on an embedded chroma instead, that needs the full chromadb package,
+# the app only installs the http client chromadb-client
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+
+# rag.py reads its configuration at import, none of the external services is used here
+for name in ['LANGCHAIN_TRACING_V2', 'OPENAI_ENABLED', 'ATLASSIAN_ENABLED']:
+    os.environ.setdefault(name, 'false')
+for name in ['LANGCHAIN_PROJECT', 'LANGCHAIN_ENDPOINT', 'LANGCHAIN_API_KEY', 'OPENAI_API_KEY', 'OPENAI_ORG_ID',
+             'ATLASSIAN_URL', 'ATLASSIAN_USERNAME', 'ATLASSIAN_API_KEY', 'AZURE_SEARCH_ENDPOINT', 'AZURE_SEARCH_KEY']:
+    os.environ.setdefault(name, '')
+
+from langchain_community.chat_models.fake import FakeListChatModel
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.prompts import PromptTemplate
+
+from rag import RagAssistant, PROMPT_TEMPLATES, RETRIEVAL_SEARCH_TYPE, RETRIEVAL_K, RETRIEVAL_SCORE_THRESHOLD, RETRIEVAL_FETCH_K, RETRIEVAL_HYBRID, get_search_kwargs
+from embeddings import embedding_registry, EMBEDDING_MODEL_NAME
+from manifest import DocumentManifest, file_hash
+from ingestion import IngestionPipeline, get_process_pool, INGESTION_PROCESSES
+from keyword_index import KeywordIndex
+from reranker import ContextBuilder, RERANK_ENABLED, get_reranker, get_reranker_status
+from vector_index import LocalVectorIndex, LocalVectorStore, VECTOR_INDEX_IVF_MIN_ROWS
+
+
+# what one ingested document is per file type, pdf pages and table rows are no comparable throughput
+DOCUMENT_UNITS = {'.pdf': 'page', '.csv': 'row', '.xlsx': 'row', '.xls': 'sheet element'}
+
+DEFAULT_CONFIG = {
+    'name': 'default',
+    'chunk_size': 1024,
+    'chunk_overlap': 100,
+    'embedding_model': EMBEDDING_MODEL_NAME,
+    'search_type': RETRIEVAL_SEARCH_TYPE,
+    'k': RETRIEVAL_K,
+    'score_threshold': RETRIEVAL_SCORE_THRESHOLD,
+    'fetch_k': RETRIEVAL_FETCH_K,
+    'hybrid': RETRIEVAL_HYBRID,
+    'rerank': RERANK_ENABLED,
+    'vector_encoding': 'float32',
+    'ivf_min_rows': VECTOR_INDEX_IVF_MIN_ROWS,
+    'ann_recall_target': 0.95,
+}
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+    return {
+        'mean-ms': round(statistics.mean(values) * 1000, 2),
+        'p50-ms': round(pick(50) * 1000, 2),
+        'p95-ms': round(pick(95) * 1000, 2),
+        'p99-ms': round(pick(99) * 1000, 2),
+    }
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+def on_debug(msg, obj):
+    pass
+
+def run_config(config, corpus_files, questions, work_dir):
+    config = {**DEFAULT_CONFIG, **config}
+    print(f'running config {config["name"]}', file=sys.stderr)
+    # uncached model, so embedding latency and ingestion throughput measure the real onnx inference
+    embeddings, load_seconds = timed(embedding_registry.get, config['embedding_model'])
+    collection_name = f'benchmark-{config["name"]}'
+    if config['vector_encoding']:
+        vector_index = LocalVectorIndex(collection_name, path=os.path.join(work_dir, 'vector_index'), encoding=config['vector_encoding'],
+            ivf_min_rows=config['ivf_min_rows'])
+        vector_store = LocalVectorStore(vector_index, embeddings)
+    else:
+        # imported here, chromadb-client of the app has no embedded runtime
+        import chromadb
+        from langchain_community.vectorstores.chroma import Chroma
+        vector_index = None
+        vector_store = Chroma(client=chromadb.EphemeralClient(), collection_name=collection_name, embedding_function=embeddings)
+    manifest = DocumentManifest('benchmark', collection_name, path=os.path.join(work_dir, f'manifest-{config["name"]}.sqlite'))
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=config['chunk_size'], chunk_overlap=config['chunk_overlap'])
+    keyword_index = KeywordIndex('benchmark', collection_name, path=work_dir) if config['hybrid'] else None
+    pipeline = IngestionPipeline(on_debug, text_splitter, embeddings, vector_store, manifest, keyword_index)
+
+    files = [(path, os.path.basename(path), file_hash(path)) for path in corpus_files]
+    ingestion, ingestion_seconds = timed(pipeline.run_files, files)
+
+    search_kwargs = get_search_kwargs(config['search_type'], config['k'], config['score_threshold'], config['fetch_k'])
+    model = FakeListChatModel(responses=['stub answer'])
+    prompt = PromptTemplate.from_template(PROMPT_TEMPLATES['mistral'])
+    context_builder = ContextBuilder(config['k'], rerank=config['rerank'])
+    if config['rerank']:
+        # loaded up front, a rerank row without the model would silently measure the retrieval order
+        get_reranker()
+    assistant = RagAssistant(on_debug, vector_store, model, prompt, text_splitter, manifest, pipeline, embeddings, None,
+        config['search_type'], search_kwargs, keyword_index, context_builder)
+
+    def retrieve(query):
+        docs = assistant.retriever.invoke(query)
+        return context_builder.build(query, docs)[0]
+
+    embedding_latencies = []
+    retrieval_latencies = []
+    answer_latencies = []
+    hits = 0
+    recalls = []
+    reciprocal_ranks = []
+    ann_recalls = []
+    for q in questions:
+        vector, seconds = timed(embeddings.embed_query, q['question'])
+        embedding_latencies.append(seconds)
+        if vector_index:
+            approximate = {slot for slot, _ in vector_index.search(vector, config['k'])}
+            exact = {slot for slot, _ in vector_index.search(vector, config['k'], exact=True)}
+            ann_recalls.append(len(approximate & exact) / len(exact) if exact else 1.0)
+        docs, seconds = timed(retrieve, q['question'])
+        retrieval_latencies.append(seconds)
+        relevant = set(q['sources'])
+        rank = next((i + 1 for i, doc in enumerate(docs) if doc.metadata.get('source') in relevant), None)
+        hits += 1 if rank else 0
+        recalls.append(len(relevant & {doc.metadata.get('source') for doc in docs}) / len(relevant) if relevant else 1.0)
+        reciprocal_ranks.append(1 / rank if rank else 0.0)
+        _, seconds = timed(assistant.ask, q['question'])
+        answer_latencies.append(seconds)
+
+    result = {
+        'config': config,
+        'search-kwargs': search_kwargs,
+        'embedding-model-load-seconds': round(load_seconds, 2),
+        'ingestion': {
+            'seconds': round(ingestion_seconds, 2),
+            'files': len(files),
+            'documents': ingestion['docs'],
+            'document-units': {ext: unit for ext, unit in DOCUMENT_UNITS.items() if any(name.endswith(ext) for _, name, _ in files)},
+            'chunks': ingestion['chunks'],
+            'documents-per-second': round(ingestion['docs'] / ingestion_seconds, 1) if ingestion_seconds else 0.0,
+            'chunks-per-second': round(ingestion['chunks'] / ingestion_seconds, 1) if ingestion_seconds else 0.0,
+            'errors': ingestion['errors'],
+        },
+        'reranker': get_reranker_status() if config['rerank'] else 'disabled',
+        'questions': len(questions),
+        # hit: at least one relevant source in the top k, recall: share of the relevant sources in the top k
+        f'hit@{config["k"]}': round(hits / len(questions), 3) if questions else 0.0,
+        f'recall@{config["k"]}': round(statistics.mean(recalls), 3) if recalls else 0.0,
+        'mrr': round(statistics.mean(reciprocal_ranks), 3) if reciprocal_ranks else 0.0,
+        'embedding-latency': percentiles(embedding_latencies),
+        'retrieval-latency': percentiles(retrieval_latencies),
+        'answer-latency': percentiles(answer_latencies),
+    }
+    errors = []
+    if config['rerank'] and result['reranker'] != 'active':
+        errors.append(f'rerank requested, but the reranker is {result["reranker"]}, the results measure the retrieval order')
+    if vector_index:
+        ann_recall = round(statistics.mean(ann_recalls), 3) if ann_recalls else 0.0
+        result['vector-index'] = vector_index.get_stats()
+        result[f'ann-recall@{config["k"]}'] = ann_recall
+        if ann_recall < config['ann_recall_target']:
+            errors.append(f'ann-recall@{config["k"]} {ann_recall} below the target {config["ann_recall_target"]}')
+    if errors:
+        result['error'] = ', '.join(errors)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='RAG retrieval and answer quality benchmark')
+    parser.add_argument('--corpus', required=True, help='directory with pdf, xlsx and csv files')
+    parser.add_argument('--questions', required=True, help='json file with questions and their relevant sources')
+    parser.add_argument('--configs', help='json file with a list of configurations, default is the app configuration')
+    parser.add_argument('--output', default='benchmark-results.json', help='json result file')
+    args = parser.parse_args()
+
+    corpus_files = sorted(os.path.join(args.corpus, name) for name in os.listdir(args.corpus)
+                          if name.endswith(('.pdf', '.xls', '.xlsx', '.csv')))
+    with open(args.questions) as f:
+        questions = json.load(f)
+    configs = [DEFAULT_CONFIG]
+    if args.configs:
+        with open(args.configs) as f:
+            configs = json.load(f)
+
+    # start the parsing worker processes up front, spawning them is not part of the ingestion throughput
+    pool, _ = get_process_pool()
+    list(pool.map(abs, range(INGESTION_PROCESSES)))
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = [run_config(config, corpus_files, questions, work_dir) for config in configs]
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'corpus': os.path.abspath(args.corpus),
+        'corpus-files': len(corpus_files),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    failed = [result['config']['name'] for result in results if 'error' in result]
+    if failed:
+        sys.exit(f'invalid results for config {", ".join(failed)}')
+
+if __name__ == '__main__':
+    main()
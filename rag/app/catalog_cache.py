@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+
+import os
+import time
+import threading
+
+
+CATALOG_CACHE_TTL_SECONDS = float(os.environ.get('CATALOG_CACHE_TTL_SECONDS', '30'))
+
+
+class CatalogCache:
+    # process-wide cache of knowledge base lists and details, shared by all sessions and reruns
+    # entries expire after the ttl, are invalidated on create and delete and carry the collection
+    # content version, so ingestion by the worker process invalidates the details of its collection
+
+    def __init__(self, ttl_seconds: float = CATALOG_CACHE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load, version=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry['version'] == version and time.monotonic() - entry['created'] < self.ttl_seconds:
+                self.hits += 1
+                return entry['value']
+            self.misses += 1
+        value = load()
+        with self.lock:
+            self.entries[key] = {'value': value, 'version': version, 'created': time.monotonic()}
+        return value
+
+    def invalidate(self, *prefix):
+        # drops every entry whose key starts with prefix, all entries without prefix
+        with self.lock:
+            for key in [k for k in self.entries if k[:len(prefix)] == prefix]:
+                del self.entries[key]
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'catalog-cache-entries': len(self.entries),
+                'catalog-cache-hit-rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+catalog_cache = CatalogCache()
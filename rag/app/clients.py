@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+
+import os
+import time
+import random
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import requests
+
+from langchain_community.llms.ollama import OllamaEndpointNotFoundError
+
+
+HTTP_TIMEOUT_SECONDS = float(os.environ.get('HTTP_TIMEOUT_SECONDS', '120'))
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('HTTP_CONNECT_TIMEOUT_SECONDS', '5'))
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', '3'))
+HTTP_BACKOFF_SECONDS = float(os.environ.get('HTTP_BACKOFF_SECONDS', '0.5'))
+HTTP_BACKOFF_MAX_SECONDS = float(os.environ.get('HTTP_BACKOFF_MAX_SECONDS', '10'))
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '20'))
+# sdk clients of the knowledge base servers are checked before use at most this often
+CLIENT_HEALTH_CHECK_SECONDS = float(os.environ.get('CLIENT_HEALTH_CHECK_SECONDS', '30'))
+
+# requests in flight per backend and process, further requests wait for a free slot
+BACKEND_CONCURRENCY = {
+    'ollama': int(os.environ.get('OLLAMA_MAX_CONCURRENCY', '4')),
+    'openai': int(os.environ.get('OPENAI_MAX_CONCURRENCY', '16')),
+    'chroma': int(os.environ.get('CHROMA_MAX_CONCURRENCY', '16')),
+    'azure-search': int(os.environ.get('AZURE_SEARCH_MAX_CONCURRENCY', '8')),
+    'local': int(os.environ.get('LOCAL_MAX_CONCURRENCY', '8')),
+    'confluence': int(os.environ.get('CONFLUENCE_MAX_CONCURRENCY', '4')),
+}
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# connection level errors of the blocking sdks (chroma and azure use requests), worth another attempt
+TRANSIENT_ERRORS = (httpx.TransportError, requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+
+def backoff_seconds(attempt: int):
+    # exponential with full jitter, concurrent clients do not retry in lockstep
+    return random.uniform(0, min(HTTP_BACKOFF_MAX_SECONDS, HTTP_BACKOFF_SECONDS * 2 ** attempt))
+
+def http_timeout():
+    return httpx.Timeout(HTTP_TIMEOUT_SECONDS, connect=HTTP_CONNECT_TIMEOUT_SECONDS)
+
+def http_limits():
+    return httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE)
+
+
+# one event loop per process in a background thread, the async clients and their keep-alive
+# connections live on it and every session's coroutines are multiplexed onto it
+event_loop = None
+event_loop_lock = threading.Lock()
+
+def get_event_loop():
+    global event_loop
+    with event_loop_lock:
+        if event_loop is None:
+            event_loop = asyncio.new_event_loop()
+            threading.Thread(target=event_loop.run_forever, name='async-clients', daemon=True).start()
+        return event_loop
+
+def run_async(coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, get_event_loop()).result()
+
+def iterate_async(async_iterator):
+    # consumes an async generator on the shared loop from synchronous code (streamlit callbacks)
+    loop = get_event_loop()
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(async_iterator.__anext__(), loop).result()
+            except StopAsyncIteration:
+                return
+    finally:
+        asyncio.run_coroutine_threadsafe(async_iterator.aclose(), loop).result()
+
+
+# pooled clients and concurrency limits, created lazily per backend
+async_http_clients = {}
+async_limits = {}
+clients_lock = threading.Lock()
+
+def get_async_http_client(backend: str):
+    # only used on the shared event loop
+    with clients_lock:
+        if backend not in async_http_clients:
+            async_http_clients[backend] = httpx.AsyncClient(timeout=http_timeout(), limits=http_limits())
+        return async_http_clients[backend]
+
+def async_limit(backend: str):
+    # only used on the shared event loop
+    with clients_lock:
+        if backend not in async_limits:
+            async_limits[backend] = asyncio.Semaphore(BACKEND_CONCURRENCY[backend])
+        return async_limits[backend]
+
+
+class LazyClient:
+    # sdk client of a backend, created (and its sdk imported) on first use, health-checked before use and
+    # recreated after a failed check, so a backend restarted after the app is picked up again
+
+    def __init__(self, backend: str, create, check=None):
+        self.backend = backend
+        self.create = create
+        self.check = check
+        self.lock = threading.Lock()
+        self.client = None
+        self.checked = None
+        self.stats = {'created': 0, 'checks': 0, 'failed-checks': 0, 'error': None}
+
+    def get(self):
+        with self.lock:
+            try:
+                if self.client is None:
+                    self.client = self.create()
+                    self.checked = None
+                    self.stats['created'] += 1
+                if self.check and (self.checked is None or time.monotonic() - self.checked > CLIENT_HEALTH_CHECK_SECONDS):
+                    self.stats['checks'] += 1
+                    self.check(self.client)
+                    self.checked = time.monotonic()
+            except Exception as e:
+                # some sdks already connect in the constructor
+                self.client = None
+                self.stats['failed-checks'] += 1
+                self.stats['error'] = f'{type(e).__name__}: {e}'
+                raise ConnectionError(f'{self.backend} is not reachable: {e}') from e
+            self.stats['error'] = None
+            return self.client
+
+    def get_stats(self):
+        with self.lock:
+            return {'backend': self.backend, 'connected': self.client is not None, **self.stats}
+
+
+blocking_executor = ThreadPoolExecutor(max_workers=sum(BACKEND_CONCURRENCY.values()), thread_name_prefix='blocking-client')
+
+async def call_blocking(backend: str, func, *args):
+    # sdks without async api (chroma, azure search, local index) run on a bounded executor,
+    # limited per backend and retried on connection errors
+    async with async_limit(backend):
+        for attempt in range(HTTP_MAX_RETRIES + 1):
+            try:
+                return await asyncio.get_running_loop().run_in_executor(blocking_executor, func, *args)
+            except TRANSIENT_ERRORS:
+                if attempt == HTTP_MAX_RETRIES:
+                    raise
+                await asyncio.sleep(backoff_seconds(attempt))
+
+
+async def astream_lines(backend: str, url: str, payload: dict, headers: dict = None):
+    # streamed POST over the pooled client, retried until the response starts
+    client = get_async_http_client(backend)
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        started = False
+        try:
+            async with client.stream('POST', url, json=payload, headers=headers) as response:
+                if response.status_code in RETRY_STATUS_CODES and attempt < HTTP_MAX_RETRIES:
+                    await response.aread()
+                    await asyncio.sleep(backoff_seconds(attempt))
+                    continue
+                raise_for_status(response.status_code, await response.aread() if response.status_code != 200 else b'', payload.get('model'))
+                started = True
+                async for line in response.aiter_lines():
+                    yield line
+                return
+        except httpx.TransportError:
+            # a broken stream is not retried, the tokens are already out
+            if started or attempt == HTTP_MAX_RETRIES:
+                raise
+            await asyncio.sleep(backoff_seconds(attempt))
+
+def raise_for_status(status_code: int, body: bytes, model: str = None):
+    # same errors as ChatOllama, a 404 lets it fall back to the legacy /api/generate endpoint
+    if status_code == 404:
+        raise OllamaEndpointNotFoundError(f'Ollama call failed with status code 404. Maybe your model is not found and you should pull the model with `ollama pull {model or ""}`.')
+    if status_code != 200:
+        raise ValueError(f'Ollama call failed with status code {status_code}. Details: {body.decode("utf-8", "replace")}')
+
@@ -0,0 +1,200 @@
+#!/usr/bin/python3
+
+import os
+import re
+import time
+import asyncio
+import tempfile
+from itertools import islice
+from datetime import datetime, timedelta
+
+import httpx
+import lxml.html
+
+from langchain_core.documents import Document
+
+from ingestion import iter_file_docs
+from telemetry import span
+from clients import get_async_http_client, async_limit, iterate_async, run_async, backoff_seconds, blocking_executor, \
+    BACKEND_CONCURRENCY, RETRY_STATUS_CODES, HTTP_MAX_RETRIES
+
+
+# pages per listing request, confluence may return fewer
+CONFLUENCE_LIST_LIMIT = int(os.environ.get('CONFLUENCE_LIST_LIMIT', '200'))
+CONFLUENCE_REQUESTS_PER_SECOND = float(os.environ.get('CONFLUENCE_REQUESTS_PER_SECOND', '10'))
+CONFLUENCE_INCLUDE_ATTACHMENTS = os.environ.get('CONFLUENCE_INCLUDE_ATTACHMENTS', 'false').lower() == 'true'
+# pages modified shortly before the last sync are checked again, edits may still have been in flight
+CONFLUENCE_WATERMARK_OVERLAP_SECONDS = float(os.environ.get('CONFLUENCE_WATERMARK_OVERLAP_SECONDS', '300'))
+
+ATTACHMENT_TYPES = ('.pdf', '.xls', '.xlsx', '.csv')
+
+
+def parse_when(value: str):
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+def page_text(html: str):
+    # text of the storage format, block elements separated by whitespace
+    if not html.strip():
+        return ''
+    return re.sub(r'\s+', ' ', ' '.join(lxml.html.fromstring(html).itertext())).strip()
+
+
+class RateLimiter:
+    # token bucket over all confluence requests of the process, only used on the shared event loop
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        # room for at least one request, below one request per second the bucket would never fill up to it
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+rate_limiter = RateLimiter(CONFLUENCE_REQUESTS_PER_SECOND)
+
+
+class ConfluenceClient:
+    # confluence rest api over the pooled async client, bounded by the confluence concurrency of the clients layer
+
+    def __init__(self, url: str, username: str, api_key: str):
+        self.url = url.rstrip('/')
+        self.auth = (username, api_key) if username else None
+
+    async def get(self, path: str, params: dict = None):
+        client = get_async_http_client('confluence')
+        async with async_limit('confluence'):
+            for attempt in range(HTTP_MAX_RETRIES + 1):
+                await rate_limiter.acquire()
+                try:
+                    with span('confluence-request') as request:
+                        response = await client.get(self.url + path, params=params, auth=self.auth)
+                        request.set(status=response.status_code, bytes=len(response.content))
+                except httpx.TransportError:
+                    if attempt == HTTP_MAX_RETRIES:
+                        raise
+                    await asyncio.sleep(backoff_seconds(attempt))
+                    continue
+                if response.status_code in RETRY_STATUS_CODES and attempt < HTTP_MAX_RETRIES:
+                    # rate limited or overloaded, the server's retry-after wins over the own backoff
+                    retry_after = response.headers.get('Retry-After', '')
+                    await asyncio.sleep(float(retry_after) if retry_after.isdigit() else backoff_seconds(attempt))
+                    continue
+                response.raise_for_status()
+                return response
+
+    async def list_pages(self, space_key: str):
+        # version metadata of all current pages, without bodies
+        pages = []
+        start = 0
+        while True:
+            response = await self.get('/rest/api/content', {'spaceKey': space_key, 'type': 'page', 'status': 'current',
+                'expand': 'version', 'start': start, 'limit': CONFLUENCE_LIST_LIMIT})
+            data = response.json()
+            pages.extend(data['results'])
+            if not data['results'] or not data.get('_links', {}).get('next'):
+                return pages
+            start += len(data['results'])
+
+    async def load_page(self, page_id: str):
+        response = await self.get(f'/rest/api/content/{page_id}', {'expand': 'body.storage,version'})
+        page = response.json()
+        # same metadata as the langchain confluence loader
+        metadata = {'title': page['title'], 'id': page['id'], 'source': self.url + page.get('_links', {}).get('webui', ''),
+                    'when': page['version']['when']}
+        docs = [Document(page_content=page_text(page['body']['storage']['value']), metadata=metadata)]
+        if CONFLUENCE_INCLUDE_ATTACHMENTS:
+            docs.extend(await self.load_attachments(page_id, metadata))
+        return docs
+
+    async def load_attachments(self, page_id: str, metadata: dict):
+        response = await self.get(f'/rest/api/content/{page_id}/child/attachment', {'limit': CONFLUENCE_LIST_LIMIT})
+        attachments = [a for a in response.json()['results'] if a['title'].lower().endswith(ATTACHMENT_TYPES)]
+        downloads = await asyncio.gather(*[self.get(a['_links']['download']) for a in attachments])
+        docs = []
+        for attachment, download in zip(attachments, downloads):
+            # parsed on the blocking executor, the event loop keeps fetching
+            docs.extend(await asyncio.get_running_loop().run_in_executor(blocking_executor, parse_attachment,
+                download.content, attachment['title'], metadata))
+        return docs
+
+def parse_attachment(content: bytes, title: str, metadata: dict):
+    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(title)[1]) as f:
+        f.write(content)
+        f.flush()
+        docs = list(iter_file_docs(f.name, title))
+    for doc in docs:
+        doc.metadata.update({'page-title': metadata['title'], 'id': metadata['id'], 'when': metadata['when']})
+    return docs
+
+
+class ConfluenceSync:
+    # incremental sync of one space into one collection: lists the whole space (metadata only), fetches
+    # the pages changed since the watermark concurrently and reports the pages that no longer exist
+    # the watermark is the newest page modification of the last complete sync, kept in the manifest
+
+    def __init__(self, client: ConfluenceClient, manifest, space_key: str):
+        self.client = client
+        self.manifest = manifest
+        self.prefix = f'confluence:{space_key}:'
+        self.space_key = space_key
+        self.watermark_name = f'confluence:{space_key}'
+
+    def list_pages(self):
+        # source id -> page metadata
+        return {self.prefix + str(page['id']): page for page in run_async(self.client.list_pages(self.space_key))}
+
+    def changed_pages(self, pages: dict):
+        # source id -> source hash (page version) of every page to fetch
+        watermark = self.manifest.get_watermark(self.watermark_name)
+        since = parse_when(watermark) - timedelta(seconds=CONFLUENCE_WATERMARK_OVERLAP_SECONDS) if watermark else None
+        changed = {}
+        for source_id, page in pages.items():
+            version = str(page['version']['number'])
+            known = self.manifest.get_source_hash(source_id)
+            if known is not None and since and parse_when(page['version']['when']) < since:
+                continue
+            if known != version:
+                changed[source_id] = version
+        return changed
+
+    def deleted_sources(self, pages: dict):
+        return set(self.manifest.list_sources(self.prefix)) - set(pages)
+
+    def iter_loaded(self, changed: dict):
+        # (source id, docs, error) in completion order, at most a window of pages is held in memory
+        return iterate_async(self.__load_pages(list(changed)))
+
+    async def __load_pages(self, source_ids):
+        window = 2 * BACKEND_CONCURRENCY['confluence']
+        remaining = iter(source_ids)
+        pending = set()
+        try:
+            while True:
+                pending.update(asyncio.ensure_future(self.__load_page(source_id)) for source_id in islice(remaining, window - len(pending)))
+                if not pending:
+                    return
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def __load_page(self, source_id: str):
+        try:
+            return source_id, await self.client.load_page(source_id[len(self.prefix):]), None
+        except Exception as e:
+            return source_id, None, f'{type(e).__name__}: {e}'
+
+    def commit_watermark(self, pages: dict):
+        if pages:
+            self.manifest.set_watermark(self.watermark_name, max((page['version']['when'] for page in pages.values()), key=parse_when))
@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+
+import os
+import time
+
+from langchain_core.documents import Document
+
+
+# debug events kept per ingestion job, older events are dropped
+DEBUG_LOG_SIZE = int(os.environ.get('DEBUG_LOG_SIZE', '50'))
+
+
+def summarize(obj):
+    # counts and sizes instead of the payload itself, cheap to keep and to render
+    if isinstance(obj, Document):
+        obj = [obj]
+    if isinstance(obj, (list, tuple)) and obj and all(isinstance(item, Document) for item in obj):
+        return {
+            'documents': len(obj),
+            'chars': sum(len(doc.page_content) for doc in obj),
+            'sources': len({doc.metadata.get('source') for doc in obj}),
+        }
+    if isinstance(obj, dict):
+        return {k: v for k, v in obj.items() if isinstance(v, (int, float, str, bool)) and len(str(v)) <= 80}
+    if isinstance(obj, (list, tuple, set)):
+        return {'items': len(obj)}
+    text = str(obj)
+    return {'value': text if len(text) <= 80 else text[:80] + '...'}
+
+
+class DebugLog:
+    # ring buffer of the debug events of one ingestion job, json serializable so the worker
+    # can keep it with the job and the app can render it
+
+    def __init__(self, state: dict = None, size=DEBUG_LOG_SIZE):
+        state = state or {}
+        self.entries = list(state.get('entries', []))
+        self.dropped = state.get('dropped', 0)
+        self.size = size
+
+    def append(self, msg, obj):
+        now = time.time()
+        last = self.entries[-1]['at'] if self.entries else None
+        self.entries.append({
+            'at': now,
+            'time': time.strftime('%H:%M:%S', time.localtime(now)),
+            'since-previous-seconds': round(now - last, 2) if last is not None else None,
+            'msg': msg,
+            'summary': summarize(obj),
+        })
+        if len(self.entries) > self.size:
+            self.dropped += len(self.entries) - self.size
+            del self.entries[:-self.size]
+
+    def get_state(self):
+        return {'entries': self.entries, 'dropped': self.dropped}
+
+    def __iter__(self):
+        # newest first
+        return reversed(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
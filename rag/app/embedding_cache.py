@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+
+import numpy as np
+
+from langchain_core.embeddings import Embeddings
+
+from embeddings import FASTEMBED_CACHE_PATH
+from telemetry import span
+
+
+EMBEDDING_CACHE_PATH = os.path.join(FASTEMBED_CACHE_PATH or '.', 'embedding_cache')
+EMBEDDING_CACHE_SIZE_MB = int(os.environ.get('EMBEDDING_CACHE_SIZE_MB', '1024'))
+
+
+def text_hash(kind: str, text: str):
+    # kind separates passages from queries, some models embed them differently
+    return hashlib.sha256(f'{kind}\0{text}'.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    # content addressed, one directory per model:
+    #   index.sqlite  text hash -> slot and last access time (lru)
+    #   vectors.f32   fixed size float32 matrix, memory-mapped, one row per slot
+
+    def __init__(self, model_name: str, path: str = EMBEDDING_CACHE_PATH, size_mb: float = EMBEDDING_CACHE_SIZE_MB):
+        self.model_name = model_name
+        self.dir = os.path.join(path, re.sub(r'[^A-Za-z0-9_.-]', '_', model_name))
+        self.size_bytes = int(size_mb * 2**20)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.vectors = None
+        os.makedirs(self.dir, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(self.dir, 'index.sqlite'), timeout=30, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS entries (hash TEXT PRIMARY KEY, slot INTEGER UNIQUE NOT NULL, last_used REAL NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'dim'").fetchone()
+        if row:
+            self.__open_vectors(row[0])
+
+    def __open_vectors(self, dim: int):
+        self.dim = dim
+        self.max_entries = max(1, self.size_bytes // (dim * 4))
+        file_path = os.path.join(self.dir, 'vectors.f32')
+        if os.path.exists(file_path) and os.path.getsize(file_path) > self.max_entries * dim * 4:
+            self.__shrink(file_path, dim)
+        # w+ creates a sparse file, disk blocks are only allocated for written slots, r+ grows it to the capacity
+        mode = 'r+' if os.path.exists(file_path) else 'w+'
+        self.vectors = np.memmap(file_path, dtype=np.float32, mode=mode, shape=(self.max_entries, dim))
+
+    def __shrink(self, file_path: str, dim: int):
+        # the cache size was lowered: the most recently used entries are kept, those in slots beyond
+        # the new capacity move into the slots of the dropped ones, used slots stay 0..count-1
+        rows = os.path.getsize(file_path) // (dim * 4)
+        old = np.memmap(file_path, dtype=np.float32, mode='r+', shape=(rows, dim))
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            entries = self.db.execute('SELECT hash, slot FROM entries ORDER BY last_used DESC').fetchall()
+            kept, dropped = entries[:self.max_entries], entries[self.max_entries:]
+            moved = [(h, slot) for h, slot in kept if slot >= self.max_entries]
+            free = [slot for _, slot in dropped if slot < self.max_entries]
+            for (h, slot), new_slot in zip(moved, free):
+                old[new_slot] = old[slot]
+            old.flush()
+            self.db.executemany('DELETE FROM entries WHERE hash = ?', [(h,) for h, _ in dropped])
+            self.db.executemany('UPDATE entries SET slot = ? WHERE hash = ?', [(new_slot, h) for (h, _), new_slot in zip(moved, free)])
+            self.db.execute('COMMIT')
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        finally:
+            del old
+        self.evictions += len(dropped)
+        os.truncate(file_path, self.max_entries * dim * 4)
+
+    def get_many(self, hashes):
+        found = {}
+        with self.lock:
+            if self.vectors is not None:
+                for i in range(0, len(hashes), 500):
+                    part = hashes[i:i + 500]
+                    rows = self.db.execute(f'SELECT hash, slot FROM entries WHERE hash IN ({",".join("?" * len(part))})', part).fetchall()
+                    found.update(rows)
+                if found:
+                    now = time.time()
+                    self.db.executemany('UPDATE entries SET last_used = ? WHERE hash = ?', [(now, h) for h in found])
+            result = [self.vectors[found[h]].tolist() if h in found else None for h in hashes]
+            self.hits += len(found)
+            self.misses += len(hashes) - len(found)
+        return result
+
+    def put_many(self, hashes, vectors):
+        if not hashes:
+            return
+        with self.lock:
+            if self.vectors is None:
+                dim = len(vectors[0])
+                self.db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('dim', ?)", (dim,))
+                self.__open_vectors(self.db.execute("SELECT value FROM meta WHERE key = 'dim'").fetchone()[0])
+            # immediate transaction, the ingestion worker process may write concurrently
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                new = [(h, v) for h, v in dict(zip(hashes, vectors)).items()
+                       if not self.db.execute('SELECT 1 FROM entries WHERE hash = ?', (h,)).fetchone()]
+                new = new[:self.max_entries]
+                slots = self.__allocate_slots(len(new))
+                now = time.time()
+                for slot, (h, v) in zip(slots, new):
+                    self.vectors[slot] = v
+                self.vectors.flush()
+                self.db.executemany('INSERT INTO entries (hash, slot, last_used) VALUES (?, ?, ?)', [(h, slot, now) for slot, (h, _) in zip(slots, new)])
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def __allocate_slots(self, n: int):
+        if n == 0:
+            return []
+        # evicted slots are reused right away, so used slots are always 0..count-1
+        count, = self.db.execute('SELECT COUNT(*) FROM entries').fetchone()
+        slots = list(range(count, min(self.max_entries, count + n)))
+        if len(slots) < n:
+            # evict least recently used entries and reuse their slots
+            evicted = self.db.execute('SELECT hash, slot FROM entries ORDER BY last_used LIMIT ?', (n - len(slots),)).fetchall()
+            self.db.executemany('DELETE FROM entries WHERE hash = ?', [(h,) for h, _ in evicted])
+            slots.extend(slot for _, slot in evicted)
+            self.evictions += len(evicted)
+        return slots
+
+    def get_stats(self):
+        with self.lock:
+            count, = self.db.execute('SELECT COUNT(*) FROM entries').fetchone()
+            lookups = self.hits + self.misses
+            return {
+                'embedding-cache-entries': count,
+                'embedding-cache-hits': self.hits,
+                'embedding-cache-misses': self.misses,
+                'embedding-cache-hit-rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'embedding-cache-evictions': self.evictions,
+            }
+
+
+class CachedEmbeddings(Embeddings):
+    # wraps an embedding model, only texts missing in the cache reach onnx inference
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache):
+        self.embeddings = embeddings
+        self.cache = cache
+
+    def embed_documents(self, texts):
+        hashes = [text_hash('passage', t) for t in texts]
+        vectors = self.cache.get_many(hashes)
+        missing = {}
+        for i, v in enumerate(vectors):
+            if v is None:
+                missing.setdefault(hashes[i], texts[i])
+        if missing:
+            # only the model inference is a stage, cache hits are counted
+            with span('embed-documents', docs=len(missing), chars=sum(map(len, missing.values())), cached=len(texts) - len(missing)):
+                computed = self.embeddings.embed_documents(list(missing.values()))
+            self.cache.put_many(list(missing.keys()), computed)
+            computed = dict(zip(missing.keys(), computed))
+            vectors = [v if v is not None else list(computed[h]) for h, v in zip(hashes, vectors)]
+        return vectors
+
+    def embed_query(self, text):
+        return self.embed_queries([text])[0]
+
+    def embed_queries(self, texts):
+        hashes = [text_hash('query', t) for t in texts]
+        vectors = self.cache.get_many(hashes)
+        missing = {}
+        for i, v in enumerate(vectors):
+            if v is None:
+                missing.setdefault(hashes[i], texts[i])
+        if missing:
+            model = getattr(self.embeddings, '_model', None)
+            with span('embed-queries', docs=len(missing), chars=sum(map(len, missing.values()))):
+                if len(missing) > 1 and hasattr(model, 'query_embed'):
+                    # fastembed embeds a list of queries in one onnx batch
+                    computed = [list(map(float, v)) for v in model.query_embed(list(missing.values()))]
+                else:
+                    computed = [list(self.embeddings.embed_query(t)) for t in missing.values()]
+            self.cache.put_many(list(missing.keys()), computed)
+            computed = dict(zip(missing.keys(), computed))
+            vectors = [v if v is not None else computed[h] for h, v in zip(hashes, vectors)]
+        return vectors
+
+
+embedding_caches = {}
+embedding_caches_lock = threading.Lock()
+
+def get_embedding_cache(model_name: str):
+    with embedding_caches_lock:
+        if model_name not in embedding_caches:
+            embedding_caches[model_name] = EmbeddingCache(model_name)
+        return embedding_caches[model_name]
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+import os
+import time
+import threading
+
+from startup import get_rss_bytes
+
+
+FASTEMBED_CACHE_PATH = os.environ.get('FASTEMBED_CACHE_PATH')
+# onnx runtime intra op threads per model, unset lets onnx runtime use all cores
+EMBEDDING_THREADS = int(os.environ.get('EMBEDDING_THREADS') or 0) or None
+
+# see model list: https://qdrant.github.io/fastembed/examples/Supported_Models/
+#EMBEDDING_MODEL_NAME = 'BAAI/bge-small-en-v1.5' # max 384 tokens
+EMBEDDING_MODEL_NAME = 'sentence-transformers/paraphrase-multilingual-mpnet-base-v2' # max 768 tokens
+#EMBEDDING_MODEL_NAME = 'intfloat/multilingual-e5-large' # max 1024 tokens
+
+
+class EmbeddingRegistry:
+    # process-wide registry, every streamlit session shares the loaded onnx models
+
+    def __init__(self, cache_dir=FASTEMBED_CACHE_PATH, threads=EMBEDDING_THREADS):
+        self.cache_dir = cache_dir
+        self.threads = threads
+        self.lock = threading.Lock()
+        self.model_locks = {}
+        self.models = {}
+        self.stats = {}
+        self.warm_up_thread = None
+
+    def get(self, model_name: str = EMBEDDING_MODEL_NAME):
+        model = self.models.get(model_name)
+        if model is not None:
+            return model
+        with self.lock:
+            model_lock = self.model_locks.setdefault(model_name, threading.Lock())
+        # one lock per model, loading model A does not block sessions using model B
+        with model_lock:
+            if model_name not in self.models:
+                self.models[model_name] = self.__load(model_name)
+        return self.models[model_name]
+
+    def __load(self, model_name: str):
+        rss_before = get_rss_bytes()
+        start = time.perf_counter()
+        # fastembed and onnx runtime are only imported with the first model
+        from langchain_community.embeddings.fastembed import FastEmbedEmbeddings
+        model = FastEmbedEmbeddings(model_name=model_name, cache_dir=self.cache_dir, threads=self.threads)
+        load_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        model.embed_query('warm up')
+        warm_up_seconds = time.perf_counter() - start
+        rss_after = get_rss_bytes()
+        with self.lock:
+            self.stats[model_name] = {
+                'load-seconds': round(load_seconds, 2),
+                'warm-up-seconds': round(warm_up_seconds, 2),
+                # delta of the process rss, approximate if several models load at the same time
+                'rss-mb': round((rss_after - rss_before) / 2**20, 1),
+            }
+        return model
+
+    def warm_up(self, model_names=(EMBEDDING_MODEL_NAME,)):
+        for model_name in model_names:
+            self.get(model_name)
+
+    def warm_up_in_background(self, model_names=(EMBEDDING_MODEL_NAME,)):
+        with self.lock:
+            if self.warm_up_thread is not None:
+                return
+            self.warm_up_thread = threading.Thread(target=self.warm_up, args=(model_names,), daemon=True)
+        self.warm_up_thread.start()
+
+    def get_stats(self):
+        with self.lock:
+            return {name: dict(s) for name, s in self.stats.items()}
+
+
+embedding_registry = EmbeddingRegistry()
@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+
+# local fake confluence rest api for testing the space sync without a confluence instance
+#
+#   python fake_confluence.py [--space DOCS] [--pages 1000] [--port 8090] [--latency 0.05] [--max-rps 0]
+#
+# run the worker with ATLASSIAN_URL=http://localhost:8090 and any user and api key
+
+import json
+import time
+import random
+import argparse
+import threading
+from datetime import datetime, timezone
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# confluence caps the page size of listings
+MAX_LIST_LIMIT = 100
+WORDS = ['lamp', 'switch', 'relay', 'network', 'firmware', 'server', 'backup', 'invoice', 'contract', 'meeting',
+         'release', 'incident', 'customer', 'storage', 'license', 'policy', 'holiday', 'onboarding', 'budget', 'report']
+
+
+def now():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+class FakeConfluence:
+    # pages of one space, edit and delete change what the next sync sees
+
+    def __init__(self, space_key: str, page_count: int, latency: float = 0.0, max_rps: float = 0.0):
+        self.space_key = space_key
+        self.latency = latency
+        self.max_rps = max_rps
+        self.lock = threading.Lock()
+        self.pages = {}
+        self.next_id = 100000
+        self.requests = 0
+        self.throttled = 0
+        self.window = []
+        for i in range(page_count):
+            self.add(f'Page {i}')
+
+    def add(self, title: str):
+        with self.lock:
+            page_id = str(self.next_id)
+            self.next_id += 1
+            self.pages[page_id] = {'id': page_id, 'title': title, 'number': 1, 'when': now(), 'body': self.__body(title)}
+            return page_id
+
+    def edit(self, page_id: str):
+        with self.lock:
+            page = self.pages[page_id]
+            page.update({'number': page['number'] + 1, 'when': now(), 'body': self.__body(page['title'])})
+
+    def delete(self, page_id: str):
+        with self.lock:
+            del self.pages[page_id]
+
+    def __body(self, title: str):
+        paragraphs = [' '.join(random.choices(WORDS, k=60)) for _ in range(3)]
+        return f'<h1>{title}</h1>' + ''.join(f'<p>{p}</p>' for p in paragraphs)
+
+    def throttle(self):
+        # true if the request exceeds max_rps within the last second
+        with self.lock:
+            self.requests += 1
+            if not self.max_rps:
+                return False
+            t = time.monotonic()
+            self.window = [w for w in self.window if t - w < 1.0]
+            if len(self.window) >= self.max_rps:
+                self.throttled += 1
+                return True
+            self.window.append(t)
+            return False
+
+    def list_pages(self, query: dict):
+        start = int(query.get('start', ['0'])[0])
+        limit = min(int(query.get('limit', ['25'])[0]), MAX_LIST_LIMIT)
+        with self.lock:
+            if query.get('spaceKey', [self.space_key])[0] != self.space_key:
+                pages = []
+            else:
+                pages = [self.pages[page_id] for page_id in sorted(self.pages)]
+        results = [self.__page(page, body=False) for page in pages[start:start + limit]]
+        data = {'results': results, 'start': start, 'limit': limit, 'size': len(results), '_links': {}}
+        if start + limit < len(pages):
+            data['_links']['next'] = f'/rest/api/content?spaceKey={self.space_key}&start={start + limit}&limit={limit}'
+        return data
+
+    def get_page(self, page_id: str):
+        with self.lock:
+            page = self.pages.get(page_id)
+        return self.__page(page, body=True) if page else None
+
+    def __page(self, page: dict, body: bool):
+        data = {'id': page['id'], 'type': 'page', 'status': 'current', 'title': page['title'],
+                'version': {'number': page['number'], 'when': page['when']},
+                '_links': {'webui': f'/spaces/{self.space_key}/pages/{page["id"]}'}}
+        if body:
+            data['body'] = {'storage': {'value': page['body'], 'representation': 'storage'}}
+        return data
+
+
+def create_handler(confluence: FakeConfluence):
+    class ConfluenceHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(confluence.latency)
+            if confluence.throttle():
+                self.send_response(429)
+                self.send_header('Retry-After', '1')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            url = urlsplit(self.path)
+            parts = url.path.strip('/').split('/')
+            if parts == ['rest', 'api', 'content']:
+                body = confluence.list_pages(parse_qs(url.query))
+            elif len(parts) == 4 and parts[:3] == ['rest', 'api', 'content']:
+                body = confluence.get_page(parts[3])
+            elif len(parts) == 6 and parts[:3] == ['rest', 'api', 'content'] and parts[4:] == ['child', 'attachment']:
+                body = {'results': [], 'start': 0, 'limit': MAX_LIST_LIMIT, 'size': 0, '_links': {}}
+            else:
+                body = None
+            if body is None:
+                self.send_error(404)
+                return
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+    return ConfluenceHandler
+
+def start_server(confluence: FakeConfluence, port: int):
+    server = ThreadingHTTPServer(('127.0.0.1', port), create_handler(confluence))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description='fake confluence rest api')
+    parser.add_argument('--space', default='DOCS', help='space key')
+    parser.add_argument('--pages', type=int, default=1000, help='number of pages in the space')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per request')
+    parser.add_argument('--max-rps', type=float, default=0, help='requests per second before answering 429, 0 is unlimited')
+    args = parser.parse_args()
+    confluence = FakeConfluence(args.space, args.pages, args.latency, args.max_rps)
+    server = start_server(confluence, args.port)
+    print(f'ATLASSIAN_URL=http://localhost:{args.port} space {args.space} with {args.pages} pages', flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
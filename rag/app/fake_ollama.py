@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+# local fake ollama server for testing the generation scheduler without a gpu
+#
+#   python fake_ollama.py [--port 11435] [--parallel 1] [--tokens 50] [--token-seconds 0.02] [--load-seconds 1]
+#
+# run the app with OLLAMA_BASE_URL=http://localhost:11435, a second one on another port
+# with OLLAMA_SPILLOVER_BASE_URL tests the spillover
+
+import json
+import time
+import random
+import argparse
+import threading
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+WORDS = ['the', 'lamp', 'switch', 'relay', 'is', 'documented', 'in', 'the', 'manual', 'see', 'page', 'three', 'for', 'details']
+
+
+def now():
+    return datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+class FakeOllama:
+    # generates like ollama with OLLAMA_NUM_PARALLEL: at most parallel generations at a time, the others
+    # wait in the server, switching to another model costs the load time
+
+    def __init__(self, parallel: int = 1, tokens: int = 50, token_seconds: float = 0.02, load_seconds: float = 1.0):
+        self.tokens = tokens
+        self.token_seconds = token_seconds
+        self.load_seconds = load_seconds
+        self.slots = threading.Semaphore(parallel)
+        self.lock = threading.Lock()
+        self.model = None
+        self.in_flight = 0
+        self.stats = {'requests': 0, 'max-in-flight': 0, 'model-loads': 0, 'requests-per-model': {}}
+
+    def generate(self, model: str):
+        # response tokens, the model is loaded on first use and swapped when another one is requested
+        with self.slots:
+            with self.lock:
+                self.stats['requests'] += 1
+                self.stats['requests-per-model'][model] = self.stats['requests-per-model'].get(model, 0) + 1
+                self.in_flight += 1
+                self.stats['max-in-flight'] = max(self.stats['max-in-flight'], self.in_flight)
+                load = self.model != model
+                if load:
+                    self.model = model
+                    self.stats['model-loads'] += 1
+            try:
+                if load:
+                    time.sleep(self.load_seconds)
+                for i in range(self.tokens):
+                    time.sleep(self.token_seconds)
+                    yield random.choice(WORDS) + ' '
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+
+    def get_stats(self):
+        with self.lock:
+            return {**self.stats, 'requests-per-model': dict(self.stats['requests-per-model'])}
+
+
+def create_handler(ollama: FakeOllama):
+    class OllamaHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            if self.path == '/api/tags':
+                self.send_json({'models': [{'name': name} for name in ollama.get_stats()['requests-per-model']]})
+            elif self.path == '/stats':
+                self.send_json(ollama.get_stats())
+            else:
+                self.send_error(404)
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', '0'))) or b'{}')
+            if self.path not in ('/api/chat', '/api/generate'):
+                self.send_error(404)
+                return
+            model = body.get('model', '')
+            chat = self.path == '/api/chat'
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            start = time.perf_counter()
+            count = 0
+            for token in ollama.generate(model):
+                count += 1
+                part = {'message': {'role': 'assistant', 'content': token}} if chat else {'response': token}
+                self.send_chunk({'model': model, 'created_at': now(), **part, 'done': False})
+            final = {'message': {'role': 'assistant', 'content': ''}} if chat else {'response': ''}
+            self.send_chunk({'model': model, 'created_at': now(), **final, 'done': True,
+                             'total_duration': int((time.perf_counter() - start) * 1e9), 'eval_count': count})
+            self.wfile.write(b'0\r\n\r\n')
+
+        def send_chunk(self, data: dict):
+            line = json.dumps(data).encode() + b'\n'
+            self.wfile.write(f'{len(line):x}\r\n'.encode() + line + b'\r\n')
+            self.wfile.flush()
+
+        def send_json(self, data: dict):
+            body = json.dumps(data).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+    return OllamaHandler
+
+def start_server(ollama: FakeOllama, port: int):
+    server = ThreadingHTTPServer(('127.0.0.1', port), create_handler(ollama))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description='fake ollama server')
+    parser.add_argument('--port', type=int, default=11435)
+    parser.add_argument('--parallel', type=int, default=1, help='generations at a time, like OLLAMA_NUM_PARALLEL')
+    parser.add_argument('--tokens', type=int, default=50, help='tokens per answer')
+    parser.add_argument('--token-seconds', type=float, default=0.02, help='seconds per token')
+    parser.add_argument('--load-seconds', type=float, default=1.0, help='seconds to load another model')
+    args = parser.parse_args()
+    ollama = FakeOllama(args.parallel, args.tokens, args.token_seconds, args.load_seconds)
+    server = start_server(ollama, args.port)
+    print(f'OLLAMA_BASE_URL=http://localhost:{args.port}, stats on /stats', flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
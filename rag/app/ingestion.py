@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import time
+import queue
+import threading
+import multiprocessing
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+
+from langchain_community.vectorstores.utils import filter_complex_metadata
+
+from manifest import chunk_ids
+from telemetry import span, record_stage
+from tabular import iter_table_docs, is_tabular, row_count, TABULAR_CHUNK_SIZE
+from vector_index import LocalVectorStore
+
+
+# empty (the compose default) means unset
+INGESTION_PROCESSES = int(os.environ.get('INGESTION_PROCESSES') or 0) or os.cpu_count() or 1
+INGESTION_LOAD_BATCH_SIZE = int(os.environ.get('INGESTION_LOAD_BATCH_SIZE', '16'))
+INGESTION_EMBED_BATCH_SIZE = int(os.environ.get('INGESTION_EMBED_BATCH_SIZE', '64'))
+INGESTION_QUEUE_SIZE = int(os.environ.get('INGESTION_QUEUE_SIZE', '4'))
+
+
+def iter_file_docs(file_path: str, original_name: str, chunk_size: int = TABULAR_CHUNK_SIZE):
+    # loaders yield page by page (pdf) or row group by row group (csv, xlsx) instead of building the whole list
+    # loaders and their parsers are imported with the first file of their type
+    if original_name.endswith('.pdf'):
+        from langchain_community.document_loaders.pdf import PyPDFLoader
+        docs = PyPDFLoader(file_path).lazy_load()
+    elif is_tabular(original_name):
+        docs = iter_table_docs(file_path, original_name, chunk_size)
+    elif original_name.endswith('.xls'):
+        # legacy excel format, not readable by openpyxl
+        from langchain_community.document_loaders.excel import UnstructuredExcelLoader
+        docs = UnstructuredExcelLoader(file_path, mode="elements").lazy_load()
+    else:
+        raise ValueError(f'unsupported file type: {original_name}')
+    for doc in docs:
+        doc.metadata['source'] = original_name
+        yield doc
+
+def timed_batches(docs, load_batch_size: int):
+    # (batch, seconds spent loading it), the loaders are lazy so loading happens while batching
+    it = iter(docs)
+    while True:
+        start = time.perf_counter()
+        batch = list(islice(it, load_batch_size))
+        if not batch:
+            return
+        yield batch, time.perf_counter() - start
+
+def split_docs(text_splitter, docs, load_batch_size: int):
+    # (doc count, chunks, stage timings) per batch
+    for doc_batch, load_seconds in timed_batches(docs, load_batch_size):
+        start = time.perf_counter()
+        chunks = filter_complex_metadata(text_splitter.split_documents(doc_batch))
+        yield len(doc_batch), chunks, {'load': load_seconds, 'split': time.perf_counter() - start}
+
+def split_table_docs(text_splitter, docs, load_batch_size: int, chunk_size: int):
+    # row groups are already chunks, only rows with oversized cells go through the text splitter, docs counts rows
+    for doc_batch, load_seconds in timed_batches(docs, load_batch_size):
+        start = time.perf_counter()
+        chunks = [chunk for doc in doc_batch for chunk in (text_splitter.split_documents([doc]) if len(doc.page_content) > chunk_size else [doc])]
+        yield sum(row_count(doc) for doc in doc_batch), chunks, {'load': load_seconds, 'split': time.perf_counter() - start}
+
+def iter_file_chunks(file_path: str, original_name: str, text_splitter, load_batch_size: int):
+    chunk_size = getattr(text_splitter, '_chunk_size', TABULAR_CHUNK_SIZE)
+    docs = iter_file_docs(file_path, original_name, chunk_size)
+    if is_tabular(original_name):
+        return split_table_docs(text_splitter, docs, load_batch_size, chunk_size)
+    return split_docs(text_splitter, docs, load_batch_size)
+
+def parse_file(file_path: str, original_name: str, text_splitter, load_batch_size: int, events):
+    # runs in a worker process, chunk batches go back through the bounded events queue
+    try:
+        for doc_count, chunks, timings in iter_file_chunks(file_path, original_name, text_splitter, load_batch_size):
+            events.put(('chunks', original_name, (doc_count, chunks, timings)))
+        events.put(('done', original_name, None))
+    except Exception as e:
+        events.put(('error', original_name, f'{type(e).__name__}: {e}'))
+
+def is_chroma(vector_store):
+    # the chroma integration is only imported once a chroma collection was opened
+    chroma = sys.modules.get('langchain_community.vectorstores.chroma')
+    return chroma is not None and isinstance(vector_store, chroma.Chroma)
+
+def write_chunks(vector_store, ids, chunks, vectors):
+    if is_chroma(vector_store):
+        # embeddings are already computed, upsert them directly instead of embedding again
+        vector_store._collection.upsert(ids=ids, embeddings=vectors, documents=[c.page_content for c in chunks], metadatas=[c.metadata for c in chunks])
+    elif isinstance(vector_store, LocalVectorStore):
+        vector_store.add_embeddings(ids, chunks, vectors)
+    else:
+        # the vector store embeds again, those lookups are served by the embedding cache
+        # chroma upserts by ids, azure search uses keys as document keys
+        vector_store.add_documents(documents=chunks, ids=ids, keys=ids)
+
+
+process_pool = None
+process_pool_manager = None
+process_pool_lock = threading.Lock()
+
+def get_process_pool():
+    # created once per app process and shared by all sessions, spawn avoids forking the threaded streamlit server
+    global process_pool, process_pool_manager
+    with process_pool_lock:
+        if process_pool is None:
+            context = multiprocessing.get_context('spawn')
+            process_pool_manager = context.Manager()
+            process_pool = ProcessPoolExecutor(max_workers=INGESTION_PROCESSES, mp_context=context)
+        return process_pool, process_pool_manager
+
+
+class IngestionPipeline:
+    # parse/split (process pool for files) -> batched embedding -> writer thread
+    # bounded queues between the stages provide the backpressure,
+    # so memory use does not grow with the size or number of files
+
+    def __init__(self, debug_print_func, text_splitter, embeddings, vector_store, manifest, keyword_index=None,
+                 load_batch_size=INGESTION_LOAD_BATCH_SIZE, embed_batch_size=INGESTION_EMBED_BATCH_SIZE, queue_size=INGESTION_QUEUE_SIZE):
+        self.debug = debug_print_func
+        self.text_splitter = text_splitter
+        self.embeddings = embeddings
+        self.vector_store = vector_store
+        self.manifest = manifest
+        self.keyword_index = keyword_index
+        self.load_batch_size = load_batch_size
+        self.embed_batch_size = embed_batch_size
+        self.queue_size = queue_size
+
+    def run(self, source_id: str, source_hash: str, docs, on_progress=None):
+        # single source parsed in this process, used for already loaded documents
+        return self.run_sources({source_id: source_hash}, [(source_id, docs, None)], on_progress)
+
+    def run_sources(self, source_hashes: dict, loaded, on_progress=None):
+        # already loaded sources split in this process as they arrive (confluence pages fetched concurrently),
+        # loaded yields (source_id, docs, error) in any order, error is a message or None
+        def events():
+            for source_id, docs, error in loaded:
+                if error:
+                    yield 'error', source_id, error
+                    continue
+                for doc_count, chunks, timings in split_docs(self.text_splitter, docs, self.load_batch_size):
+                    yield 'chunks', source_id, (doc_count, chunks, timings)
+                yield 'done', source_id, None
+        return self.__ingest(source_hashes, events(), on_progress)
+
+    def run_files(self, files, on_progress=None):
+        # files: list of (file_path, original_name, source_hash), parsed and split in parallel worker processes
+        pool, manager = get_process_pool()
+        events_queue = manager.Queue(maxsize=self.queue_size * max(1, len(files)))
+        futures = {original_name: pool.submit(parse_file, file_path, original_name, self.text_splitter, self.load_batch_size, events_queue)
+                   for file_path, original_name, _ in files}
+
+        def events():
+            open_sources = set(futures)
+            while open_sources:
+                try:
+                    event = events_queue.get(timeout=1)
+                except queue.Empty:
+                    # a worker that died before reporting would otherwise block forever
+                    for source_id in list(open_sources):
+                        future = futures[source_id]
+                        if future.done() and future.exception():
+                            open_sources.discard(source_id)
+                            yield 'error', source_id, str(future.exception())
+                    continue
+                if event[0] in ('done', 'error'):
+                    open_sources.discard(event[1])
+                yield event
+
+        try:
+            return self.__ingest({original_name: source_hash for _, original_name, source_hash in files}, events(), on_progress)
+        finally:
+            # unblock workers still putting into the events queue if ingestion stopped early
+            while not all(future.done() for future in futures.values()):
+                try:
+                    events_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    def __ingest(self, source_hashes, events, on_progress):
+        stats = {'sources': len(source_hashes), 'docs': 0, 'chunks': 0, 'chunks-embedded': 0, 'chunks-written': 0, 'chunks-deleted': 0, 'errors': {}}
+        start = time.perf_counter()
+        trace = span('ingest', sources=len(source_hashes))
+        known_ids = {source_id: self.manifest.get_chunk_ids(source_id) for source_id in source_hashes}
+        seen_ids = {source_id: set() for source_id in source_hashes}
+        occurrences = {source_id: {} for source_id in source_hashes}
+        write_queue = queue.Queue(maxsize=self.queue_size)
+        writer_errors = []
+
+        def report():
+            stats['seconds'] = round(time.perf_counter() - start, 2)
+            stats['chunks-per-second'] = round(stats['chunks-written'] / stats['seconds'], 1) if stats['seconds'] else 0.0
+            if on_progress:
+                on_progress(dict(stats))
+
+        def writer():
+            while (item := write_queue.get()) is not None:
+                if writer_errors:
+                    continue
+                try:
+                    if item[0] == 'chunks':
+                        _, pending, vectors = item
+                        ids = [chunk_id for _, chunk_id, _ in pending]
+                        chunks = [chunk for _, _, chunk in pending]
+                        with trace.child('vector-store-write', chunks=len(chunks)):
+                            write_chunks(self.vector_store, ids, chunks, vectors)
+                        if self.keyword_index:
+                            with trace.child('keyword-index-write', chunks=len(chunks)):
+                                self.keyword_index.add(ids, chunks)
+                        # recorded per batch, written chunks are searchable before the whole source is done
+                        by_source = {}
+                        for source_id, chunk_id, _ in pending:
+                            by_source.setdefault(source_id, []).append(chunk_id)
+                        for source_id, ids in by_source.items():
+                            self.manifest.add_chunks(source_id, ids)
+                        stats['chunks-written'] += len(pending)
+                    else:
+                        _, source_id, stale_ids = item
+                        if stale_ids:
+                            self.vector_store.delete(ids=list(stale_ids))
+                            if self.keyword_index:
+                                self.keyword_index.delete(stale_ids)
+                            self.manifest.remove_chunks(stale_ids)
+                            stats['chunks-deleted'] += len(stale_ids)
+                        self.manifest.set_source(source_id, source_hashes[source_id])
+                    report()
+                except Exception as e:
+                    writer_errors.append(e)
+
+        def put(item):
+            while True:
+                if writer_errors:
+                    raise writer_errors[0]
+                try:
+                    write_queue.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    pass
+
+        def embed(pending):
+            texts = [chunk.page_content for _, _, chunk in pending]
+            with trace.child('embed', chunks=len(texts), chars=sum(map(len, texts))):
+                vectors = self.embeddings.embed_documents(texts)
+            stats['chunks-embedded'] += len(pending)
+            put(('chunks', pending, vectors))
+
+        writer_thread = threading.Thread(target=writer, daemon=True)
+        writer_thread.start()
+        pending = []
+        try:
+            for kind, source_id, payload in events:
+                if kind == 'chunks':
+                    doc_count, chunks, timings = payload
+                    # measured where the source was parsed, possibly in a worker process
+                    record_stage('load', timings['load'], trace, docs=doc_count)
+                    record_stage('split', timings['split'], trace, chunks=len(chunks))
+                    stats['docs'] += doc_count
+                    stats['chunks'] += len(chunks)
+                    ids = chunk_ids(source_id, chunks, occurrences[source_id])
+                    seen_ids[source_id].update(ids)
+                    pending.extend((source_id, chunk_id, chunk) for chunk_id, chunk in zip(ids, chunks) if chunk_id not in known_ids[source_id])
+                    # one embedding stage for all sources, batches may mix chunks of several files
+                    while len(pending) >= self.embed_batch_size:
+                        embed(pending[:self.embed_batch_size])
+                        pending = pending[self.embed_batch_size:]
+                elif kind == 'done':
+                    if pending:
+                        embed(pending)
+                        pending = []
+                    # queued after the source's last chunks, the writer finalizes it in order
+                    put(('finalize', source_id, known_ids[source_id] - seen_ids[source_id]))
+                elif kind == 'error':
+                    # chunks written so far stay recorded, the source hash is not set so a retry resumes
+                    stats['errors'][source_id] = payload
+                report()
+        finally:
+            write_queue.put(None)
+            writer_thread.join()
+            trace.set(docs=stats['docs'], chunks=stats['chunks'], errors=len(stats['errors']) + len(writer_errors)).end()
+        if writer_errors:
+            raise writer_errors[0]
+        report()
+        self.debug('ingested', stats)
+        return stats
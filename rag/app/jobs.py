@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from manifest import RAG_DATA_PATH
+
+
+JOBS_PATH = os.path.join(RAG_DATA_PATH, 'jobs.sqlite')
+UPLOADS_PATH = os.path.join(RAG_DATA_PATH, 'uploads')
+
+
+class JobQueue:
+    # persistent ingestion job queue, the app enqueues and polls, worker.py claims and runs jobs
+    # status: queued -> running -> done | failed
+
+    def __init__(self, path: str = JOBS_PATH):
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL, server TEXT NOT NULL, collection TEXT NOT NULL, payload TEXT NOT NULL,
+                status TEXT NOT NULL, progress TEXT NOT NULL DEFAULT '{}', error TEXT,
+                created REAL NOT NULL, updated REAL NOT NULL)''')
+        # debug events of the worker, added after the first release of the table
+        if 'events' not in {row[1] for row in self.db.execute('PRAGMA table_info(jobs)')}:
+            try:
+                self.db.execute("ALTER TABLE jobs ADD COLUMN events TEXT NOT NULL DEFAULT '{}'")
+            except sqlite3.OperationalError:
+                # added by the app or the worker at the same time
+                pass
+
+    def enqueue(self, kind: str, knowledge_base_server_name: str, collection_name: str, payload: dict):
+        now = time.time()
+        with self.lock:
+            cursor = self.db.execute('INSERT INTO jobs (kind, server, collection, payload, status, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (kind, knowledge_base_server_name, collection_name, json.dumps(payload), 'queued', now, now))
+        return cursor.lastrowid
+
+    def claim_next(self):
+        with self.lock:
+            # immediate transaction, several workers may poll the same queue
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.db.execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone()
+                if row:
+                    self.db.execute("UPDATE jobs SET status = 'running', updated = ? WHERE id = ?", (time.time(), row[0]))
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+        return self.get(row[0]) if row else None
+
+    def requeue_running(self):
+        # jobs interrupted by a restart run again, the manifest skips what was already written
+        with self.lock:
+            self.db.execute("UPDATE jobs SET status = 'queued', updated = ? WHERE status = 'running'", (time.time(),))
+
+    def update_progress(self, job_id: int, progress: dict):
+        with self.lock:
+            self.db.execute('UPDATE jobs SET progress = ?, updated = ? WHERE id = ?', (json.dumps(progress), time.time(), job_id))
+
+    def update_events(self, job_id: int, events: dict):
+        with self.lock:
+            self.db.execute('UPDATE jobs SET events = ? WHERE id = ?', (json.dumps(events), job_id))
+
+    def finish(self, job_id: int, error: str = None):
+        with self.lock:
+            self.db.execute('UPDATE jobs SET status = ?, error = ?, updated = ? WHERE id = ?',
+                ('failed' if error else 'done', error, time.time(), job_id))
+
+    def get(self, job_id: int):
+        with self.lock:
+            row = self.db.execute('SELECT id, kind, server, collection, payload, status, progress, error, created, updated, events FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self.__to_job(row) if row else None
+
+    def list_jobs(self, knowledge_base_server_name: str, collection_name: str, limit: int = 10):
+        with self.lock:
+            rows = self.db.execute('SELECT id, kind, server, collection, payload, status, progress, error, created, updated, events FROM jobs '
+                + 'WHERE server = ? AND collection = ? ORDER BY id DESC LIMIT ?', (knowledge_base_server_name, collection_name, limit)).fetchall()
+        return [self.__to_job(row) for row in rows]
+
+    def __to_job(self, row):
+        job_id, kind, server, collection, payload, status, progress, error, created, updated, events = row
+        return {
+            'id': job_id, 'kind': kind, 'server': server, 'collection': collection, 'payload': json.loads(payload),
+            'status': status, 'progress': json.loads(progress), 'error': error, 'created': created, 'updated': updated,
+            'events': json.loads(events),
+        }
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+
+import os
+import re
+import json
+import sqlite3
+import hashlib
+import threading
+from typing import Any
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from manifest import RAG_DATA_PATH
+
+
+KEYWORD_INDEX_PATH = os.path.join(RAG_DATA_PATH, 'keyword_index')
+RRF_K = int(os.environ.get('RRF_K', '60'))
+
+# identifiers like part numbers (P-0007, ab_cd) are one token, dotted ones (4.2.1) a phrase
+TOKEN_PATTERN = re.compile(r'[\w][\w\-_.]*[\w]|[\w]')
+
+# bm25 and vector search of a question run at the same time, shared by all sessions
+search_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='hybrid-search')
+
+
+def fts_query(query: str):
+    # every token quoted (no fts syntax from the user), or-ed for recall, bm25 does the ranking
+    tokens = {t.lower() for t in TOKEN_PATTERN.findall(query)}
+    return ' OR '.join('"' + t.replace('"', '""') + '"' for t in sorted(tokens))
+
+def doc_key(doc: Document):
+    return (doc.page_content, doc.metadata.get('source'), doc.metadata.get('page', doc.metadata.get('row')))
+
+
+class KeywordIndex:
+    # local inverted index per collection (sqlite fts5 with bm25 ranking), written alongside the vector store
+
+    def __init__(self, knowledge_base_server_name: str, collection_name: str, path: str = KEYWORD_INDEX_PATH):
+        os.makedirs(path, exist_ok=True)
+        name = hashlib.sha256(f'{knowledge_base_server_name}\0{collection_name}'.encode('utf-8')).hexdigest()[:32]
+        self.file_path = os.path.join(path, f'{name}.sqlite')
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.file_path, timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5(
+            content, metadata UNINDEXED, tokenize="porter unicode61 remove_diacritics 2 tokenchars '-_'")''')
+        # chunk id -> fts rowid, deletes by rowid instead of scanning the fts table
+        self.db.execute('CREATE TABLE IF NOT EXISTS chunk_rows (chunk_id TEXT PRIMARY KEY, row INTEGER NOT NULL)')
+
+    def add(self, ids, chunks):
+        with self.lock, self.db:
+            self.__delete(ids)
+            for chunk_id, chunk in zip(ids, chunks):
+                row = self.db.execute('INSERT INTO chunks (content, metadata) VALUES (?, ?)', (chunk.page_content, json.dumps(chunk.metadata, default=str))).lastrowid
+                self.db.execute('INSERT INTO chunk_rows (chunk_id, row) VALUES (?, ?)', (chunk_id, row))
+
+    def delete(self, ids):
+        with self.lock, self.db:
+            self.__delete(ids)
+
+    def __delete(self, ids):
+        for chunk_id in ids:
+            row = self.db.execute('SELECT row FROM chunk_rows WHERE chunk_id = ?', (chunk_id,)).fetchone()
+            if row:
+                self.db.execute('DELETE FROM chunks WHERE rowid = ?', row)
+                self.db.execute('DELETE FROM chunk_rows WHERE chunk_id = ?', (chunk_id,))
+
+    def search(self, query: str, k: int):
+        match = fts_query(query)
+        if not match:
+            return []
+        with self.lock:
+            rows = self.db.execute('SELECT content, metadata FROM chunks WHERE chunks MATCH ? ORDER BY bm25(chunks) LIMIT ?', (match, k)).fetchall()
+        return [Document(page_content=content, metadata=json.loads(metadata)) for content, metadata in rows]
+
+    def count(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM chunks').fetchone()[0]
+
+    def drop(self):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM chunks')
+            self.db.execute('DELETE FROM chunk_rows')
+
+
+class HybridRetriever(BaseRetriever):
+    # bm25 and vector search concurrently, combined by reciprocal rank fusion
+
+    vector_retriever: BaseRetriever
+    keyword_index: Any
+    k: int = 6
+    rrf_k: int = RRF_K
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None):
+        vector_future = search_executor.submit(self.vector_retriever.invoke, query)
+        keyword_future = search_executor.submit(self.keyword_index.search, query, self.k * 2)
+        scores = {}
+        docs = {}
+        for results in (vector_future.result(), keyword_future.result()):
+            for rank, doc in enumerate(results):
+                key = doc_key(doc)
+                docs.setdefault(key, doc)
+                scores[key] = scores.get(key, 0.0) + 1.0 / (self.rrf_k + rank + 1)
+        ranked = sorted(scores, key=scores.get, reverse=True)[:self.k]
+        return [docs[key] for key in ranked]
@@ -1,20 +1,37 @@
 #!/usr/bin/python3
 
 import os
-import tempfile
+import uuid
+import itertools
+from collections import deque
 import streamlit as st
 from streamlit_chat import message
-from rag import RagBuilder, RagAssistant
-from pprint import pformat
+# imported first, profiles the imports of all app modules below
+from startup import mark, get_startup_report, get_rss_bytes
+from rag import RagBuilder
+from embeddings import embedding_registry
+from jobs import JobQueue, UPLOADS_PATH
+from debug_log import DebugLog
+from reranker import reference
+from telemetry import start_metrics_server
+
+mark('imports')
 
 APP_NAME='AI Playground - RAG Chat'
+JOB_POLL_SECONDS = float(os.environ.get('JOB_POLL_SECONDS', '2'))
+# chat history per session, rendered one page at a time
+CHAT_HISTORY_SIZE = int(os.environ.get('CHAT_HISTORY_SIZE', '200'))
+CHAT_PAGE_SIZE = int(os.environ.get('CHAT_PAGE_SIZE', '20'))
 
 # ui handlers
 def __on_nop():
     pass
 
-def __on_debug(msg, obj):
-    st.session_state['debug'].append((msg, obj))
+def __on_older_messages():
+    st.session_state['messages_page'] += 1
+
+def __on_newer_messages():
+    st.session_state['messages_page'] -= 1
 
 def __on_change_llm_server():
     st.session_state['selected_llm'] = None
@@ -40,7 +57,7 @@ def __on_create_kb():
     if not kb_name:
         st.session_state['messages'].append(('Please, define a knowledge base name first.', False))
         return
-    rb.create_knowledge_base(st.session_state['selected_kb_server'], kb_name)
+    rb.create_knowledge_base(st.session_state['selected_kb_server'], kb_name, st.session_state.get('new_kb_vector_encoding'))
     st.session_state['selected_kb'] = kb_name
     __on_change_llm_or_kb()
 
@@ -54,13 +71,16 @@ def __on_add_file_to_kb():
     if not kb_name:
         st.session_state['messages'].append(('Please, select a knowledge base first.', False))
         return
+    # the upload is stored on the shared data volume and ingested by worker.py
+    os.makedirs(UPLOADS_PATH, exist_ok=True)
+    files = []
     for file in st.session_state['file_uploader']:
-        with tempfile.NamedTemporaryFile(delete=False) as tf:
-            tf.write(file.getbuffer())
-            file_path = tf.name
-        with st.session_state['ingestion_spinner'], st.spinner(f'Adding file {file.name}'):
-            st.session_state['assistant'].add_file(kb_name, file_path, file.name)
-        os.remove(file_path)
+        file_path = os.path.join(UPLOADS_PATH, uuid.uuid4().hex)
+        with open(file_path, 'wb') as f:
+            f.write(file.getbuffer())
+        files.append((file_path, file.name))
+    if files:
+        job_queue.enqueue('files', st.session_state['selected_kb_server'], kb_name, {'files': files})
 
 def __on_add_confluence_space_to_kb():
     kb_name = st.session_state['selected_kb']
@@ -71,8 +91,7 @@ def __on_add_confluence_space_to_kb():
     if not confluence_space:
         st.session_state['messages'].append(('Please, define a Confluence space first.', False))
         return
-    with st.session_state['ingestion_spinner'], st.spinner(f'Adding space {confluence_space}'):
-        st.session_state['assistant'].add_confluence_page(kb_name, confluence_space)
+    job_queue.enqueue('confluence', st.session_state['selected_kb_server'], kb_name, {'space_key': confluence_space})
 
 def __on_ask_question():
     if not st.session_state['assistant']:
@@ -80,17 +99,68 @@ def __on_ask_question():
         return
     user_text = st.session_state['user_input']
     if user_text:
-        with st.session_state['thinking_spinner'], st.spinner(f'Thinking'):
-            agent_text = st.session_state['assistant'].ask(user_text)
-            agent_desc = f'{st.session_state["selected_llm_server"]}/{st.session_state["selected_llm"]} on {st.session_state["selected_kb_server"]}/{st.session_state["selected_kb"]}'
-            agent_text = f'_{agent_desc}:_\n\n{agent_text}'
+        agent_desc = f'{st.session_state["selected_llm_server"]}/{st.session_state["selected_llm"]} on {st.session_state["selected_kb_server"]}/{st.session_state["selected_kb"]}'
+        answer = ''
+        stats = {}
+        with st.session_state['thinking_spinner'].container():
+            sources_area = st.empty()
+            answer_area = st.empty()
+            with st.spinner(f'Thinking'):
+                # render tokens as they arrive instead of waiting for the whole completion
+                for kind, value in st.session_state['assistant'].ask_stream(user_text, st.session_state['session_id']):
+                    if kind == 'sources':
+                        sources = sorted({reference(doc) for doc in value})
+                        sources_area.caption('Sources: ' + (', '.join(sources) or 'none found'))
+                    elif kind == 'token':
+                        answer += value
+                        answer_area.markdown(answer + '▌')
+                    elif kind == 'stats':
+                        stats = value
+        timing = f'first token after {stats.get("time-to-first-token-seconds")}s, total {stats.get("total-seconds")}s'
+        if stats.get('answer-cache') in ('exact', 'semantic'):
+            timing = f'{stats["answer-cache"]} cached answer, {timing}'
+        if stats.get('reranker-unavailable'):
+            timing = f'{timing}, reranker unavailable'
+        agent_text = f'_{agent_desc} ({timing}):_\n\n{answer}'
         st.session_state['messages'].append((user_text, True))
         st.session_state['messages'].append((agent_text, False))
+        st.session_state['messages_page'] = 0
+
+# process-wide resources, created on the first run and shared by all sessions and reruns
+@st.cache_resource
+def get_rag_builder():
+    embedding_registry.warm_up_in_background()
+    start_metrics_server()
+    # ingestion runs in the worker, its debug events come with the jobs
+    rb = RagBuilder(lambda msg, obj: None)
+    mark('ready')
+    return rb
+
+@st.cache_resource
+def get_job_queue():
+    return JobQueue()
 
 # ui renderers
-def render_chat():
-    for i, (msg, is_user) in enumerate(st.session_state['messages']):
+def render_messages():
+    # only the selected page is rendered, the newest page is 0
+    messages = st.session_state['messages']
+    pages = max(1, -(-len(messages) // CHAT_PAGE_SIZE))
+    page = min(st.session_state['messages_page'], pages - 1)
+    end = len(messages) - page * CHAT_PAGE_SIZE
+    start = max(0, end - CHAT_PAGE_SIZE)
+    if pages > 1:
+        c1, c2, c3 = st.columns([2,6,2])
+        with c1:
+            st.button('Older', on_click=__on_older_messages, disabled=page == pages - 1, use_container_width=True)
+        with c2:
+            st.caption(f'messages {start + 1}-{end} of {len(messages)}')
+        with c3:
+            st.button('Newer', on_click=__on_newer_messages, disabled=page == 0, use_container_width=True)
+    for i, (msg, is_user) in enumerate(itertools.islice(messages, start, end), start):
         message(msg, is_user=is_user, key=str(i))
+
+def render_chat():
+    render_messages()
     st.session_state['thinking_spinner'] = st.empty()
     if st.session_state['assistant']:
         agent_desc = f'{st.session_state["selected_llm_server"]}/{st.session_state["selected_llm"]} on {st.session_state["selected_kb_server"]}/{st.session_state["selected_kb"]}'
@@ -102,6 +172,28 @@ def render_chat():
             st.button('Ask', on_click=__on_ask_question, disabled=not st.session_state['user_input'], use_container_width=True)
 
 
+# reruns on its own every JOB_POLL_SECONDS, only the jobs panel is refreshed and the chat stays usable
+@st.experimental_fragment(run_every=JOB_POLL_SECONDS)
+def render_jobs():
+    jobs = job_queue.list_jobs(st.session_state['selected_kb_server'], st.session_state['selected_kb'], limit=5) if st.session_state['selected_kb'] else []
+    for job in jobs:
+        if job['kind'] == 'files':
+            what = ', '.join(name for _, name in job['payload']['files'])
+        else:
+            what = f'confluence space {job["payload"]["space_key"]}'
+        progress = job['progress']
+        st.caption(f'  ingestion {job["status"]}: {what}  \n'
+            + f'  docs {progress.get("docs", 0)}, embedded {progress.get("chunks-embedded", 0)}, written {progress.get("chunks-written", 0)}, '
+            + f'{progress.get("chunks-per-second", 0)} chunks/s')
+        if job['error']:
+            st.caption(f'  {job["error"]}')
+    active = any(job['status'] in ('queued', 'running') for job in jobs)
+    if st.session_state['ingestion_active'] and not active:
+        # finished jobs changed the knowledge base details, refresh the whole page once
+        st.session_state['ingestion_active'] = False
+        st.rerun()
+    st.session_state['ingestion_active'] = active
+
 def render_sidebar():
     st.subheader('Language model')
     st.selectbox('selected_llm_server', rb.list_model_servers(), key='selected_llm_server', on_change=__on_change_llm_server, index=None, 
@@ -117,6 +209,15 @@ def render_sidebar():
     if st.session_state['selected_kb']:
         for key, value in rb.get_knowledge_base_details(st.session_state['selected_kb_server'], st.session_state['selected_kb']).items():
             st.caption(f'  {key}: {value}')
+        for key, value in rb.get_embedding_cache_stats().items():
+            st.caption(f'  {key}: {value}')
+        for key, value in rb.get_answer_cache_stats().items():
+            st.caption(f'  {key}: {value}')
+        for key, value in rb.get_catalog_cache_stats().items():
+            st.caption(f'  {key}: {value}')
+        st.caption(f'  reranker: {rb.get_reranker_status()}')
+    # rendered on every run, the timer of a fragment missing from the last full run would fail
+    render_jobs()
 
     if st.session_state['assistant']:
         st.write(f'<font size="3">Add file to knowledge base {st.session_state["selected_kb"]}</font>', unsafe_allow_html=True)
@@ -137,28 +238,70 @@ def render_sidebar():
             st.text_input('new_kb_name', key='new_kb_name', on_change=__on_nop, label_visibility='collapsed')
         with c2:
             st.button('Create', on_click=__on_create_kb, disabled=not st.session_state["new_kb_name"], use_container_width=True)            
+        vector_encodings = rb.list_vector_encodings(st.session_state['selected_kb_server'])
+        if vector_encodings:
+            st.selectbox('new_kb_vector_encoding', vector_encodings, key='new_kb_vector_encoding', label_visibility='collapsed')
 
     if st.session_state['selected_kb']:
         st.write(f'<font size="3">Delete knowledge base from {st.session_state["selected_kb_server"]}</font>', unsafe_allow_html=True)
         st.button(f'delete {st.session_state["selected_kb"]}', on_click=__on_delete_kb, type="primary", use_container_width=True)
     
+    st.subheader('Embedding models')
+    for model_name, stats in embedding_registry.get_stats().items():
+        st.caption(f'  {model_name}: ' + ', '.join(f'{k} {v}' for k, v in stats.items()))
+    st.caption(f'  process-rss-mb: {round(get_rss_bytes() / 2**20, 1)}')
+
+    st.subheader('Startup')
+    report = get_startup_report()
+    for name, m in report['marks'].items():
+        st.caption(f'  {name}: {m["seconds"]}s after process start, rss {m["rss-mb"]} MB')
+    with st.expander(f'imports {report["import-seconds"]}s'):
+        for i in report['imports']:
+            st.caption(f'  {i["package"]}: {i["seconds"]}s, {i["rss-mb"]} MB, {i["modules"]} modules' + (' (lazy)' if i['lazy'] else ''))
+    for stats in rb.get_backend_client_stats():
+        st.caption(f'  {stats["backend"]} client: ' + ', '.join(f'{k} {v}' for k, v in stats.items() if k != 'backend' and v is not None))
+
+    st.subheader('Model scheduler')
+    scheduler_stats = rb.get_scheduler_stats()
+    st.caption('  ' + ', '.join(f'{k} {v}' for k, v in scheduler_stats.items() if isinstance(v, int)))
+    for name, backend in scheduler_stats['backends'].items():
+        st.caption(f'  {name}: ' + ', '.join(f'{k} {v}' for k, v in backend.items()))
+    for model, depth in scheduler_stats['queue-depth'].items():
+        waits = scheduler_stats['wait-seconds'].get(model, {})
+        st.caption(f'  {model}: queue {depth}' + ''.join(f', wait {k} <={v}s' for k, v in waits.items()))
+
+    st.subheader('Stage latency')
+    for stage, quantiles in sorted(rb.get_stage_latency_stats().items()):
+        st.caption(f'  {stage}: ' + ', '.join(f'{k} <={v}s' for k, v in quantiles.items()))
+
+    render_debug()
+
+def render_debug():
     st.subheader('Debug output')
-    for msg, obj in st.session_state['debug']:
-        obj_str = pformat(obj).replace('\n', '  \n')
-        st.write(f'{msg}:  \n{obj_str}')
+    if not st.session_state['selected_kb']:
+        return
+    # debug events of the recent ingestion jobs, emitted by the worker and kept with the job
+    for job in job_queue.list_jobs(st.session_state['selected_kb_server'], st.session_state['selected_kb'], limit=5):
+        debug_log = DebugLog(job['events'])
+        if debug_log.dropped:
+            st.caption(f'  job {job["id"]}: {debug_log.dropped} older debug events dropped')
+        for entry in debug_log:
+            with st.expander(f'{entry["time"]} job {job["id"]} {entry["msg"]}'):
+                summary = {**entry['summary'], 'since-previous-seconds': entry['since-previous-seconds']}
+                st.caption('  ' + ', '.join(f'{k} {v}' for k, v in summary.items()))
 
 def render_page():
     # init first loop
     if len(st.session_state) == 0:
-        st.session_state['messages'] = []
-        st.session_state['debug'] = []
+        st.session_state['messages'] = deque(maxlen=CHAT_HISTORY_SIZE)
+        st.session_state['messages_page'] = 0
+        st.session_state['session_id'] = uuid.uuid4().hex
         st.session_state['selected_kb_server'] = None
         st.session_state['selected_kb'] = None
         st.session_state['selected_llm_server'] = None
         st.session_state['selected_llm'] = None
         st.session_state['assistant'] = None
-    # init loop
-    st.session_state['ingestion_spinner'] = st.empty()
+        st.session_state['ingestion_active'] = False
     # render
     st.header(APP_NAME)
     render_chat()
@@ -167,5 +310,6 @@ def render_page():
 
 if __name__ == '__main__':
     st.set_page_config(page_title=APP_NAME)
-    rb = RagBuilder(__on_debug)
+    rb = get_rag_builder()
+    job_queue = get_job_queue()
     render_page()
@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+
+
+RAG_DATA_PATH = os.environ.get('RAG_DATA_PATH', '/rag_data')
+MANIFEST_PATH = os.path.join(RAG_DATA_PATH, 'manifest.sqlite')
+
+
+def file_hash(file_path: str):
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def chunk_hash(chunk):
+    metadata = json.dumps(chunk.metadata, sort_keys=True, default=str)
+    return hashlib.sha256(f'{chunk.page_content}\0{metadata}'.encode('utf-8')).hexdigest()
+
+def docs_hash(docs):
+    return hashlib.sha256(''.join(chunk_hash(doc) for doc in docs).encode('utf-8')).hexdigest()
+
+def chunk_ids(source_id: str, chunks, seen=None):
+    # deterministic ids: same source and same chunk content always map to the same id,
+    # identical chunks inside one source are told apart by their occurrence number,
+    # pass the same seen dict for all batches of one source
+    ids = []
+    seen = {} if seen is None else seen
+    for chunk in chunks:
+        h = chunk_hash(chunk)
+        n = seen.get(h, 0)
+        seen[h] = n + 1
+        ids.append(hashlib.sha256(f'{source_id}\0{h}\0{n}'.encode('utf-8')).hexdigest())
+    return ids
+
+
+class DocumentManifest:
+    # per collection record of ingested sources (file hash, confluence page version) and their chunk ids
+
+    def __init__(self, knowledge_base_server_name: str, collection_name: str, path: str = MANIFEST_PATH):
+        self.key = (knowledge_base_server_name, collection_name)
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS sources (
+                server TEXT NOT NULL, collection TEXT NOT NULL, source_id TEXT NOT NULL, source_hash TEXT NOT NULL,
+                PRIMARY KEY (server, collection, source_id));
+            CREATE TABLE IF NOT EXISTS chunks (
+                server TEXT NOT NULL, collection TEXT NOT NULL, chunk_id TEXT NOT NULL, source_id TEXT NOT NULL,
+                PRIMARY KEY (server, collection, chunk_id));
+            CREATE INDEX IF NOT EXISTS chunks_source ON chunks (server, collection, source_id);
+            CREATE TABLE IF NOT EXISTS collections (
+                server TEXT NOT NULL, collection TEXT NOT NULL, version INTEGER NOT NULL,
+                PRIMARY KEY (server, collection));
+            CREATE TABLE IF NOT EXISTS watermarks (
+                server TEXT NOT NULL, collection TEXT NOT NULL, name TEXT NOT NULL, value TEXT NOT NULL,
+                PRIMARY KEY (server, collection, name));
+        ''')
+
+    def get_source_hash(self, source_id: str):
+        with self.lock:
+            row = self.db.execute('SELECT source_hash FROM sources WHERE server = ? AND collection = ? AND source_id = ?', (*self.key, source_id)).fetchone()
+        return row[0] if row else None
+
+    def list_sources(self, prefix: str = ''):
+        with self.lock:
+            rows = self.db.execute('SELECT source_id FROM sources WHERE server = ? AND collection = ? AND substr(source_id, 1, ?) = ?',
+                (*self.key, len(prefix), prefix)).fetchall()
+        return [r[0] for r in rows]
+
+    def get_chunk_ids(self, source_id: str):
+        with self.lock:
+            rows = self.db.execute('SELECT chunk_id FROM chunks WHERE server = ? AND collection = ? AND source_id = ?', (*self.key, source_id)).fetchall()
+        return {r[0] for r in rows}
+
+    def add_chunks(self, source_id: str, ids):
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO chunks (server, collection, chunk_id, source_id) VALUES (?, ?, ?, ?)',
+                [(*self.key, chunk_id, source_id) for chunk_id in ids])
+            self.__bump_version()
+
+    def remove_chunks(self, ids):
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM chunks WHERE server = ? AND collection = ? AND chunk_id = ?', [(*self.key, chunk_id) for chunk_id in ids])
+            self.__bump_version()
+
+    def set_source(self, source_id: str, source_hash: str):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO sources (server, collection, source_id, source_hash) VALUES (?, ?, ?, ?)', (*self.key, source_id, source_hash))
+
+    def remove_source(self, source_id: str):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM sources WHERE server = ? AND collection = ? AND source_id = ?', (*self.key, source_id))
+            self.db.execute('DELETE FROM chunks WHERE server = ? AND collection = ? AND source_id = ?', (*self.key, source_id))
+            self.__bump_version()
+
+    def get_watermark(self, name: str):
+        # last synced modification time of an incrementally synced source (confluence space)
+        with self.lock:
+            row = self.db.execute('SELECT value FROM watermarks WHERE server = ? AND collection = ? AND name = ?', (*self.key, name)).fetchone()
+        return row[0] if row else None
+
+    def set_watermark(self, name: str, value: str):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO watermarks (server, collection, name, value) VALUES (?, ?, ?, ?)', (*self.key, name, value))
+
+    def get_version(self):
+        # content version of the collection, changes with every chunk write or delete
+        with self.lock:
+            row = self.db.execute('SELECT version FROM collections WHERE server = ? AND collection = ?', self.key).fetchone()
+        return row[0] if row else 0
+
+    def __bump_version(self):
+        self.db.execute('INSERT INTO collections (server, collection, version) VALUES (?, ?, 1) '
+            + 'ON CONFLICT (server, collection) DO UPDATE SET version = version + 1', self.key)
+
+    def drop(self):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM sources WHERE server = ? AND collection = ?', self.key)
+            self.db.execute('DELETE FROM chunks WHERE server = ? AND collection = ?', self.key)
+            self.db.execute('DELETE FROM watermarks WHERE server = ? AND collection = ?', self.key)
+            self.__bump_version()
@@ -1,35 +1,30 @@
 #!/usr/bin/python3
 
 import os
-
-import chromadb
-
-from langchain_community.vectorstores import Chroma
-from langchain_community.chat_models import ChatOllama
-from langchain_community.embeddings import FastEmbedEmbeddings
-from langchain_community.document_loaders import PyPDFLoader, UnstructuredExcelLoader, CSVLoader
-
-import csv
-from langchain_core.documents import Document
+import time
+import asyncio
+import threading
+import contextlib
 
 from langchain.schema.output_parser import StrOutputParser
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.schema.runnable import RunnablePassthrough
 from langchain.prompts import PromptTemplate
-from langchain.vectorstores.utils import filter_complex_metadata
-from langchain import hub
-
-#from langchain_community.chat_models import ChatOpenAI
-from langchain_openai import ChatOpenAI
 
-from langchain_community.document_loaders import ConfluenceLoader
+# chroma, azure search, openai and the confluence sync are imported on first use of their
+# knowledge base server, model server or source, see the create_* functions below
 
-from langchain_openai import AzureChatOpenAI
-
-from langchain_community.vectorstores.azuresearch import AzureSearch
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents.indexes import SearchIndexClient
-from azure.search.documents.indexes.models import SearchIndex
+from embeddings import embedding_registry, EMBEDDING_MODEL_NAME
+from embedding_cache import CachedEmbeddings, get_embedding_cache
+from manifest import DocumentManifest, file_hash
+from ingestion import IngestionPipeline
+from answer_cache import answer_cache
+from keyword_index import KeywordIndex, HybridRetriever
+from vector_index import LocalVectorIndex, LocalVectorStore, list_vector_indexes, VECTOR_ENCODINGS
+from catalog_cache import catalog_cache
+from scheduler import PooledChatOllama, ollama_scheduler
+from clients import LazyClient, call_blocking, async_limit, run_async, iterate_async, HTTP_TIMEOUT_SECONDS, HTTP_CONNECT_TIMEOUT_SECONDS, HTTP_MAX_RETRIES
+from reranker import ContextBuilder, CONTEXT_TOKEN_BUDGETS, DEFAULT_CONTEXT_TOKEN_BUDGET, RERANK_FETCH_K, estimate_tokens, get_reranker_status
+from telemetry import span, record_stage, metrics
 
 
 OLLAMA_BASE_URL = os.environ.get('OLLAMA_BASE_URL')
@@ -67,8 +62,8 @@ PROMPT_TEMPLATES = {
         System:
         You are an retrieval augmented generation assistant. 
         The provided context contains documents related to the question.
-        Use the document property page_content only to answer the question. 
-        All documents containing relevant pieces of the answer must be referenced with the metadata properties source and page, use format [source, page].
+        Each context document starts with its reference in format [source, page], use the text below it only to answer the question. 
+        All documents containing relevant pieces of the answer must be referenced with their reference, use format [source, page].
         If you don't know the answer, just say that you don't know. 
 
         Context documents:
@@ -86,8 +81,8 @@ PROMPT_TEMPLATES = {
         System:
         You are an retrieval augmented generation assistant. 
         The provided context contains documents related to the question.
-        Use the document property page_content only to answer the question. 
-        All documents containing pieces of the answer must be referenced with the metadata properties source and page, use format [source, page].
+        Each context document starts with its reference in format [source, page], use the text below it only to answer the question. 
+        All documents containing pieces of the answer must be referenced with their reference, use format [source, page].
         If you don't know the answer, just say that you don't know. 
 
         Context documents:
@@ -103,8 +98,8 @@ PROMPT_TEMPLATES = {
         System:
         You are an retrieval augmented generation assistant. 
         The provided context contains documents related to the question.
-        Use the document property page_content only to answer the question. 
-        All documents containing pieces of the answer must be referenced with the metadata properties source and page, use format [source, page].
+        Each context document starts with its reference in format [source, page], use the text below it only to answer the question. 
+        All documents containing pieces of the answer must be referenced with their reference, use format [source, page].
         If you don't know the answer, just say that you don't know. 
 
         Context documents:
@@ -121,8 +116,6 @@ PROMPT_TEMPLATES = {
 CHROMA_HOST = os.environ.get('CHROMA_HOST')
 CHROMA_PORT = os.environ.get('CHROMA_PORT')
 
-FASTEMBED_CACHE_PATH = os.environ.get('CHROMA_PORT')
-
 LANGCHAIN_TRACING_V2 = os.environ['LANGCHAIN_TRACING_V2']
 LANGCHAIN_PROJECT = os.environ['LANGCHAIN_PROJECT']
 LANGCHAIN_ENDPOINT = os.environ['LANGCHAIN_ENDPOINT']
@@ -140,56 +133,180 @@ ATLASSIAN_API_KEY = os.environ["ATLASSIAN_API_KEY"]
 AZURE_SEARCH_ENDPOINT = os.environ["AZURE_SEARCH_ENDPOINT"]
 AZURE_SEARCH_KEY = os.environ["AZURE_SEARCH_KEY"]
 
+# 'similarity', 'similarity_score_threshold' or 'mmr' (fetch RETRIEVAL_FETCH_K documents and select k by maximal marginal relevance)
+RETRIEVAL_SEARCH_TYPE = os.environ.get('RETRIEVAL_SEARCH_TYPE', 'similarity_score_threshold')
+RETRIEVAL_K = int(os.environ.get('RETRIEVAL_K', '6'))
+RETRIEVAL_SCORE_THRESHOLD = float(os.environ.get('RETRIEVAL_SCORE_THRESHOLD', '0.3'))
+RETRIEVAL_FETCH_K = int(os.environ.get('RETRIEVAL_FETCH_K', '50'))
+# bm25 over the local keyword index fused with the vector search
+RETRIEVAL_HYBRID = os.environ.get('RETRIEVAL_HYBRID', 'true') == 'true'
+ASK_MANY_PARALLEL = int(os.environ.get('ASK_MANY_PARALLEL', '4'))
+
+
+def get_search_kwargs(search_type: str, k: int = RETRIEVAL_K, score_threshold: float = RETRIEVAL_SCORE_THRESHOLD, fetch_k: int = RETRIEVAL_FETCH_K):
+    if search_type == 'similarity_score_threshold':
+        return {'k': k, 'score_threshold': score_threshold}
+    if search_type == 'mmr':
+        return {'k': k, 'fetch_k': fetch_k}
+    return {'k': k}
+
+
+# concurrency limit of the clients layer a knowledge base server or model server goes through
+RETRIEVAL_BACKENDS = {'local-chroma-db': 'chroma', 'azure-ai-search': 'azure-search', 'local-vector-index': 'local'}
+MODEL_BACKENDS = {'local_ollama': 'ollama', 'openai': 'openai', 'azure-openai': 'openai'}
+
+
+def create_chroma_client():
+    import chromadb
+    return chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+
+def create_azure_search_index_client():
+    # the azure sdk pools through its transport
+    from azure.core.credentials import AzureKeyCredential
+    from azure.search.documents.indexes import SearchIndexClient
+    return SearchIndexClient(AZURE_SEARCH_ENDPOINT, AzureKeyCredential(AZURE_SEARCH_KEY),
+        connection_timeout=HTTP_CONNECT_TIMEOUT_SECONDS, read_timeout=HTTP_TIMEOUT_SECONDS, retry_total=HTTP_MAX_RETRIES)
+
+def create_azure_search(index_name: str, embeddings):
+    from langchain_community.vectorstores.azuresearch import AzureSearch
+    return AzureSearch(azure_search_endpoint=AZURE_SEARCH_ENDPOINT, azure_search_key=AZURE_SEARCH_KEY, index_name=index_name, embedding_function=embeddings)
+
+def create_chat_openai(model_name: str, temperature: float):
+    # the openai sdk pools connections and retries with jittered backoff itself
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(model_name=model_name, temperature=temperature, openai_api_key=OPENAI_API_KEY, openai_organization=OPENAI_ORG_ID,
+        request_timeout=HTTP_TIMEOUT_SECONDS, max_retries=HTTP_MAX_RETRIES)
+
+
+# assistants are stateless between questions, all sessions share them per configuration
+assistants = {}
+assistants_lock = threading.Lock()
+
 
 class RagBuilder:
     def __init__(self, debug_print_func):
         self.debug = debug_print_func
-        self.chroma_client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
-        self.azure_search_index_client = SearchIndexClient(AZURE_SEARCH_ENDPOINT, AzureKeyCredential(AZURE_SEARCH_KEY))
+        # created on first use of their knowledge base server, chromadb's client keeps one requests session
+        self.chroma_client = LazyClient('chroma', create_chroma_client, lambda client: client.heartbeat())
+        self.azure_search_index_client = LazyClient('azure-search', create_azure_search_index_client,
+            lambda client: client.get_service_statistics())
+        self.manifests = {}
+        self.manifests_lock = threading.Lock()
+        # one instance per collection, it keeps the memory maps, the ivf centroids and the interned source names
+        self.vector_indexes = {}
+        self.vector_indexes_lock = threading.Lock()
     
     def __get_embedding(self):
-        # see model list: https://qdrant.github.io/fastembed/examples/Supported_Models/
-        #return FastEmbedEmbeddings(model_name='BAAI/bge-small-en-v1.5') # max 384 tokens
-        return FastEmbedEmbeddings(model_name='sentence-transformers/paraphrase-multilingual-mpnet-base-v2') # max 768 tokens
-        #return FastEmbedEmbeddings(model_name='intfloat/multilingual-e5-large') # max 1024 tokens
+        # shared across sessions, the onnx model is loaded only once per process
+        # and already embedded chunks and queries are served from the on-disk cache
+        return CachedEmbeddings(embedding_registry.get(EMBEDDING_MODEL_NAME), get_embedding_cache(EMBEDDING_MODEL_NAME))
+
+    def get_embedding_cache_stats(self):
+        return get_embedding_cache(EMBEDDING_MODEL_NAME).get_stats()
 
     def list_knowledge_base_servers(self):
-        return ['local-chroma-db', 'azure-ai-search']
+        return ['local-chroma-db', 'azure-ai-search', 'local-vector-index']
+
+    def __get_manifest(self, knowledge_base_server_name: str, knowledge_base_name: str):
+        with self.manifests_lock:
+            key = (knowledge_base_server_name, knowledge_base_name)
+            if key not in self.manifests:
+                self.manifests[key] = DocumentManifest(knowledge_base_server_name, knowledge_base_name)
+            return self.manifests[key]
+
+    def __get_vector_index(self, knowledge_base_name: str, vector_encoding: str = None):
+        with self.vector_indexes_lock:
+            vector_index = self.vector_indexes.get(knowledge_base_name)
+            # the collection may have been deleted and created again by another process (app and worker)
+            if vector_index is None or not vector_index.is_current():
+                vector_index = self.vector_indexes[knowledge_base_name] = LocalVectorIndex(knowledge_base_name, encoding=vector_encoding)
+            return vector_index
+
+    def get_catalog_cache_stats(self):
+        return catalog_cache.get_stats()
+
+    def get_backend_client_stats(self):
+        return [client.get_stats() for client in (self.chroma_client, self.azure_search_index_client)]
+
+    def get_scheduler_stats(self):
+        return ollama_scheduler.get_stats()
+
+    def get_reranker_status(self):
+        return get_reranker_status()
+
+    def get_stage_latency_stats(self):
+        # latency quantiles per pipeline stage of this process, in seconds (histogram bucket bounds)
+        return metrics.get_quantiles('stage_seconds')
 
     def list_knowledge_bases(self, knowledge_base_server_name: str):
+        # served from the catalog cache, the sidebar asks on every rerun
+        return catalog_cache.get(('list', knowledge_base_server_name), lambda: self.__list_knowledge_bases(knowledge_base_server_name))
+
+    def __list_knowledge_bases(self, knowledge_base_server_name: str):
         if knowledge_base_server_name == 'local-chroma-db':
-            collections = self.chroma_client.list_collections()
-            return map(lambda c: c.name, collections)
+            collections = self.chroma_client.get().list_collections()
+            return [c.name for c in collections]
         if knowledge_base_server_name == 'azure-ai-search':
-            indexes = self.azure_search_index_client.list_index_names()
-            return indexes
+            indexes = self.azure_search_index_client.get().list_index_names()
+            return list(indexes)
+        if knowledge_base_server_name == 'local-vector-index':
+            return list_vector_indexes()
         return []
 
     def get_knowledge_base_details(self, knowledge_base_server_name: str, knowledge_base_name: str):
+        # reloaded after the ttl or as soon as an ingestion changed the collection's content version
+        version = self.__get_manifest(knowledge_base_server_name, knowledge_base_name).get_version()
+        return catalog_cache.get(('details', knowledge_base_server_name, knowledge_base_name),
+            lambda: self.__get_knowledge_base_details(knowledge_base_server_name, knowledge_base_name), version)
+
+    def __get_knowledge_base_details(self, knowledge_base_server_name: str, knowledge_base_name: str):
         if knowledge_base_server_name == 'local-chroma-db':
-            collection = self.chroma_client.get_collection(knowledge_base_name)
+            collection = self.chroma_client.get().get_collection(knowledge_base_name)
             #details = vars(collection)
             details = {}
             details['chunk-count'] = collection.count()
             return details
         if knowledge_base_server_name == 'azure-ai-search':
-            index = self.azure_search_index_client.get_index_statistics(index_name=knowledge_base_name)
+            index = self.azure_search_index_client.get().get_index_statistics(index_name=knowledge_base_name)
             #self.debug('azure search index statistics: ', index)
             return index
+        if knowledge_base_server_name == 'local-vector-index':
+            return self.__get_vector_index(knowledge_base_name).get_stats()
         return {}
 
-    def create_knowledge_base(self, knowledge_base_server_name: str, knowledge_base_name: str):
+    def list_vector_encodings(self, knowledge_base_server_name: str):
+        if knowledge_base_server_name == 'local-vector-index':
+            return VECTOR_ENCODINGS
+        return []
+
+    def create_knowledge_base(self, knowledge_base_server_name: str, knowledge_base_name: str, vector_encoding: str = None):
         if knowledge_base_server_name == 'local-chroma-db':
-            collection = self.chroma_client.get_or_create_collection(knowledge_base_name)
+            collection = self.chroma_client.get().get_or_create_collection(knowledge_base_name)
         elif knowledge_base_server_name == 'azure-ai-search':
             #index = self.azure_search_index_client.create_index(SearchIndex(name=knowledge_base_name, fields=List[SearchField]))
-            AzureSearch(azure_search_endpoint=AZURE_SEARCH_ENDPOINT, azure_search_key=AZURE_SEARCH_KEY, index_name=knowledge_base_name, embedding_function=self.__get_embedding())
+            create_azure_search(knowledge_base_name, self.__get_embedding())
+        elif knowledge_base_server_name == 'local-vector-index':
+            # int8 or pq codes shrink the scanned vectors, fixed for the lifetime of the collection
+            self.__get_vector_index(knowledge_base_name, vector_encoding)
+        catalog_cache.invalidate('list', knowledge_base_server_name)
+        catalog_cache.invalidate('details', knowledge_base_server_name, knowledge_base_name)
 
     def delete_knowledge_base(self, knowledge_base_server_name: str, knowledge_base_name: str):
         if knowledge_base_server_name == 'local-chroma-db':
-            self.chroma_client.delete_collection(knowledge_base_name)
+            self.chroma_client.get().delete_collection(knowledge_base_name)
         elif knowledge_base_server_name == 'azure-ai-search':
-            self.azure_search_index_client.delete_index(knowledge_base_name)
+            self.azure_search_index_client.get().delete_index(knowledge_base_name)
+        elif knowledge_base_server_name == 'local-vector-index':
+            with self.vector_indexes_lock:
+                vector_index = self.vector_indexes.pop(knowledge_base_name, None) or LocalVectorIndex(knowledge_base_name)
+            vector_index.drop()
+        self.__get_manifest(knowledge_base_server_name, knowledge_base_name).drop()
+        KeywordIndex(knowledge_base_server_name, knowledge_base_name).drop()
+        with assistants_lock:
+            for key in [k for k in assistants if k[:2] == (knowledge_base_server_name, knowledge_base_name)]:
+                del assistants[key]
+        catalog_cache.invalidate('list', knowledge_base_server_name)
+        catalog_cache.invalidate('details', knowledge_base_server_name, knowledge_base_name)
 
     def list_model_servers(self):
         return ['local_ollama', 'openai', 'azure-openai']
@@ -203,83 +320,235 @@ class RagBuilder:
             return []
         return []
 
-    def build_rag_assistant(self, knowledge_base_server_name: str, knowledge_base_name: str, model_server_name: str, model_name: str):
-        vector_store = None
+    def build_rag_assistant(self, knowledge_base_server_name: str, knowledge_base_name: str, model_server_name: str, model_name: str,
+                            search_type: str = RETRIEVAL_SEARCH_TYPE, search_kwargs: dict = None):
+        search_kwargs = search_kwargs or get_search_kwargs(search_type)
+        key = (knowledge_base_server_name, knowledge_base_name, model_server_name, model_name, search_type, tuple(sorted(search_kwargs.items())))
+        with assistants_lock:
+            if key not in assistants:
+                assistants[key] = self.__build_rag_assistant(knowledge_base_server_name, knowledge_base_name, model_server_name, model_name, search_type, search_kwargs)
+            return assistants[key]
+
+    def __build_rag_assistant(self, knowledge_base_server_name: str, knowledge_base_name: str, model_server_name: str, model_name: str, search_type: str, search_kwargs: dict):
         model = None
         temp = 0.4
 
-        if knowledge_base_server_name == 'local-chroma-db':
-            vector_store = Chroma(client=self.chroma_client, collection_name=knowledge_base_name, embedding_function=self.__get_embedding())
-        elif knowledge_base_server_name == 'azure-ai-search':
-            vector_store = AzureSearch(azure_search_endpoint=AZURE_SEARCH_ENDPOINT, azure_search_key=AZURE_SEARCH_KEY, index_name=knowledge_base_name, embedding_function=self.__get_embedding())
-
         if model_server_name == 'local_ollama':
-            model = ChatOllama(model=model_name, temperature=temp, base_url=OLLAMA_BASE_URL)
+            model = PooledChatOllama(model=model_name, temperature=temp, base_url=OLLAMA_BASE_URL)
         elif model_server_name == 'openai':
-            model = ChatOpenAI(model_name=model_name, temperature=temp, openai_api_key=OPENAI_API_KEY, openai_organization=OPENAI_ORG_ID)
+            model = create_chat_openai(model_name, temp)
 
         prompt = PromptTemplate.from_template(PROMPT_TEMPLATES[model_name])
 
+        context_builder = ContextBuilder(search_kwargs['k'], CONTEXT_TOKEN_BUDGETS.get(model_name, DEFAULT_CONTEXT_TOKEN_BUDGET))
+
+        # cached answers are only reused for the same collection, model, prompt template and retrieval,
+        # another search, hybrid or rerank setting puts other chunks into the context
+        answer_cache_scope = (knowledge_base_server_name, knowledge_base_name, model_server_name, model_name, PROMPT_TEMPLATES[model_name],
+            search_type, tuple(sorted(search_kwargs.items())), RETRIEVAL_HYBRID, context_builder.rerank)
+
+        return self.__build_assistant(knowledge_base_server_name, knowledge_base_name, model, prompt, answer_cache_scope, search_type, search_kwargs, context_builder,
+            MODEL_BACKENDS.get(model_server_name))
+
+    def build_ingestion_assistant(self, knowledge_base_server_name: str, knowledge_base_name: str, debug_print_func=None):
+        # without language model, used by the ingestion worker, debug_print_func receives the debug events of one job
+        return self.__build_assistant(knowledge_base_server_name, knowledge_base_name, None, None, None, debug_print_func=debug_print_func)
+
+    def get_answer_cache_stats(self):
+        return answer_cache.get_stats()
+
+    def __build_assistant(self, knowledge_base_server_name: str, knowledge_base_name: str, model, prompt, answer_cache_scope,
+                          search_type: str = RETRIEVAL_SEARCH_TYPE, search_kwargs: dict = None, context_builder: ContextBuilder = None, model_backend: str = None,
+                          debug_print_func=None):
+        debug = debug_print_func or self.debug
+        vector_store = None
+
+        if knowledge_base_server_name == 'local-chroma-db':
+            from langchain_community.vectorstores.chroma import Chroma
+            vector_store = Chroma(client=self.chroma_client.get(), collection_name=knowledge_base_name, embedding_function=self.__get_embedding())
+        elif knowledge_base_server_name == 'azure-ai-search':
+            vector_store = create_azure_search(knowledge_base_name, self.__get_embedding())
+        elif knowledge_base_server_name == 'local-vector-index':
+            # in-process, no network round trip per query
+            vector_store = LocalVectorStore(self.__get_vector_index(knowledge_base_name), self.__get_embedding())
+
         text_splitter = RecursiveCharacterTextSplitter(chunk_size=1024, chunk_overlap=100)
 
-        return RagAssistant(self.debug, vector_store, model, prompt, text_splitter)
+        manifest = self.__get_manifest(knowledge_base_server_name, knowledge_base_name)
+
+        keyword_index = KeywordIndex(knowledge_base_server_name, knowledge_base_name)
+
+        ingestion_pipeline = IngestionPipeline(debug, text_splitter, self.__get_embedding(), vector_store, manifest, keyword_index)
+
+        return RagAssistant(debug, vector_store, model, prompt, text_splitter, manifest, ingestion_pipeline, self.__get_embedding(), answer_cache_scope,
+            search_type, search_kwargs or get_search_kwargs(search_type), keyword_index if RETRIEVAL_HYBRID else None, context_builder,
+            RETRIEVAL_BACKENDS.get(knowledge_base_server_name, 'local'), model_backend)
 
 
 class RagAssistant:
 
-    def __init__(self, debug_print_func, vector_store, model, prompt, text_splitter):
+    def __init__(self, debug_print_func, vector_store, model, prompt, text_splitter, manifest, ingestion_pipeline, embeddings, answer_cache_scope,
+                 search_type: str = RETRIEVAL_SEARCH_TYPE, search_kwargs: dict = None, keyword_index=None, context_builder: ContextBuilder = None,
+                 retrieval_backend: str = 'local', model_backend: str = None):
         self.debug = debug_print_func
         self.vector_store = vector_store
         self.model = model
         self.prompt = prompt
         self.text_splitter = text_splitter
-
-    def add_file(self, collection_name: str, file_path: str, original_name: str):
-        if original_name.endswith('.pdf'):
-            docs = PyPDFLoader(file_path).load()
-        elif original_name.endswith('.xls') or original_name.endswith('.xlsx'):
-            docs = UnstructuredExcelLoader(file_path, mode="elements").load()
-        elif original_name.endswith('.csv'):
-            #docs = CSVLoader(file_path, autodetect_encoding = True).load()
-            with open(file_path, 'r', newline='') as f:
-                csv_reader = csv.DictReader(f)
-                docs = []
-                for i, row in enumerate(csv_reader):
-                    doc = Document(
-                        page_content = '\n'.join(f'{k}: {v}' for k, v in row.items()),
-                        metadata = {'row': i}
-                    )
-                    docs.append(doc)
-        for doc in docs:
-            doc.metadata['source'] = original_name
-        self.debug('loaded docs', docs)
-        self.__add_docs(docs)
-
-    def add_confluence_page(self, collection_name: str, conf_space_key: str):
-        loader = ConfluenceLoader(url=ATLASSIAN_URL, username=ATLASSIAN_USERNAME, api_key=ATLASSIAN_API_KEY)
-        docs = loader.load(space_key=conf_space_key, limit=50)
-        self.debug(f'loaded docs from confluence space {conf_space_key}', docs)
-        self.__add_docs(docs)
-
-    def __add_docs(self, docs):
-        chunks = self.text_splitter.split_documents(docs)
-        self.debug('splitted chunks', chunks)
-        chunks = filter_complex_metadata(chunks)
-        self.debug('filtered chunks', chunks)
-        self.vector_store.add_documents(documents=chunks)
-
-    def ask(self, query: str):
-        retriever = self.vector_store.as_retriever(
-            #search_type = "similarity", search_kwargs = {"k": 3}
-            
-            search_type = "similarity_score_threshold", search_kwargs = {"k": 6,"score_threshold": 0.3}
-            
-            # fetch 50 document using similarity search and select 6 using maximal marginal relevance 
-            #search_type = "mmr", search_kwargs = {'k': 6, 'fetch_k': 50}
-            
-        )
-        chain = ({"context": retriever, "question": RunnablePassthrough()}
-                      | self.prompt
-                      | self.model
-                      | StrOutputParser())
-        return chain.invoke(query)
+        self.manifest = manifest
+        self.ingestion_pipeline = ingestion_pipeline
+        self.embeddings = embeddings
+        self.answer_cache_scope = answer_cache_scope
+        self.keyword_index = keyword_index
+        self.context_builder = context_builder
+        self.retrieval_backend = retrieval_backend
+        self.model_backend = model_backend
+        # compiled once, reused for every question
+        search_kwargs = search_kwargs or get_search_kwargs(search_type)
+        if context_builder and context_builder.rerank:
+            # over-fetch candidates, the reranker selects the final k
+            search_kwargs = {**search_kwargs, 'k': max(search_kwargs['k'], RERANK_FETCH_K)}
+            if 'fetch_k' in search_kwargs:
+                search_kwargs['fetch_k'] = max(search_kwargs['fetch_k'], search_kwargs['k'])
+        self.retriever = vector_store.as_retriever(search_type=search_type, search_kwargs=search_kwargs) if vector_store else None
+        if self.retriever and keyword_index:
+            self.retriever = HybridRetriever(vector_retriever=self.retriever, keyword_index=keyword_index, k=search_kwargs['k'])
+        self.answer_chain = (prompt | model | StrOutputParser()) if model else None
+
+    def add_file(self, collection_name: str, file_path: str, original_name: str, on_progress=None):
+        return self.add_files(collection_name, [(file_path, original_name)], on_progress)
+
+    def add_files(self, collection_name: str, files, on_progress=None):
+        changed_files = {}
+        for file_path, original_name in files:
+            source_hash = file_hash(file_path)
+            if self.manifest.get_source_hash(original_name) == source_hash:
+                self.debug(f'skipped unchanged file {original_name}', source_hash)
+                continue
+            changed_files[original_name] = (file_path, original_name, source_hash)
+        if not changed_files:
+            return None
+        return self.ingestion_pipeline.run_files(list(changed_files.values()), on_progress)
+
+    def add_confluence_page(self, collection_name: str, conf_space_key: str, on_progress=None):
+        # only pages changed since the last sync are fetched (concurrently) and ingested as they arrive
+        from confluence_sync import ConfluenceClient, ConfluenceSync
+        sync = ConfluenceSync(ConfluenceClient(ATLASSIAN_URL, ATLASSIAN_USERNAME, ATLASSIAN_API_KEY), self.manifest, conf_space_key)
+        pages = sync.list_pages()
+        changed = sync.changed_pages(pages)
+        self.debug(f'listed confluence space {conf_space_key}', {'pages': len(pages), 'pages-changed': len(changed)})
+        stats = {'errors': {}}
+        if changed:
+            progress = (lambda stats: on_progress({'pages-total': len(pages), 'pages-changed': len(changed), **stats})) if on_progress else None
+            stats = self.ingestion_pipeline.run_sources(changed, sync.iter_loaded(changed), progress)
+        deleted = sync.deleted_sources(pages)
+        for source_id in deleted:
+            self.__delete_chunks(self.manifest.get_chunk_ids(source_id))
+            self.manifest.remove_source(source_id)
+        # failed pages keep their old version in the manifest and are fetched again by the next sync anyway
+        if not stats['errors']:
+            sync.commit_watermark(pages)
+        return {**stats, 'pages-total': len(pages), 'pages-changed': len(changed), 'pages-deleted': len(deleted)}
+
+    def __delete_chunks(self, ids):
+        if ids:
+            self.vector_store.delete(ids=list(ids))
+            if self.ingestion_pipeline.keyword_index:
+                self.ingestion_pipeline.keyword_index.delete(ids)
+            self.manifest.remove_chunks(ids)
+
+    def ask(self, query: str, session: str = None):
+        return run_async(self.aask(query, session))
+
+    async def aask(self, query: str, session: str = None):
+        answer = ''
+        async for kind, value in self.aask_stream(query, session):
+            if kind == 'token':
+                answer += value
+        return answer
+
+    def ask_many(self, queries, max_parallel: int = ASK_MANY_PARALLEL):
+        return run_async(self.aask_many(queries, max_parallel))
+
+    async def aask_many(self, queries, max_parallel: int = ASK_MANY_PARALLEL):
+        # one batched embedding call for all queries, retrieval and answer cache lookups then hit the embedding cache
+        await call_blocking('local', self.embeddings.embed_queries, list(queries))
+        parallel = asyncio.Semaphore(max_parallel)
+        async def ask_one(query):
+            async with parallel:
+                return await self.aask(query)
+        return await asyncio.gather(*[ask_one(query) for query in queries])
+
+    def ask_stream(self, query: str, session: str = None):
+        # synchronous callers (streamlit, benchmark) share the process event loop of the clients layer
+        yield from iterate_async(self.aask_stream(query, session))
+
+    async def aask_stream(self, query: str, session: str = None):
+        # yields ('sources', docs) first, then ('token', text) while the model generates, finally ('stats', timings)
+        # blocking work (embedding, vector store sdks, reranking) runs on the bounded executor of the clients layer
+        # session is the caller's id for the fair scheduling of the ollama generations
+        start = time.perf_counter()
+        trace = span('ask', chars=len(query), retrieval_backend=self.retrieval_backend, model_backend=self.model_backend)
+        try:
+            version = self.manifest.get_version()
+            # no scope disables the answer cache (ingestion assistant, benchmark)
+            if self.answer_cache_scope:
+                with trace.child('answer-cache-lookup'):
+                    cached, match = await call_blocking('local', answer_cache.lookup, self.answer_cache_scope, version, query, self.embeddings)
+            else:
+                cached, match = None, None
+            trace.set(answer_cache=match or 'miss')
+            if cached:
+                yield 'sources', cached['sources']
+                yield 'token', cached['answer']
+                seconds = round(time.perf_counter() - start, 2)
+                yield 'stats', {'answer-cache': match, 'time-to-first-token-seconds': seconds, 'total-seconds': seconds}
+                return
+            with trace.child('retrieval') as retrieval:
+                docs = await call_blocking(self.retrieval_backend, self.retriever.invoke, query)
+                retrieval.set(docs=len(docs))
+            retrieval_seconds = time.perf_counter() - start
+            with trace.child('prompt-build') as prompt_build:
+                if self.context_builder:
+                    docs, context = await call_blocking('local', self.context_builder.build, query, docs)
+                else:
+                    context = docs
+                prompt_build.set(docs=len(docs), tokens=estimate_tokens(str(context)))
+            context_seconds = time.perf_counter() - start - retrieval_seconds
+            yield 'sources', docs
+            time_to_first_token = None
+            answer = ''
+            prompt_tokens = estimate_tokens(str(context) + query)
+            llm = trace.child('llm')
+            answer_chain = self.answer_chain
+            if self.model_backend == 'ollama' and session:
+                answer_chain = self.prompt | self.model.bind(session=session) | StrOutputParser()
+            # ollama generations are queued and capped by the scheduler, the other model servers by the backend limit
+            limited = self.model_backend and self.model_backend != 'ollama'
+            async with async_limit(self.model_backend) if limited else contextlib.nullcontext():
+                async for token in answer_chain.astream({"context": context, "question": query}):
+                    if time_to_first_token is None:
+                        time_to_first_token = time.perf_counter() - start
+                        record_stage('llm-first-token', time.perf_counter() - llm.start, trace)
+                    answer += token
+                    yield 'token', token
+            # token counts estimated from the characters, the same estimate the context budget uses
+            llm.set(**{'prompt-tokens': prompt_tokens, 'completion-tokens': estimate_tokens(answer)}).end()
+            if self.answer_cache_scope:
+                with trace.child('answer-cache-store'):
+                    await call_blocking('local', answer_cache.store, self.answer_cache_scope, version, query, self.embeddings, answer, docs)
+        except Exception as e:
+            trace.set(error=f'{type(e).__name__}: {e}')
+            raise
+        finally:
+            trace.end()
+        yield 'stats', {
+            'answer-cache': 'miss',
+            'retrieval-seconds': round(retrieval_seconds, 2),
+            'rerank-and-pack-seconds': round(context_seconds, 2),
+            # reranking was requested, but the model failed to load, the context is in retrieval order
+            'reranker-unavailable': bool(self.context_builder and self.context_builder.rerank and get_reranker_status() == 'unavailable'),
+            'context-chars': len(context) if isinstance(context, str) else None,
+            'time-to-first-token-seconds': round(time_to_first_token or 0.0, 2),
+            'total-seconds': round(time.perf_counter() - start, 2),
+        }
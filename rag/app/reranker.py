@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+
+import os
+import re
+import logging
+import threading
+
+import numpy as np
+
+from embeddings import FASTEMBED_CACHE_PATH
+
+
+RERANK_ENABLED = os.environ.get('RERANK_ENABLED', 'true') == 'true'
+# onnx export of a cross-encoder with tokenizer.json, downloaded from the huggingface hub into the fastembed cache volume
+RERANKER_MODEL_NAME = os.environ.get('RERANKER_MODEL_NAME', 'Xenova/ms-marco-MiniLM-L-6-v2')
+RERANK_FETCH_K = int(os.environ.get('RERANK_FETCH_K', '20'))
+RERANK_BATCH_SIZE = int(os.environ.get('RERANK_BATCH_SIZE', '16'))
+DUPLICATE_THRESHOLD = float(os.environ.get('DUPLICATE_THRESHOLD', '0.8'))
+
+# context tokens per model, estimated with ~4 characters per token
+CONTEXT_TOKEN_BUDGETS = {
+    'mistral': 2500,
+    'llama2': 2500,
+    'gpt-3.5-turbo': 3000,
+    'gpt-4': 6000,
+    'gpt-4-turbo-preview': 12000,
+}
+DEFAULT_CONTEXT_TOKEN_BUDGET = 2500
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_tokens(text: str):
+    return len(text) // 4 + 1
+
+def reference(doc):
+    page = doc.metadata.get('page', doc.metadata.get('row', doc.metadata.get('title', '')))
+    if 'row_end' in doc.metadata:
+        # row group of a table
+        page = f'rows {doc.metadata["row"]}-{doc.metadata["row_end"]}'
+    return f'[{doc.metadata.get("source", "")}, {page}]'
+
+def shingles(text: str, n: int = 5):
+    words = re.findall(r'\w+', text.lower())
+    return {' '.join(words[i:i + n]) for i in range(max(1, len(words) - n + 1))}
+
+
+class CrossEncoderReranker:
+
+    def __init__(self, model_name: str = RERANKER_MODEL_NAME, cache_dir=FASTEMBED_CACHE_PATH, batch_size: int = RERANK_BATCH_SIZE):
+        # imported here, only needed when reranking is enabled (both come with fastembed)
+        import onnxruntime
+        from tokenizers import Tokenizer
+        from huggingface_hub import snapshot_download
+
+        model_dir = snapshot_download(model_name, cache_dir=cache_dir, allow_patterns=['onnx/model.onnx', 'tokenizer.json', 'config.json'])
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, 'tokenizer.json'))
+        self.tokenizer.enable_truncation(max_length=512)
+        self.tokenizer.enable_padding()
+        self.session = onnxruntime.InferenceSession(os.path.join(model_dir, 'onnx', 'model.onnx'), providers=['CPUExecutionProvider'])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.batch_size = batch_size
+
+    def score(self, query: str, texts):
+        scores = []
+        for i in range(0, len(texts), self.batch_size):
+            encodings = self.tokenizer.encode_batch([(query, text) for text in texts[i:i + self.batch_size]])
+            inputs = {
+                'input_ids': np.array([e.ids for e in encodings], dtype=np.int64),
+                'attention_mask': np.array([e.attention_mask for e in encodings], dtype=np.int64),
+                'token_type_ids': np.array([e.type_ids for e in encodings], dtype=np.int64),
+            }
+            logits = self.session.run(None, {name: value for name, value in inputs.items() if name in self.input_names})[0]
+            scores.extend(float(s) for s in logits[:, 0])
+        return scores
+
+
+reranker = None
+reranker_lock = threading.Lock()
+
+def get_reranker():
+    # loaded once per process and shared by all sessions, None when disabled or not loadable
+    global reranker
+    with reranker_lock:
+        if reranker is None and RERANK_ENABLED:
+            try:
+                reranker = CrossEncoderReranker()
+            except Exception as e:
+                logger.warning('reranker %s not available, keeping retrieval order: %s', RERANKER_MODEL_NAME, e)
+                reranker = False
+        return reranker or None
+
+def get_reranker_status():
+    # unavailable: enabled, but the model failed to load and the retrieval order is kept
+    if not RERANK_ENABLED:
+        return 'disabled'
+    if reranker is None:
+        return 'not loaded'
+    return 'active' if reranker else 'unavailable'
+
+
+class ContextBuilder:
+    # over-fetched candidates -> cross-encoder rerank -> drop near duplicates -> pack into the model's token budget
+
+    def __init__(self, k: int, token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET, rerank: bool = RERANK_ENABLED):
+        self.k = k
+        self.token_budget = token_budget
+        self.rerank = rerank
+
+    def build(self, query: str, docs):
+        model = get_reranker() if self.rerank and len(docs) > 1 else None
+        if model:
+            scores = model.score(query, [doc.page_content for doc in docs])
+            docs = [doc for _, doc in sorted(zip(scores, docs), key=lambda x: x[0], reverse=True)]
+        selected = []
+        selected_shingles = []
+        context = []
+        tokens = 0
+        for doc in docs:
+            if len(selected) == self.k:
+                break
+            doc_shingles = shingles(doc.page_content)
+            # chunk overlap and the hybrid search return the same text more than once
+            if any(len(doc_shingles & s) / min(len(doc_shingles), len(s)) >= DUPLICATE_THRESHOLD for s in selected_shingles):
+                continue
+            text = f'{reference(doc)}\n{doc.page_content.strip()}'
+            doc_tokens = estimate_tokens(text)
+            if tokens + doc_tokens > self.token_budget:
+                if selected:
+                    break
+                # always keep the best chunk, cut to the budget
+                text = text[:self.token_budget * 4]
+                doc_tokens = self.token_budget
+            selected.append(doc)
+            selected_shingles.append(doc_shingles)
+            context.append(text)
+            tokens += doc_tokens
+        return selected, '\n\n'.join(context)
@@ -0,0 +1,311 @@
+#!/usr/bin/python3
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict, deque
+
+# the module, not the package, which would import every chat model integration
+from langchain_community.chat_models.ollama import ChatOllama
+
+from clients import astream_lines, iterate_async, BACKEND_CONCURRENCY
+from telemetry import metrics
+
+
+OLLAMA_BASE_URL = os.environ.get('OLLAMA_BASE_URL')
+# second ollama server, requests waiting longer than the spillover threshold are sent there, empty disables spillover
+OLLAMA_SPILLOVER_BASE_URL = os.environ.get('OLLAMA_SPILLOVER_BASE_URL', '')
+OLLAMA_SPILLOVER_MAX_CONCURRENCY = int(os.environ.get('OLLAMA_SPILLOVER_MAX_CONCURRENCY', '2'))
+SCHEDULER_SPILLOVER_WAIT_SECONDS = float(os.environ.get('SCHEDULER_SPILLOVER_WAIT_SECONDS', '5'))
+# a backend keeps serving the model it has loaded while the oldest request for another model waited less than this
+SCHEDULER_MODEL_SWITCH_SECONDS = float(os.environ.get('SCHEDULER_MODEL_SWITCH_SECONDS', '10'))
+# waiting requests per model, further requests are rejected
+SCHEDULER_MAX_QUEUE_SIZE = int(os.environ.get('SCHEDULER_MAX_QUEUE_SIZE', '100'))
+SCHEDULER_COALESCE = os.environ.get('SCHEDULER_COALESCE', 'true').lower() == 'true'
+
+WAIT_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300]
+DEFAULT_SESSION = 'default'
+
+
+class Backend:
+    # one ollama server with its cap of generations in flight
+
+    def __init__(self, name: str, base_url: str, max_in_flight: int, spillover: bool = False):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.max_in_flight = max_in_flight
+        self.spillover = spillover
+        self.in_flight = 0
+        self.model = None
+        self.requests = 0
+
+
+class Waiter:
+
+    def __init__(self, model: str, session: str, future):
+        self.model = model
+        self.session = session
+        self.future = future
+        self.enqueued = time.monotonic()
+
+
+class SharedStream:
+    # response lines of one generation, replayed to every request coalesced onto it
+    # the generation is cancelled when the last follower leaves
+
+    def __init__(self):
+        self.lines = []
+        self.done = False
+        self.error = None
+        self.followers = 0
+        self.task = None
+        self.changed = asyncio.get_running_loop().create_future()
+
+    def __notify(self):
+        self.changed.set_result(None)
+        self.changed = asyncio.get_running_loop().create_future()
+
+    def append(self, line: str):
+        self.lines.append(line)
+        self.__notify()
+
+    def finish(self, error: BaseException = None):
+        self.done = True
+        self.error = error
+        self.__notify()
+
+    async def follow(self):
+        self.followers += 1
+        i = 0
+        try:
+            while True:
+                while i < len(self.lines):
+                    yield self.lines[i]
+                    i += 1
+                if self.done:
+                    if self.error:
+                        raise self.error
+                    return
+                # shielded, a follower leaving does not cancel the wake-up of the others
+                await asyncio.shield(self.changed)
+        finally:
+            self.followers -= 1
+            if not self.followers and not self.done and self.task:
+                self.task.cancel()
+
+
+class GenerationScheduler:
+    # process-wide scheduler of the generations of all sessions on the shared event loop:
+    # requests wait in a queue per model, a backend takes the next one when it has a free slot,
+    # sessions of a model take turns (round robin), a backend stays with its loaded model while no other
+    # model waited longer than SCHEDULER_MODEL_SWITCH_SECONDS, requests waiting longer than
+    # SCHEDULER_SPILLOVER_WAIT_SECONDS may also go to the spillover backend and identical requests
+    # in flight share one generation
+
+    def __init__(self, backends):
+        self.backends = backends
+        # model -> session -> waiters, sessions in turn order, changed on the event loop and read by the ui under the lock
+        self.queues = {}
+        self.streams = {}
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'coalesced': 0, 'spilled': 0, 'rejected': 0, 'cancelled': 0}
+
+    def queue_depth(self, model: str = None):
+        with self.lock:
+            models = [model] if model else list(self.queues)
+            return sum(len(waiters) for m in models for waiters in self.queues.get(m, {}).values())
+
+    async def acquire(self, model: str, session: str):
+        # waits for a backend slot, the caller releases it
+        if self.queue_depth(model) >= SCHEDULER_MAX_QUEUE_SIZE:
+            self.__count('rejected')
+            raise ValueError(f'Ollama queue for model {model} is full ({SCHEDULER_MAX_QUEUE_SIZE} waiting), try again later.')
+        loop = asyncio.get_running_loop()
+        waiter = Waiter(model, session, loop.create_future())
+        with self.lock:
+            self.queues.setdefault(model, OrderedDict()).setdefault(session, deque()).append(waiter)
+        self.__update_gauges(model)
+        if any(backend.spillover for backend in self.backends):
+            loop.call_later(SCHEDULER_SPILLOVER_WAIT_SECONDS, self.__dispatch)
+        self.__dispatch()
+        try:
+            backend = await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # the slot was assigned in the same loop iteration the caller gave up
+                self.release(waiter.future.result())
+            else:
+                self.__remove(waiter)
+            self.__count('cancelled')
+            raise
+        wait_seconds = time.monotonic() - waiter.enqueued
+        metrics.observe('scheduler_wait_seconds', wait_seconds, buckets=WAIT_BUCKETS, model=model)
+        metrics.inc('scheduler_requests_total', backend=backend.name, model=model)
+        return backend
+
+    def release(self, backend: Backend):
+        backend.in_flight -= 1
+        metrics.set('scheduler_in_flight', backend.in_flight, backend=backend.name)
+        self.__dispatch()
+
+    def __remove(self, waiter: Waiter):
+        with self.lock:
+            sessions = self.queues.get(waiter.model, {})
+            waiters = sessions.get(waiter.session)
+            if waiters and waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del sessions[waiter.session]
+        self.__update_gauges(waiter.model)
+
+    def __dispatch(self):
+        now = time.monotonic()
+        for backend in self.backends:
+            while backend.in_flight < backend.max_in_flight:
+                waiter = self.__next_waiter(backend, now)
+                if waiter is None:
+                    break
+                if waiter.future.done():
+                    # cancelled while waiting, its task removes nothing anymore
+                    continue
+                backend.in_flight += 1
+                backend.requests += 1
+                backend.model = waiter.model
+                if backend.spillover:
+                    self.__count('spilled')
+                waiter.future.set_result(backend)
+                metrics.set('scheduler_in_flight', backend.in_flight, backend=backend.name)
+                self.__update_gauges(waiter.model)
+
+    def __next_waiter(self, backend: Backend, now: float):
+        with self.lock:
+            # oldest head of line per model, the spillover backend only takes requests past the threshold
+            heads = {}
+            for model, sessions in self.queues.items():
+                oldest = min((waiters[0].enqueued for waiters in sessions.values() if waiters), default=None)
+                if oldest is not None and (not backend.spillover or now - oldest >= SCHEDULER_SPILLOVER_WAIT_SECONDS):
+                    heads[model] = oldest
+            if not heads:
+                return None
+            model = min(heads, key=heads.get)
+            if backend.model in heads and now - heads[model] < SCHEDULER_MODEL_SWITCH_SECONDS:
+                # keep the loaded model busy instead of swapping models on every request
+                model = backend.model
+            sessions = self.queues[model]
+            # next session in turn, it moves to the end of the turn order
+            session, waiters = next(iter(sessions.items()))
+            waiter = waiters.popleft()
+            del sessions[session]
+            if waiters:
+                sessions[session] = waiters
+            return waiter
+
+    def __update_gauges(self, model: str):
+        metrics.set('scheduler_queue_depth', self.queue_depth(model), model=model)
+
+    def __count(self, name: str):
+        with self.lock:
+            self.stats[name] += 1
+        metrics.inc(f'scheduler_{name}_total')
+
+    async def astream(self, model: str, path: str, payload: dict, headers: dict = None, session: str = None):
+        # response lines of a generation, identical requests in flight are served from one generation
+        with self.lock:
+            self.stats['requests'] += 1
+        if not SCHEDULER_COALESCE:
+            async for line in self.__generate(model, path, payload, headers, session or DEFAULT_SESSION):
+                yield line
+            return
+        key = hashlib.sha256(json.dumps({'model': model, 'path': path, 'payload': payload}, sort_keys=True, default=str).encode()).hexdigest()
+        shared = self.streams.get(key)
+        if shared is not None:
+            self.__count('coalesced')
+        else:
+            shared = self.streams[key] = SharedStream()
+            shared.task = asyncio.ensure_future(self.__produce(key, shared, model, path, payload, headers, session or DEFAULT_SESSION))
+        async for line in shared.follow():
+            yield line
+
+    async def __produce(self, key, shared: SharedStream, model: str, path: str, payload: dict, headers: dict, session: str):
+        try:
+            async for line in self.__generate(model, path, payload, headers, session):
+                shared.append(line)
+            shared.finish()
+        except BaseException as e:
+            shared.finish(e)
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            if self.streams.get(key) is shared:
+                del self.streams[key]
+
+    async def __generate(self, model: str, path: str, payload: dict, headers: dict, session: str):
+        backend = await self.acquire(model, session)
+        try:
+            async for line in astream_lines(backend.name, backend.base_url + path, payload, headers):
+                yield line
+        finally:
+            self.release(backend)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['in-flight-streams'] = len(self.streams)
+        stats['queue-depth'] = {model: self.queue_depth(model) for model in list(self.queues)}
+        stats['backends'] = {b.name: {'in-flight': b.in_flight, 'max-in-flight': b.max_in_flight, 'model': b.model, 'requests': b.requests}
+                             for b in self.backends}
+        stats['wait-seconds'] = metrics.get_quantiles('scheduler_wait_seconds', label='model')
+        return stats
+
+
+def create_backends():
+    backends = [Backend('ollama', OLLAMA_BASE_URL or 'http://localhost:11434', BACKEND_CONCURRENCY['ollama'])]
+    if OLLAMA_SPILLOVER_BASE_URL:
+        backends.append(Backend('ollama-spillover', OLLAMA_SPILLOVER_BASE_URL, OLLAMA_SPILLOVER_MAX_CONCURRENCY, spillover=True))
+    return backends
+
+ollama_scheduler = GenerationScheduler(create_backends())
+
+
+class PooledChatOllama(ChatOllama):
+    # ChatOllama opens a new connection per call (requests.post, a new aiohttp session),
+    # this one streams over the pooled keep-alive clients with timeouts and retries
+    # and waits for its turn in the generation scheduler, bind(session=...) sets the session for fairness
+
+    def __request_payload(self, payload, stop, kwargs):
+        # same request body as ChatOllama
+        if self.stop is not None and stop is not None:
+            raise ValueError('`stop` found in both the input and default params.')
+        stop = self.stop if self.stop is not None else (stop or [])
+        params = self._default_params
+        for key in self._default_params:
+            if key in kwargs:
+                params[key] = kwargs[key]
+        if 'options' in kwargs:
+            params['options'] = kwargs['options']
+        else:
+            params['options'] = {**params['options'], 'stop': stop, **{k: v for k, v in kwargs.items() if k not in self._default_params}}
+        if payload.get('messages'):
+            return {'messages': payload.get('messages', []), **params}
+        return {'prompt': payload.get('prompt'), 'images': payload.get('images', []), **params}
+
+    def __headers(self):
+        return {'Content-Type': 'application/json', **(self.headers if isinstance(self.headers, dict) else {})}
+
+    def __path(self, api_url: str):
+        # the scheduler picks the server, only the api path is kept
+        return api_url[len(self.base_url.rstrip('/')):] if api_url.startswith(self.base_url.rstrip('/')) else api_url
+
+    def _create_stream(self, api_url, payload, stop=None, **kwargs):
+        session = kwargs.pop('session', None)
+        return iterate_async(ollama_scheduler.astream(self.model, self.__path(api_url), self.__request_payload(payload, stop, kwargs),
+            self.__headers(), session))
+
+    async def _acreate_stream(self, api_url, payload, stop=None, **kwargs):
+        session = kwargs.pop('session', None)
+        async for line in ollama_scheduler.astream(self.model, self.__path(api_url), self.__request_payload(payload, stop, kwargs),
+                self.__headers(), session):
+            yield line
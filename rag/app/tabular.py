@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+
+import os
+import csv
+import codecs
+
+import charset_normalizer
+from langchain_core.documents import Document
+
+
+# bytes at the start of a csv file used to detect its encoding and dialect, the rest is streamed
+TABULAR_SAMPLE_BYTES = int(os.environ.get('TABULAR_SAMPLE_BYTES', str(2**20)))
+TABULAR_CHUNK_SIZE = int(os.environ.get('TABULAR_CHUNK_SIZE', '1024'))
+TABULAR_EXTENSIONS = ('.csv', '.xlsx', '.xlsm')
+
+
+def is_tabular(original_name: str):
+    return original_name.lower().endswith(TABULAR_EXTENSIONS)
+
+def detect_encoding(file_path: str):
+    with open(file_path, 'rb') as f:
+        sample = f.read(TABULAR_SAMPLE_BYTES)
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        # incremental, a multi byte character cut at the end of the sample is not an error
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    match = charset_normalizer.from_bytes(sample).best()
+    return match.encoding if match else 'latin-1'
+
+def iter_csv_tables(file_path: str):
+    with open(file_path, 'r', newline='', encoding=detect_encoding(file_path), errors='replace') as f:
+        sample = f.read(2**16)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=',;\t|')
+        except csv.Error:
+            dialect = csv.excel
+        yield None, csv.reader(f, dialect)
+
+def iter_xlsx_tables(file_path: str):
+    # read only mode streams the sheet xml instead of building the whole workbook
+    from openpyxl import load_workbook
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        for sheet in workbook.worksheets:
+            yield sheet.title, sheet.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+def iter_table_docs(file_path: str, original_name: str, chunk_size: int = TABULAR_CHUNK_SIZE):
+    # rows grouped into chunks of up to chunk_size characters, each starting with the header row,
+    # row and row_end are the data row range of the chunk (0-based, header excluded)
+    tables = iter_csv_tables(file_path) if original_name.lower().endswith('.csv') else iter_xlsx_tables(file_path)
+    for sheet, rows in tables:
+        header = None
+        lines = []
+        size = 0
+        row = 0
+        first = 0
+        for values in rows:
+            values = ['' if v is None else str(v).strip() for v in values]
+            if not any(values):
+                continue
+            if header is None:
+                header = ' | '.join(values)
+                continue
+            line = ' | '.join(values)
+            if lines and size + len(line) + 1 > chunk_size:
+                yield table_doc(original_name, sheet, header, lines, first, row - 1)
+                lines = []
+            if not lines:
+                first = row
+                size = len(header)
+            lines.append(line)
+            size += len(line) + 1
+            row += 1
+        if lines:
+            yield table_doc(original_name, sheet, header, lines, first, row - 1)
+
+def table_doc(original_name: str, sheet, header: str, lines, first: int, last: int):
+    metadata = {'source': original_name, 'row': first, 'row_end': last}
+    if sheet is not None:
+        metadata['sheet'] = sheet
+    return Document(page_content=header + '\n' + '\n'.join(lines), metadata=metadata)
+
+def row_count(doc):
+    return doc.metadata['row_end'] - doc.metadata['row'] + 1
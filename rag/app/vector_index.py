@@ -0,0 +1,518 @@
+#!/usr/bin/python3
+
+import os
+import json
+import uuid
+import contextlib
+import shutil
+import sqlite3
+import hashlib
+import threading
+
+import numpy as np
+
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+
+from manifest import RAG_DATA_PATH
+
+
+VECTOR_INDEX_PATH = os.path.join(RAG_DATA_PATH, 'vector_index')
+# below this many chunks exact brute-force search is fast enough, above it an ivf index is trained
+VECTOR_INDEX_IVF_MIN_ROWS = int(os.environ.get('VECTOR_INDEX_IVF_MIN_ROWS', '50000'))
+# ivf lists probed per query: a fraction of the lists, at least VECTOR_INDEX_MIN_NPROBE, so the recall holds as the collection grows
+VECTOR_INDEX_NPROBE_FRACTION = float(os.environ.get('VECTOR_INDEX_NPROBE_FRACTION', '0.05'))
+VECTOR_INDEX_MIN_NPROBE = int(os.environ.get('VECTOR_INDEX_MIN_NPROBE', '8'))
+# quantized collections rank by their codes, the best k * factor candidates are rescored with the float32 vectors
+VECTOR_INDEX_RESCORE_FACTOR = int(os.environ.get('VECTOR_INDEX_RESCORE_FACTOR', '4'))
+# product quantization: dimensions per sub-vector (one byte code each), codebooks are trained from this many chunks on
+VECTOR_INDEX_PQ_SUBVECTOR_DIM = int(os.environ.get('VECTOR_INDEX_PQ_SUBVECTOR_DIM', '2'))
+VECTOR_INDEX_PQ_TRAIN_ROWS = int(os.environ.get('VECTOR_INDEX_PQ_TRAIN_ROWS', '10000'))
+
+# float32: scan the full vectors, int8: scalar quantized codes (4x smaller), pq: product quantized codes (dim / VECTOR_INDEX_PQ_SUBVECTOR_DIM bytes, 8x smaller by default)
+VECTOR_ENCODINGS = ['float32', 'int8', 'pq']
+
+INITIAL_CAPACITY = 1024
+
+
+def index_dir(name: str, path: str = VECTOR_INDEX_PATH):
+    return os.path.join(path, hashlib.sha256(name.encode('utf-8')).hexdigest()[:32])
+
+def list_vector_indexes(path: str = VECTOR_INDEX_PATH):
+    names = []
+    if os.path.isdir(path):
+        for entry in sorted(os.listdir(path)):
+            file_path = os.path.join(path, entry, 'index.sqlite')
+            if os.path.exists(file_path):
+                with contextlib.closing(sqlite3.connect(file_path, timeout=30)) as db:
+                    row = db.execute("SELECT value FROM meta WHERE key = 'name'").fetchone()
+                if row:
+                    names.append(row[0])
+    return names
+
+def normalize(vectors):
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def nearest(vectors, centroids, spherical: bool = True):
+    if spherical:
+        return np.argmax(vectors @ centroids.T, axis=1)
+    return np.argmin((centroids * centroids).sum(axis=1) - 2 * vectors @ centroids.T, axis=1)
+
+def kmeans(vectors, n_lists: int, iterations: int = 10, spherical: bool = True, seed: int = 0):
+    # spherical: centroids stay normalized so the inner product ranks lists (ivf)
+    # otherwise plain euclidean k-means (pq codebooks)
+    rng = np.random.default_rng(seed)
+    n_lists = min(n_lists, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = nearest(vectors, centroids, spherical)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        counts = np.bincount(assignments, minlength=n_lists)
+        empty = counts == 0
+        sums[empty] = centroids[empty]
+        centroids = normalize(sums) if spherical else sums / np.maximum(counts, 1)[:, None]
+    return centroids.astype(np.float32)
+
+def get_nprobe(n_lists: int, fraction: float = VECTOR_INDEX_NPROBE_FRACTION, min_nprobe: int = VECTOR_INDEX_MIN_NPROBE):
+    return min(n_lists, max(min_nprobe, int(np.ceil(n_lists * fraction))))
+
+def pq_subvector_dim(dim: int):
+    # largest divisor of dim up to the configured sub-vector size
+    return max(d for d in range(1, min(dim, VECTOR_INDEX_PQ_SUBVECTOR_DIM) + 1) if dim % d == 0)
+
+
+class LocalVectorIndex:
+    # in-process vector index, one directory per collection in the rag_data volume:
+    #   index.sqlite         chunk id, text and other metadata per slot, interned source names, free slots, counters
+    #   vectors.f32          normalized float32 matrix, memory-mapped, one row per slot
+    #   live.u1              1 for used slots, deleted slots are reused by the next add
+    #   source.i32, page.i32 metadata columns, interned source id and page + 1 per slot, 0 = none
+    #   codes.i8, scales.f32 int8 collections: scalar quantized vectors
+    #   codebook-<n>.f32     pq collections: sub-vector centroids, codes-<n>.u8 the codes of every slot
+    #   centroids-<n>.f32    ivf list centroids, lists-<n>.i32 list of every slot (+1, 0 = unassigned)
+    # the app and the ingestion worker map the same files, readers see writes through the page cache
+    # and only reopen the maps when the capacity, the ivf or the pq generation changed
+    # quantized collections only scan their codes, the float32 vectors are read for the rescored candidates
+
+    def __init__(self, name: str, path: str = VECTOR_INDEX_PATH, encoding: str = None, ivf_min_rows: int = VECTOR_INDEX_IVF_MIN_ROWS):
+        if encoding and encoding not in VECTOR_ENCODINGS:
+            raise ValueError(f'unknown vector encoding {encoding}, use one of {VECTOR_ENCODINGS}')
+        self.name = name
+        self.dir = index_dir(name, path)
+        self.ivf_min_rows = ivf_min_rows
+        self.lock = threading.Lock()
+        self.synced = None
+        self.columns = {}
+        self.centroids = None
+        self.codebook = None
+        self.source_names = {}
+        self.source_ids = {}
+        os.makedirs(self.dir, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(self.dir, 'index.sqlite'), timeout=30, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS entries (slot INTEGER PRIMARY KEY, chunk_id TEXT UNIQUE NOT NULL, content TEXT NOT NULL, extra TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS sources (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS free (slot INTEGER PRIMARY KEY)')
+        self.db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('name', ?)", (name,))
+        # the encoding is chosen when the collection is created and kept for its lifetime
+        self.db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('encoding', ?)", (encoding or 'float32',))
+        # a dropped and recreated collection of the same name gets a new id
+        self.db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('created', ?)", (uuid.uuid4().hex,))
+        meta = self.__meta()
+        self.encoding = meta['encoding']
+        self.created = meta['created']
+
+    def __meta(self):
+        return dict(self.db.execute('SELECT key, value FROM meta').fetchall())
+
+    def __column_files(self, meta):
+        # column name -> (file name, dtype, row shape), every file holds capacity rows
+        dim = meta['dim']
+        files = {
+            'vectors': ('vectors.f32', np.float32, (dim,)),
+            'live': ('live.u1', np.uint8, ()),
+            'source': ('source.i32', np.int32, ()),
+            'page': ('page.i32', np.int32, ()),
+        }
+        if self.encoding == 'int8':
+            files['codes'] = ('codes.i8', np.int8, (dim,))
+            files['scales'] = ('scales.f32', np.float32, ())
+        if meta.get('pq'):
+            files['codes'] = (f'codes-{meta["pq"]}.u8', np.uint8, (dim // meta['pq_subvector_dim'],))
+        if meta.get('ivf'):
+            files['lists'] = (f'lists-{meta["ivf"]}.i32', np.int32, ())
+        return files
+
+    def __sync(self, meta):
+        # called with self.lock held
+        if meta.get('capacity') is None:
+            return
+        generation = (meta['capacity'], meta.get('ivf', 0), meta.get('pq', 0))
+        if generation == self.synced:
+            return
+        dim = meta['dim']
+        # a new dict, searches running on the previous maps keep them
+        self.columns = {name: np.memmap(os.path.join(self.dir, file_name), dtype=dtype, mode='r+', shape=(meta['capacity'],) + shape)
+                        for name, (file_name, dtype, shape) in self.__column_files(meta).items()}
+        self.centroids = np.fromfile(os.path.join(self.dir, f'centroids-{meta["ivf"]}.f32'), dtype=np.float32).reshape(-1, dim) if meta.get('ivf') else None
+        if meta.get('pq'):
+            subvector_dim = meta['pq_subvector_dim']
+            self.codebook = np.fromfile(os.path.join(self.dir, f'codebook-{meta["pq"]}.f32'), dtype=np.float32).reshape(dim // subvector_dim, -1, subvector_dim)
+        else:
+            self.codebook = None
+        self.synced = generation
+
+    def __grow(self, meta, needed: int):
+        capacity = max(INITIAL_CAPACITY, meta.get('capacity', 0))
+        while capacity < needed:
+            capacity *= 2
+        if capacity == meta.get('capacity'):
+            return
+        # extending the files keeps the maps of other processes valid, they remap on the next search
+        for file_name, dtype, shape in self.__column_files(meta).values():
+            with open(os.path.join(self.dir, file_name), 'ab') as f:
+                f.truncate(capacity * np.dtype(dtype).itemsize * int(np.prod(shape)))
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('capacity', ?)", (capacity,))
+        meta['capacity'] = capacity
+
+    def __intern_source(self, name):
+        if name is None:
+            return 0
+        name = str(name)
+        if name not in self.source_ids:
+            self.db.execute('INSERT OR IGNORE INTO sources (name) VALUES (?)', (name,))
+            source_id, = self.db.execute('SELECT id FROM sources WHERE name = ?', (name,)).fetchone()
+            self.source_ids[name] = source_id
+            self.source_names[source_id] = name
+        return self.source_ids[name]
+
+    def __source_name(self, source_id: int):
+        if source_id not in self.source_names:
+            self.source_names.update(self.db.execute('SELECT id, name FROM sources').fetchall())
+        return self.source_names.get(source_id)
+
+    def __encode(self, columns, slots, vectors):
+        if self.encoding == 'int8':
+            # per vector scale, the largest component maps to 127
+            scales = np.abs(vectors).max(axis=1) / 127
+            scales[scales == 0] = 1.0
+            columns['codes'][slots] = np.round(vectors / scales[:, None]).astype(np.int8)
+            columns['scales'][slots] = scales
+        elif self.codebook is not None:
+            columns['codes'][slots] = pq_encode(vectors, self.codebook)
+        if self.centroids is not None:
+            columns['lists'][slots] = nearest(vectors, self.centroids) + 1
+
+    def add(self, ids, texts, metadatas, vectors):
+        # upsert by chunk id
+        if not ids:
+            return
+        vectors = normalize(vectors)
+        with self.lock:
+            # immediate transaction, serializes the app and the ingestion worker
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                meta = self.__meta()
+                if 'dim' not in meta:
+                    self.db.execute("INSERT INTO meta (key, value) VALUES ('dim', ?)", (vectors.shape[1],))
+                    meta['dim'] = vectors.shape[1]
+                self.__sync(meta)
+                self.__delete(ids)
+                free = [slot for slot, in self.db.execute('SELECT slot FROM free ORDER BY slot LIMIT ?', (len(ids),))]
+                used = meta.get('used', 0)
+                new_used = used + len(ids) - len(free)
+                slots = np.array(free + list(range(used, new_used)))
+                self.__grow(meta, new_used)
+                self.__sync(meta)
+                columns = self.columns
+                columns['vectors'][slots] = vectors
+                self.__encode(columns, slots, vectors)
+                # source and integer page as columns, all other metadata stays a json object
+                rows = []
+                sources = []
+                pages = []
+                for slot, chunk_id, text, metadata in zip(slots, ids, texts, metadatas):
+                    extra = dict(metadata or {})
+                    sources.append(self.__intern_source(extra.pop('source', None)))
+                    page = extra.get('page')
+                    if type(page) is int and 0 <= page < 2**31 - 1:
+                        pages.append(extra.pop('page') + 1)
+                    else:
+                        pages.append(0)
+                    rows.append((int(slot), chunk_id, text, json.dumps(extra, default=str) if extra else None))
+                columns['source'][slots] = sources
+                columns['page'][slots] = pages
+                for name, column in columns.items():
+                    if name != 'live':
+                        column.flush()
+                self.db.executemany('INSERT INTO entries (slot, chunk_id, content, extra) VALUES (?, ?, ?, ?)', rows)
+                self.db.executemany('DELETE FROM free WHERE slot = ?', [(slot,) for slot in free])
+                self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('used', ?)", (new_used,))
+                # slots become visible to searches last
+                columns['live'][slots] = 1
+                columns['live'].flush()
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.__train_if_needed()
+
+    def delete(self, ids):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.__sync(self.__meta())
+                self.__delete(ids)
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def __delete(self, ids):
+        slots = []
+        for i in range(0, len(ids), 500):
+            part = list(ids[i:i + 500])
+            slots.extend(slot for slot, in self.db.execute(f'SELECT slot FROM entries WHERE chunk_id IN ({",".join("?" * len(part))})', part))
+        if not slots:
+            return
+        self.columns['live'][np.array(slots)] = 0
+        self.columns['live'].flush()
+        self.db.executemany('DELETE FROM entries WHERE slot = ?', [(slot,) for slot in slots])
+        self.db.executemany('INSERT INTO free (slot) VALUES (?)', [(slot,) for slot in slots])
+
+    def __train_if_needed(self):
+        # called with self.lock held
+        # pq codebooks are trained once enough chunks exist, until then pq collections are scanned in float32
+        # ivf lists are (re)trained when the collection doubled since the last training
+        count = self.db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        meta = self.__meta()
+        train_pq = self.encoding == 'pq' and not meta.get('pq') and count >= VECTOR_INDEX_PQ_TRAIN_ROWS
+        train_ivf = count >= self.ivf_min_rows and count >= 2 * meta.get('ivf_trained_count', 0)
+        if not train_pq and not train_ivf:
+            return
+        self.db.execute('BEGIN IMMEDIATE')
+        removed = []
+        try:
+            meta = self.__meta()
+            self.__sync(meta)
+            used = meta['used']
+            vectors = self.columns['vectors']
+            live_slots = np.flatnonzero(self.columns['live'][:used])
+            rng = np.random.default_rng(0)
+            # new files per generation, searches running on the previous ones are not disturbed
+            if train_pq:
+                subvector_dim = pq_subvector_dim(meta['dim'])
+                sample = np.asarray(vectors[np.sort(rng.choice(live_slots, min(len(live_slots), 256 * 64), replace=False))])
+                parts = sample.reshape(len(sample), -1, subvector_dim)
+                codebook = np.stack([kmeans(parts[:, j], 256, spherical=False) for j in range(parts.shape[1])])
+                pq = meta.get('pq', 0) + 1
+                codebook.tofile(os.path.join(self.dir, f'codebook-{pq}.f32'))
+                codes = np.memmap(os.path.join(self.dir, f'codes-{pq}.u8'), dtype=np.uint8, mode='w+', shape=(meta['capacity'], parts.shape[1]))
+                for start in range(0, used, 65536):
+                    end = min(used, start + 65536)
+                    codes[start:end] = pq_encode(np.asarray(vectors[start:end]), codebook)
+                codes.flush()
+                self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('pq', ?)", (pq,))
+                self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('pq_subvector_dim', ?)", (subvector_dim,))
+                removed.extend([f'codebook-{pq - 1}.f32', f'codes-{pq - 1}.u8'])
+            if train_ivf:
+                n_lists = int(min(4096, max(16, 4 * np.sqrt(len(live_slots)))))
+                sample = rng.choice(live_slots, min(len(live_slots), n_lists * 64), replace=False)
+                centroids = kmeans(np.asarray(vectors[np.sort(sample)]), n_lists)
+                ivf = meta.get('ivf', 0) + 1
+                centroids.tofile(os.path.join(self.dir, f'centroids-{ivf}.f32'))
+                lists = np.memmap(os.path.join(self.dir, f'lists-{ivf}.i32'), dtype=np.int32, mode='w+', shape=(meta['capacity'],))
+                for start in range(0, used, 65536):
+                    end = min(used, start + 65536)
+                    lists[start:end] = nearest(vectors[start:end], centroids) + 1
+                lists.flush()
+                self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('ivf', ?)", (ivf,))
+                self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('ivf_trained_count', ?)", (len(live_slots),))
+                removed.extend([f'centroids-{ivf - 1}.f32', f'lists-{ivf - 1}.i32'])
+            self.db.execute('COMMIT')
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        for file_name in removed:
+            if os.path.exists(os.path.join(self.dir, file_name)):
+                os.remove(os.path.join(self.dir, file_name))
+
+    def search(self, vector, k: int, nprobe: int = None, exact: bool = False):
+        # returns [(slot, cosine similarity)], best first
+        # exact: float32 brute force over all chunks, the reference for the recall of ivf and quantization
+        query = normalize(vector)[0]
+        with self.lock:
+            meta = self.__meta()
+            self.__sync(meta)
+            used = meta.get('used', 0)
+            columns, centroids, codebook = self.columns, self.centroids, self.codebook
+        if not used:
+            return []
+        live = columns['live'][:used] == 1
+        if centroids is not None and not exact:
+            nprobe = min(nprobe or get_nprobe(len(centroids)), len(centroids))
+            probes = np.argpartition(centroids @ query, -nprobe)[-nprobe:] + 1
+            candidates = np.flatnonzero(np.isin(columns['lists'][:used], probes) & live)
+        else:
+            candidates = np.flatnonzero(live)
+        if exact or (self.encoding != 'int8' and codebook is None):
+            scores = columns['vectors'][candidates] @ query
+        else:
+            if self.encoding == 'int8':
+                scores = (columns['codes'][candidates] @ query) * columns['scales'][candidates]
+            else:
+                # inner products of the query with every sub-vector centroid, summed up along the codes
+                subspaces, _, subvector_dim = codebook.shape
+                table = np.einsum('jcd,jd->jc', codebook, query.reshape(subspaces, subvector_dim))
+                scores = table[np.arange(subspaces), columns['codes'][candidates]].sum(axis=1)
+            # rescore the best candidates with the full precision vectors
+            candidates, scores = top_k(candidates, scores, k * VECTOR_INDEX_RESCORE_FACTOR)
+            scores = columns['vectors'][candidates] @ query
+        candidates, scores = top_k(candidates, scores, k)
+        order = np.argsort(-scores)
+        return [(int(candidates[i]), float(scores[i])) for i in order]
+
+    def get(self, slots, with_vectors: bool = False):
+        # returns {slot: (chunk id, document, vector or None)} for slots still in use
+        if not slots:
+            return {}
+        with self.lock:
+            self.__sync(self.__meta())
+            rows = self.db.execute(f'SELECT slot, chunk_id, content, extra FROM entries WHERE slot IN ({",".join("?" * len(slots))})', list(slots)).fetchall()
+            columns = self.columns
+            result = {}
+            for slot, chunk_id, content, extra in rows:
+                metadata = {}
+                source_id, page = int(columns['source'][slot]), int(columns['page'][slot])
+                if source_id:
+                    metadata['source'] = self.__source_name(source_id)
+                if page:
+                    metadata['page'] = page - 1
+                if extra:
+                    metadata.update(json.loads(extra))
+                vector = np.array(columns['vectors'][slot]) if with_vectors else None
+                result[slot] = (chunk_id, Document(page_content=content, metadata=metadata), vector)
+        return result
+
+    def count(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def get_stats(self):
+        with self.lock:
+            meta = self.__meta()
+            self.__sync(meta)
+            stats = {
+                'chunk-count': self.db.execute('SELECT COUNT(*) FROM entries').fetchone()[0],
+                'vector-encoding': self.encoding + ('' if self.encoding != 'pq' or self.codebook is not None else ' (untrained)'),
+                'interned-sources': self.db.execute('SELECT COUNT(*) FROM sources').fetchone()[0],
+                'ivf-lists': len(self.centroids) if self.centroids is not None else 0,
+                'ivf-nprobe': get_nprobe(len(self.centroids)) if self.centroids is not None else 0,
+            }
+            if meta.get('capacity'):
+                used = meta['used']
+                row_bytes = {name: np.dtype(dtype).itemsize * int(np.prod(shape)) for name, (_, dtype, shape) in self.__column_files(meta).items()}
+                # searches scan the codes of quantized collections, the float32 vectors only for rescoring
+                scanned = ['codes', 'scales'] if 'codes' in row_bytes else ['vectors']
+                stats['scan-bytes-per-chunk'] = sum(row_bytes.get(name, 0) for name in scanned)
+                stats['scan-memory-mb'] = round(stats['scan-bytes-per-chunk'] * used / 2**20, 2)
+                stats['float32-memory-mb'] = round(row_bytes['vectors'] * used / 2**20, 2)
+                stats['metadata-columns-mb'] = round((row_bytes['source'] + row_bytes['page']) * used / 2**20, 2)
+        return stats
+
+    def is_current(self):
+        # false once the collection was dropped, possibly by another process, the files of this instance are unlinked then
+        file_path = os.path.join(self.dir, 'index.sqlite')
+        if not os.path.exists(file_path):
+            return False
+        try:
+            with contextlib.closing(sqlite3.connect(file_path, timeout=30)) as db:
+                row = db.execute("SELECT value FROM meta WHERE key = 'created'").fetchone()
+        except sqlite3.Error:
+            return False
+        return row is not None and row[0] == self.created
+
+    def drop(self):
+        with self.lock:
+            self.db.close()
+            shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def pq_encode(vectors, codebook):
+    subspaces, _, subvector_dim = codebook.shape
+    parts = vectors.reshape(len(vectors), subspaces, subvector_dim)
+    return np.stack([nearest(parts[:, j], codebook[j], spherical=False) for j in range(subspaces)], axis=1).astype(np.uint8)
+
+def top_k(candidates, scores, k: int):
+    if len(candidates) <= k:
+        return candidates, scores
+    top = np.argpartition(scores, -k)[-k:]
+    return candidates[top], scores[top]
+
+
+class LocalVectorStore(VectorStore):
+    # langchain vector store over a LocalVectorIndex, scores are cosine similarities
+
+    def __init__(self, index: LocalVectorIndex, embedding_function):
+        self.index = index
+        self.embedding_function = embedding_function
+
+    @property
+    def embeddings(self):
+        return self.embedding_function
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        ids = list(ids) if ids else [str(uuid.uuid4()) for _ in texts]
+        self.index.add(ids, texts, metadatas or [{}] * len(texts), self.embedding_function.embed_documents(texts))
+        return ids
+
+    def add_embeddings(self, ids, documents, vectors):
+        # ingestion pipeline, embeddings are already computed
+        self.index.add(ids, [d.page_content for d in documents], [d.metadata for d in documents], vectors)
+
+    def delete(self, ids=None, **kwargs):
+        if ids:
+            self.index.delete(list(ids))
+        return True
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs):
+        return self.similarity_search_by_vector_with_score(self.embedding_function.embed_query(query), k)
+
+    def similarity_search_by_vector(self, embedding, k: int = 4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k)]
+
+    def similarity_search_by_vector_with_score(self, embedding, k: int = 4):
+        hits = self.index.search(embedding, k)
+        entries = self.index.get([slot for slot, _ in hits])
+        return [(entries[slot][1], score) for slot, score in hits if slot in entries]
+
+    def _select_relevance_score_fn(self):
+        return lambda score: score
+
+    def max_marginal_relevance_search(self, query: str, k: int = 4, fetch_k: int = 20, lambda_mult: float = 0.5, **kwargs):
+        return self.max_marginal_relevance_search_by_vector(self.embedding_function.embed_query(query), k, fetch_k, lambda_mult)
+
+    def max_marginal_relevance_search_by_vector(self, embedding, k: int = 4, fetch_k: int = 20, lambda_mult: float = 0.5, **kwargs):
+        hits = self.index.search(embedding, fetch_k)
+        entries = self.index.get([slot for slot, _ in hits], with_vectors=True)
+        candidates = [entries[slot] for slot, _ in hits if slot in entries]
+        if not candidates:
+            return []
+        selected = maximal_marginal_relevance(normalize(embedding)[0], [vector for _, _, vector in candidates], lambda_mult=lambda_mult, k=k)
+        return [candidates[i][1] for i in selected]
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, collection_name: str = 'langchain', ids=None, encoding: str = None, **kwargs):
+        store = cls(LocalVectorIndex(collection_name, encoding=encoding), embedding)
+        store.add_texts(texts, metadatas, ids)
+        return store
@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+
+import os
+import time
+import traceback
+
+# imported first, profiles the imports of all app modules below
+from startup import mark, get_startup_report, format_startup_report
+from rag import RagBuilder
+from jobs import JobQueue
+from debug_log import DebugLog
+from telemetry import start_metrics_server
+
+mark('imports')
+
+
+JOB_POLL_SECONDS = float(os.environ.get('JOB_POLL_SECONDS', '2'))
+
+
+def on_debug(msg, obj):
+    print(msg, obj if isinstance(obj, dict) else type(obj).__name__, flush=True)
+
+def run_job(rb: RagBuilder, job_queue: JobQueue, job):
+    # the debug events are kept with the job, the app renders them in its debug panel
+    debug_log = DebugLog(job['events'])
+    def on_job_debug(msg, obj):
+        on_debug(msg, obj)
+        debug_log.append(msg, obj)
+        job_queue.update_events(job['id'], debug_log.get_state())
+    assistant = rb.build_ingestion_assistant(job['server'], job['collection'], on_job_debug)
+    on_progress = lambda progress: job_queue.update_progress(job['id'], progress)
+    payload = job['payload']
+    if job['kind'] == 'files':
+        files = [tuple(f) for f in payload['files']]
+        try:
+            stats = assistant.add_files(job['collection'], files, on_progress)
+        finally:
+            for file_path, _ in files:
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+    elif job['kind'] == 'confluence':
+        stats = assistant.add_confluence_page(job['collection'], payload['space_key'], on_progress)
+    else:
+        return f'unknown job kind {job["kind"]}'
+    if stats and stats['errors']:
+        return '\n'.join(f'{source}: {error}' for source, error in stats['errors'].items())
+    return None
+
+def run_worker():
+    rb = RagBuilder(on_debug)
+    job_queue = JobQueue()
+    start_metrics_server()
+    job_queue.requeue_running()
+    mark('ready')
+    print('ingestion worker started', flush=True)
+    print(format_startup_report(get_startup_report()), flush=True)
+    while True:
+        job = job_queue.claim_next()
+        if not job:
+            time.sleep(JOB_POLL_SECONDS)
+            continue
+        print(f'running job {job["id"]} {job["kind"]} on {job["server"]}/{job["collection"]}', flush=True)
+        try:
+            error = run_job(rb, job_queue, job)
+        except Exception:
+            error = traceback.format_exc()
+        job_queue.finish(job['id'], error)
+        print(f'finished job {job["id"]}', error or 'ok', flush=True)
+
+if __name__ == '__main__':
+    run_worker()
@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+
+# the app modules are flat modules in rag/app and read their configuration at import
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+os.environ.setdefault('RAG_DATA_PATH', tempfile.mkdtemp(prefix='rag_data_'))
+os.environ.setdefault('FASTEMBED_CACHE_PATH', tempfile.mkdtemp(prefix='fastembed_cache_'))
+# rag.py requires the settings of the external services, none of them is used by the tests
+for name in ['LANGCHAIN_TRACING_V2', 'OPENAI_ENABLED', 'ATLASSIAN_ENABLED']:
+    os.environ.setdefault(name, 'false')
+for name in ['LANGCHAIN_PROJECT', 'LANGCHAIN_ENDPOINT', 'LANGCHAIN_API_KEY', 'OPENAI_API_KEY', 'OPENAI_ORG_ID',
+             'ATLASSIAN_URL', 'ATLASSIAN_USERNAME', 'ATLASSIAN_API_KEY', 'AZURE_SEARCH_ENDPOINT', 'AZURE_SEARCH_KEY']:
+    os.environ.setdefault(name, '')
+os.environ.setdefault('OLLAMA_BASE_URL', 'http://localhost:11434')
@@ -0,0 +1,29 @@
+import json
+
+import pytest
+from langchain_community.llms.ollama import OllamaEndpointNotFoundError
+
+from clients import raise_for_status, astream_lines, iterate_async
+from fake_ollama import FakeOllama, start_server
+
+
+def test_ollama_404_keeps_the_langchain_error():
+    # ChatOllama falls back to /api/generate on this error type
+    with pytest.raises(OllamaEndpointNotFoundError, match='ollama pull mistral'):
+        raise_for_status(404, b'', 'mistral')
+
+def test_ollama_error_status():
+    with pytest.raises(ValueError, match='status code 500'):
+        raise_for_status(500, b'overloaded')
+
+
+def test_astream_lines_over_the_pooled_client():
+    server = start_server(FakeOllama(tokens=3, token_seconds=0, load_seconds=0), 0)
+    try:
+        url = f'http://127.0.0.1:{server.server_address[1]}'
+        lines = [json.loads(line) for line in iterate_async(astream_lines('ollama', url + '/api/chat', {'model': 'mistral'})) if line]
+        assert len(lines) == 4 and lines[-1]['done']
+        with pytest.raises(OllamaEndpointNotFoundError):
+            list(iterate_async(astream_lines('ollama', url + '/api/missing', {'model': 'mistral'})))
+    finally:
+        server.shutdown()
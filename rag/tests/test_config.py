@@ -0,0 +1,15 @@
+import importlib
+
+
+def test_empty_ingestion_processes_means_unset(monkeypatch):
+    # docker compose passes INGESTION_PROCESSES=${INGESTION_PROCESSES-} as an empty string
+    monkeypatch.setenv('INGESTION_PROCESSES', '')
+    import ingestion
+    ingestion = importlib.reload(ingestion)
+    assert ingestion.INGESTION_PROCESSES >= 1
+
+def test_empty_embedding_threads_means_unset(monkeypatch):
+    monkeypatch.setenv('EMBEDDING_THREADS', '')
+    import embeddings
+    embeddings = importlib.reload(embeddings)
+    assert embeddings.EMBEDDING_THREADS is None
@@ -0,0 +1,73 @@
+import time
+import asyncio
+
+from langchain_core.embeddings import FakeEmbeddings
+
+import rag
+import confluence_sync
+from rag import RagBuilder
+from manifest import DocumentManifest
+from fake_confluence import FakeConfluence, start_server
+
+
+def test_rate_limiter_below_one_request_per_second():
+    async def acquire_twice():
+        limiter = confluence_sync.RateLimiter(0.5)
+        await limiter.acquire()
+        # almost refilled, the second request waits ~0.04s
+        limiter.tokens = 0.98
+        await limiter.acquire()
+    asyncio.run(asyncio.wait_for(acquire_twice(), 2))
+
+
+def test_space_sync_advances_the_watermark_and_removes_deleted_pages(monkeypatch):
+    monkeypatch.setattr(rag.embedding_registry, 'get', lambda name: FakeEmbeddings(size=4))
+    confluence = FakeConfluence('DOCS', 4)
+    server = start_server(confluence, 0)
+    monkeypatch.setattr(rag, 'ATLASSIAN_URL', f'http://127.0.0.1:{server.server_address[1]}')
+    try:
+        rb = RagBuilder(print)
+        rb.create_knowledge_base('local-vector-index', 'confluence')
+        assistant = rb.build_ingestion_assistant('local-vector-index', 'confluence')
+        manifest = assistant.manifest
+
+        stats = assistant.add_confluence_page('confluence', 'DOCS')
+        assert (stats['pages-total'], stats['pages-changed'], stats['pages-deleted']) == (4, 4, 0)
+        newest = max(page['when'] for page in confluence.pages.values())
+        assert manifest.get_watermark('confluence:DOCS') == newest
+
+        # nothing changed, nothing fetched
+        stats = assistant.add_confluence_page('confluence', 'DOCS')
+        assert (stats['pages-changed'], stats['pages-deleted']) == (0, 0)
+
+        edited, deleted = sorted(confluence.pages)[:2]
+        deleted_chunks = manifest.get_chunk_ids(f'confluence:DOCS:{deleted}')
+        assert deleted_chunks
+        time.sleep(0.01)
+        confluence.edit(edited)
+        confluence.delete(deleted)
+        stats = assistant.add_confluence_page('confluence', 'DOCS')
+        assert (stats['pages-total'], stats['pages-changed'], stats['pages-deleted']) == (3, 1, 1)
+        assert manifest.get_source_hash(f'confluence:DOCS:{edited}') == '2'
+        assert manifest.get_source_hash(f'confluence:DOCS:{deleted}') is None
+        assert not manifest.get_chunk_ids(f'confluence:DOCS:{deleted}')
+        assert manifest.get_watermark('confluence:DOCS') == confluence.pages[edited]['when']
+    finally:
+        server.shutdown()
+
+
+def test_pages_older_than_the_watermark_are_skipped(tmp_path):
+    manifest = DocumentManifest('server', 'kb', path=str(tmp_path / 'manifest.sqlite'))
+    sync = confluence_sync.ConfluenceSync(None, manifest, 'DOCS')
+    manifest.set_source('confluence:DOCS:1', '1')
+    manifest.set_source('confluence:DOCS:2', '1')
+    manifest.set_watermark('confluence:DOCS', '2026-01-01T12:00:00.000Z')
+    pages = {
+        # known and older than the watermark minus the overlap: not compared
+        'confluence:DOCS:1': {'version': {'number': 2, 'when': '2026-01-01T10:00:00.000Z'}},
+        # within the overlap: compared by version
+        'confluence:DOCS:2': {'version': {'number': 2, 'when': '2026-01-01T11:58:00.000Z'}},
+        # new pages are always fetched
+        'confluence:DOCS:3': {'version': {'number': 1, 'when': '2026-01-01T09:00:00.000Z'}},
+    }
+    assert sync.changed_pages(pages) == {'confluence:DOCS:2': '2', 'confluence:DOCS:3': '1'}
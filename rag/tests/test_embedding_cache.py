@@ -0,0 +1,31 @@
+import numpy as np
+
+from embedding_cache import EmbeddingCache
+
+
+def vector(i):
+    return [float(i), float(i) + 0.5, 0.0, 1.0]
+
+def test_reopen_with_smaller_size_keeps_recent_entries(tmp_path):
+    # 4 dimensions are 16 bytes per slot, 100 and 40 slots
+    cache = EmbeddingCache('model', str(tmp_path), size_mb=1600 / 2**20)
+    hashes = [f'h{i}' for i in range(100)]
+    for i in range(0, 100, 10):
+        cache.put_many(hashes[i:i + 10], [vector(j) for j in range(i, i + 10)])
+    # the first ten become the most recently used
+    cache.get_many(hashes[:10])
+    cache.db.close()
+
+    cache = EmbeddingCache('model', str(tmp_path), size_mb=640 / 2**20)
+    assert cache.max_entries == 40
+    vectors = cache.get_many(hashes)
+    kept = [i for i, v in enumerate(vectors) if v is not None]
+    assert len(kept) == 40
+    assert set(range(10)) <= set(kept)
+    for i in kept:
+        assert np.allclose(vectors[i], vector(i))
+    slots = [slot for slot, in cache.db.execute('SELECT slot FROM entries')]
+    assert sorted(slots) == list(range(40))
+    # new entries evict old ones instead of writing past the end
+    cache.put_many(['new'], [vector(1000)])
+    assert np.allclose(cache.get_many(['new'])[0], vector(1000))
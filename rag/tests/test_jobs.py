@@ -0,0 +1,32 @@
+import sqlite3
+
+from langchain_core.documents import Document
+
+from jobs import JobQueue
+from debug_log import DebugLog
+
+
+def test_worker_debug_events_are_kept_with_the_job(tmp_path):
+    job_queue = JobQueue(str(tmp_path / 'jobs.sqlite'))
+    job_id = job_queue.enqueue('files', 'local-vector-index', 'kb', {'files': []})
+    job = job_queue.claim_next()
+    debug_log = DebugLog(job['events'], size=3)
+    for i in range(5):
+        debug_log.append(f'event {i}', [Document(page_content='text', metadata={'source': 'a.pdf'})])
+        job_queue.update_events(job_id, debug_log.get_state())
+    # read back like the app does
+    events = DebugLog(job_queue.list_jobs('local-vector-index', 'kb')[0]['events'])
+    assert [entry['msg'] for entry in events] == ['event 4', 'event 3', 'event 2']
+    assert events.dropped == 2
+    assert next(iter(events))['summary'] == {'documents': 1, 'chars': 4, 'sources': 1}
+
+
+def test_events_column_is_added_to_an_existing_queue(tmp_path):
+    path = str(tmp_path / 'jobs.sqlite')
+    with sqlite3.connect(path) as db:
+        db.execute('''CREATE TABLE jobs (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL, server TEXT NOT NULL, collection TEXT NOT NULL, payload TEXT NOT NULL,
+            status TEXT NOT NULL, progress TEXT NOT NULL DEFAULT '{}', error TEXT, created REAL NOT NULL, updated REAL NOT NULL)''')
+        db.execute("INSERT INTO jobs (kind, server, collection, payload, status, created, updated) VALUES ('files', 's', 'c', '{}', 'done', 0, 0)")
+    db.close()
+    assert JobQueue(path).get(1)['events'] == {}
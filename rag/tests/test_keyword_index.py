@@ -0,0 +1,44 @@
+from typing import List
+
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from keyword_index import KeywordIndex, HybridRetriever, fts_query
+
+
+class FixedRetriever(BaseRetriever):
+    docs: List[Document]
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None):
+        return self.docs
+
+
+def doc(text, row):
+    return Document(page_content=text, metadata={'source': 'parts.csv', 'row': row})
+
+
+def test_fts_query_quotes_identifiers():
+    assert fts_query('Where is P-0007 "v4.2.1"?') == '"is" OR "p-0007" OR "v4.2.1" OR "where"'
+    assert fts_query('?!') == ''
+
+
+def test_rrf_ranks_documents_found_by_both_searches_first(tmp_path):
+    index = KeywordIndex('server', 'kb', path=str(tmp_path))
+    docs = [doc('pump P-0007 seal kit', 1), doc('pump P-0008 housing', 2), doc('valve V-0100', 3), doc('pump overview', 4)]
+    index.add(['1', '2', '3', '4'], docs)
+    # vector search: 3, 1, 4 - keyword search for p-0007: 1 only
+    vector_retriever = FixedRetriever(docs=[doc('valve V-0100', 3), doc('pump P-0007 seal kit', 1), doc('pump overview', 4)])
+    retriever = HybridRetriever(vector_retriever=vector_retriever, keyword_index=index, k=3, rrf_k=60)
+    ranked = retriever.invoke('P-0007')
+    # 1: 1/62 + 1/61, 3: 1/61, 4: 1/63
+    assert [d.metadata['row'] for d in ranked] == [1, 3, 4]
+
+
+def test_rrf_keeps_k_and_deduplicates(tmp_path):
+    index = KeywordIndex('server', 'kb', path=str(tmp_path))
+    docs = [doc(f'pump part {i}', i) for i in range(5)]
+    index.add([str(i) for i in range(5)], docs)
+    retriever = HybridRetriever(vector_retriever=FixedRetriever(docs=list(reversed(docs))), keyword_index=index, k=2)
+    ranked = retriever.invoke('pump')
+    assert len(ranked) == 2
+    assert len({d.metadata['row'] for d in ranked}) == 2
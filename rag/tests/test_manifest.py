@@ -0,0 +1,65 @@
+from langchain_core.documents import Document
+from langchain_core.embeddings import FakeEmbeddings
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from manifest import DocumentManifest, chunk_ids
+from ingestion import IngestionPipeline
+from keyword_index import KeywordIndex
+from vector_index import LocalVectorIndex, LocalVectorStore
+
+
+def doc(text, page=1):
+    return Document(page_content=text, metadata={'source': 'a.pdf', 'page': page})
+
+def pipeline(tmp_path):
+    manifest = DocumentManifest('server', 'kb', path=str(tmp_path / 'manifest.sqlite'))
+    vector_index = LocalVectorIndex('kb', path=str(tmp_path / 'vector_index'))
+    keyword_index = KeywordIndex('server', 'kb', path=str(tmp_path / 'keyword_index'))
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=100, chunk_overlap=0)
+    embeddings = FakeEmbeddings(size=4)
+    return IngestionPipeline(lambda msg, obj: None, text_splitter, embeddings, LocalVectorStore(vector_index, embeddings), manifest, keyword_index), vector_index
+
+
+def test_chunk_ids_are_deterministic():
+    chunks = [doc('alpha'), doc('beta'), doc('alpha')]
+    ids = chunk_ids('a.pdf', chunks)
+    assert ids == chunk_ids('a.pdf', chunks)
+    # identical chunks of one source get their own ids, other sources other ids
+    assert len(set(ids)) == 3
+    assert not set(ids) & set(chunk_ids('b.pdf', chunks))
+    # metadata is part of the chunk identity
+    assert chunk_ids('a.pdf', [doc('alpha', page=2)])[0] != ids[0]
+
+
+def test_chunk_ids_continue_across_batches():
+    chunks = [doc('alpha'), doc('alpha'), doc('beta'), doc('alpha')]
+    seen = {}
+    batched = chunk_ids('a.pdf', chunks[:2], seen) + chunk_ids('a.pdf', chunks[2:], seen)
+    assert batched == chunk_ids('a.pdf', chunks)
+
+
+def test_changed_source_only_writes_the_difference(tmp_path):
+    ingestion, vector_index = pipeline(tmp_path)
+    stats = ingestion.run('a.pdf', 'v1', [doc('alpha'), doc('beta', page=2), doc('gamma', page=3)])
+    assert (stats['chunks-written'], stats['chunks-deleted']) == (3, 0)
+    assert ingestion.manifest.get_source_hash('a.pdf') == 'v1'
+    unchanged = ingestion.manifest.get_chunk_ids('a.pdf')
+
+    stats = ingestion.run('a.pdf', 'v2', [doc('alpha'), doc('beta', page=2), doc('delta', page=3)])
+    assert (stats['chunks-written'], stats['chunks-deleted']) == (1, 1)
+    ids = ingestion.manifest.get_chunk_ids('a.pdf')
+    assert len(ids) == 3 and len(ids & unchanged) == 2
+    assert ingestion.manifest.get_source_hash('a.pdf') == 'v2'
+    assert vector_index.count() == 3
+    assert ingestion.keyword_index.search('gamma', 5) == []
+    assert [d.page_content for d in ingestion.keyword_index.search('delta', 5)] == ['delta']
+
+
+def test_failed_source_keeps_its_old_hash(tmp_path):
+    ingestion, _ = pipeline(tmp_path)
+    ingestion.run('a.pdf', 'v1', [doc('alpha')])
+    stats = ingestion.run_sources({'a.pdf': 'v2'}, [('a.pdf', None, 'unreadable')])
+    assert stats['errors'] == {'a.pdf': 'unreadable'}
+    # not marked as synced, the next run ingests it again
+    assert ingestion.manifest.get_source_hash('a.pdf') == 'v1'
+    assert len(ingestion.manifest.get_chunk_ids('a.pdf')) == 1
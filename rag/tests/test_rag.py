@@ -0,0 +1,27 @@
+import numpy as np
+from langchain_core.embeddings import FakeEmbeddings
+
+import rag
+from rag import RagBuilder
+
+
+def test_worker_reopens_a_recreated_vector_index():
+    app, worker = RagBuilder(print), RagBuilder(print)
+    app.create_knowledge_base('local-vector-index', 'recreated')
+    stale = worker._RagBuilder__get_vector_index('recreated')
+    app.delete_knowledge_base('local-vector-index', 'recreated')
+    app.create_knowledge_base('local-vector-index', 'recreated')
+    current = worker._RagBuilder__get_vector_index('recreated')
+    assert current is not stale
+    current.add(['a'], ['text'], [{'source': 'a.pdf'}], np.ones((1, 4)))
+    assert app._RagBuilder__get_vector_index('recreated').count() == 1
+
+
+def test_answer_cache_scope_includes_the_retrieval_settings(monkeypatch):
+    monkeypatch.setattr(rag.embedding_registry, 'get', lambda name: FakeEmbeddings(size=4))
+    rb = RagBuilder(print)
+    rb.create_knowledge_base('local-vector-index', 'scoped')
+    narrow = rb.build_rag_assistant('local-vector-index', 'scoped', 'local_ollama', 'mistral', 'similarity', {'k': 2})
+    wide = rb.build_rag_assistant('local-vector-index', 'scoped', 'local_ollama', 'mistral', 'similarity', {'k': 8})
+    assert narrow.answer_cache_scope != wide.answer_cache_scope
+    assert rb.build_rag_assistant('local-vector-index', 'scoped', 'local_ollama', 'mistral', 'similarity', {'k': 2}) is narrow
@@ -0,0 +1,20 @@
+import logging
+
+from langchain_core.documents import Document
+
+import reranker
+
+
+def test_unloadable_reranker_keeps_order_and_reports_unavailable(monkeypatch, caplog):
+    def fail(*args, **kwargs):
+        raise OSError('no model')
+    monkeypatch.setattr(reranker, 'RERANK_ENABLED', True)
+    monkeypatch.setattr(reranker, 'reranker', None)
+    monkeypatch.setattr(reranker, 'CrossEncoderReranker', fail)
+    docs = [Document(page_content=f'chunk number {i} about topic {i}', metadata={'source': f'{i}.pdf', 'page': 1}) for i in range(3)]
+    assert reranker.get_reranker_status() == 'not loaded'
+    with caplog.at_level(logging.WARNING, logger='reranker'):
+        selected, _ = reranker.ContextBuilder(2, rerank=True).build('topic', docs)
+    assert selected == docs[:2]
+    assert reranker.get_reranker_status() == 'unavailable'
+    assert 'no model' in caplog.text
@@ -0,0 +1,64 @@
+import json
+import asyncio
+
+from scheduler import GenerationScheduler, Backend
+from fake_ollama import FakeOllama, start_server
+
+
+def test_sessions_take_turns():
+    async def grant_order():
+        backend = Backend('ollama', 'http://localhost:11434', 1)
+        scheduler = GenerationScheduler([backend])
+        # the slot is taken, all requests queue
+        backend.in_flight = 1
+        order = []
+
+        async def request(session):
+            await scheduler.acquire('mistral', session)
+            order.append(session)
+
+        tasks = [asyncio.ensure_future(request(session)) for session in ['a', 'a', 'a', 'b']]
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth('mistral') == 4
+        for _ in tasks:
+            scheduler.release(backend)
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        return order
+    # b's single request does not wait behind all of a's
+    assert asyncio.run(grant_order()) == ['a', 'b', 'a', 'a']
+
+
+def test_cancelled_request_leaves_the_queue():
+    async def cancel():
+        backend = Backend('ollama', 'http://localhost:11434', 1)
+        scheduler = GenerationScheduler([backend])
+        backend.in_flight = 1
+        task = asyncio.ensure_future(scheduler.acquire('mistral', 'a'))
+        await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return scheduler.queue_depth('mistral'), scheduler.stats['cancelled']
+    assert asyncio.run(cancel()) == (0, 1)
+
+
+def test_identical_requests_share_one_generation():
+    ollama = FakeOllama(parallel=2, tokens=5, token_seconds=0.01, load_seconds=0)
+    server = start_server(ollama, 0)
+
+    async def generate(scheduler, prompts):
+        async def lines(prompt):
+            return [json.loads(line) async for line in scheduler.astream('mistral', '/api/chat', {'model': 'mistral', 'messages': [prompt]}) if line]
+        return await asyncio.gather(*[lines(prompt) for prompt in prompts])
+
+    try:
+        scheduler = GenerationScheduler([Backend('ollama', f'http://127.0.0.1:{server.server_address[1]}', 2)])
+        same, also_same, other = asyncio.run(generate(scheduler, ['hello', 'hello', 'bye']))
+        assert same == also_same
+        assert len(same) == 6 and same[-1]['done']
+        assert len(other) == 6
+        assert scheduler.stats['requests'] == 3 and scheduler.stats['coalesced'] == 1
+        assert ollama.get_stats()['requests'] == 2
+        assert not scheduler.streams
+    finally:
+        server.shutdown()
@@ -0,0 +1,60 @@
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from tabular import iter_table_docs, row_count
+from ingestion import iter_file_chunks
+
+
+def write_csv(path, lines, encoding='utf-8'):
+    path.write_bytes(('\n'.join(lines) + '\n').encode(encoding))
+    return str(path)
+
+
+def test_csv_rows_are_grouped_with_the_header(tmp_path):
+    rows = [f'P-{i:04d};pump part {i};{i * 10}' for i in range(40)]
+    file_path = write_csv(tmp_path / 'parts.csv', ['part;name;price', ''] + rows[:20] + [';;'] + rows[20:])
+    docs = list(iter_table_docs(file_path, 'parts.csv', chunk_size=120))
+    assert len(docs) > 1
+    for doc in docs:
+        lines = doc.page_content.split('\n')
+        assert lines[0] == 'part | name | price'
+        assert len(doc.page_content) <= 120
+        assert len(lines) - 1 == row_count(doc)
+        assert doc.metadata['source'] == 'parts.csv'
+    # contiguous row ranges over all data rows, empty rows skipped
+    assert docs[0].metadata['row'] == 0
+    assert all(a.metadata['row_end'] + 1 == b.metadata['row'] for a, b in zip(docs, docs[1:]))
+    assert docs[-1].metadata['row_end'] == 39
+    assert [line for doc in docs for line in doc.page_content.split('\n')[1:]] == [row.replace(';', ' | ') for row in rows]
+
+
+def test_csv_encoding_is_detected(tmp_path):
+    rows = ['Zürich,Schweiz,Grüße aus der Stadt', 'Köln,Deutschland,Schöne Straßen und Brücken'] * 20
+    file_path = write_csv(tmp_path / 'cities.csv', ['city,country,note'] + rows, encoding='latin-1')
+    docs = list(iter_table_docs(file_path, 'cities.csv'))
+    assert docs[0].page_content.split('\n')[:3] == ['city | country | note', 'Zürich | Schweiz | Grüße aus der Stadt',
+                                                     'Köln | Deutschland | Schöne Straßen und Brücken']
+
+
+def test_xlsx_sheets_are_separate_tables(tmp_path):
+    from openpyxl import Workbook
+    workbook = Workbook()
+    workbook.active.title = 'pumps'
+    workbook.active.append(['part', 'price'])
+    workbook.active.append(['P-0001', 10])
+    valves = workbook.create_sheet('valves')
+    valves.append(['part', 'price'])
+    valves.append(['V-0001', None])
+    workbook.save(tmp_path / 'parts.xlsx')
+    docs = list(iter_table_docs(str(tmp_path / 'parts.xlsx'), 'parts.xlsx'))
+    assert [(doc.metadata['sheet'], doc.page_content) for doc in docs] == [
+        ('pumps', 'part | price\nP-0001 | 10'), ('valves', 'part | price\nV-0001 | ')]
+
+
+def test_oversized_rows_go_through_the_text_splitter(tmp_path):
+    file_path = write_csv(tmp_path / 'notes.csv', ['id,note', '1,short', '2,' + ' '.join(['word'] * 100), '3,short'])
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=100, chunk_overlap=0)
+    [(doc_count, chunks, _)] = iter_file_chunks(file_path, 'notes.csv', text_splitter, 16)
+    # docs counts rows, not row groups or chunks
+    assert doc_count == 3
+    assert len(chunks) > 3
+    assert all(len(chunk.page_content) <= 100 for chunk in chunks)
@@ -0,0 +1,42 @@
+import numpy as np
+
+from vector_index import LocalVectorIndex, get_nprobe
+
+
+def test_nprobe_scales_with_the_lists():
+    assert get_nprobe(16) == 8
+    assert get_nprobe(4096) == 205
+    assert get_nprobe(4) == 4
+
+
+def test_ivf_recall_stays_within_target(tmp_path):
+    rng = np.random.default_rng(1)
+    centers = rng.normal(size=(200, 32))
+    vectors = centers[rng.integers(0, len(centers), 20000)] + rng.normal(scale=1.0, size=(20000, 32))
+    index = LocalVectorIndex('recall', path=str(tmp_path), ivf_min_rows=10000)
+    for start in range(0, len(vectors), 5000):
+        ids = [f'chunk-{i}' for i in range(start, start + 5000)]
+        index.add(ids, ['text'] * len(ids), [{'source': 'a.pdf', 'page': 1}] * len(ids), vectors[start:start + 5000])
+    stats = index.get_stats()
+    assert stats['ivf-lists'] > 0
+    assert stats['ivf-nprobe'] == get_nprobe(stats['ivf-lists'])
+    recalls = []
+    # questions resemble some of the chunks
+    for query in vectors[rng.integers(0, len(vectors), 100)] + rng.normal(scale=0.5, size=(100, 32)):
+        approximate = {slot for slot, _ in index.search(query, 10)}
+        exact = {slot for slot, _ in index.search(query, 10, exact=True)}
+        recalls.append(len(approximate & exact) / len(exact))
+    assert np.mean(recalls) >= 0.95
+
+
+def test_recreated_collection_is_detected(tmp_path):
+    # the worker's cached instance must not keep writing into the files of a deleted collection
+    cached = LocalVectorIndex('kb', path=str(tmp_path))
+    cached.add(['a'], ['text'], [{'source': 'a.pdf'}], np.ones((1, 4)))
+    assert cached.is_current()
+    LocalVectorIndex('kb', path=str(tmp_path)).drop()
+    assert not cached.is_current()
+    recreated = LocalVectorIndex('kb', path=str(tmp_path))
+    assert recreated.is_current()
+    assert not cached.is_current()
+    assert recreated.count() == 0